@@ -0,0 +1,53 @@
+import argparse
+import json
+import sys
+
+import sig_load
+
+parser = argparse.ArgumentParser(
+    description='Runs sig_load.py against the gevent and asyncio backends')
+parser.add_argument('--backends', default='gevent,asyncio')
+parser.add_argument('--devices', default='250,1000,4000',
+                    help='device counts to run, one client per device')
+parser.add_argument('--rounds', type=int, default=3)
+parser.add_argument('--port', type=int, default=8765)
+parser.add_argument('--output', default='', help='write results to this file')
+
+
+def summary(results):
+    return {"connections": results['connections'],
+            "connect_rate": results['connect_rate'],
+            "messages_per_s": results['throughput']['messages_per_s'],
+            "forward_latency_ms": results['forward_latency_ms'],
+            "rss_kb_per_connection": results['rss_kb']['per_connection'],
+            "errors": results['errors']}
+
+def print_table(comparison):
+    print(f'{"backend":<8} {"conns":>6} {"conn/s":>8} {"msg/s":>8} '
+          f'{"p50 ms":>8} {"p99 ms":>8} {"KiB/conn":>8}', file=sys.stderr)
+    for backend, runs in comparison.items():
+        for run in runs:
+            print(f'{backend:<8} {run["connections"]:>6} '
+                  f'{run["connect_rate"]["clients_per_s"]:>8} {run["messages_per_s"]:>8} '
+                  f'{run["forward_latency_ms"]["p50"]:>8} {run["forward_latency_ms"]["p99"]:>8} '
+                  f'{run["rss_kb_per_connection"]:>8}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    sig_load.raise_fd_limit()
+    comparison = {}
+    for backend in args.backends.split(','):
+        comparison[backend] = []
+        for devices in args.devices.split(','):
+            load_args = sig_load.parser.parse_args([
+                '--devices', devices, '--rounds', str(args.rounds),
+                '--port', str(args.port), f'--server_args=--backend={backend}'])
+            comparison[backend].append(summary(sig_load.benchmark(load_args)))
+
+    print_table(comparison)
+    output = json.dumps(comparison, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    print(output)
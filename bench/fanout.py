@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import websockets
+
+import sig_load
+
+parser = argparse.ArgumentParser(
+    description='Compares broadcast and per-client forwards from one device to many viewers')
+parser.add_argument('--viewers', default='1,2,5,10,20,50,100')
+parser.add_argument('--messages', type=int, default=200,
+                    help='messages sent by the device in each run')
+parser.add_argument('--port', type=int, default=8765)
+parser.add_argument('--server_args', default='',
+                    help='extra arguments for wsgi.py, e.g. "--backend=asyncio"')
+parser.add_argument('--output', default='', help='write results to this file')
+
+
+async def connect(url, message, replies):
+    ws = await websockets.connect(url, max_size=None, ping_interval=None)
+    await ws.send(json.dumps(message))
+    for _ in range(replies):
+        await ws.recv()
+    return ws
+
+async def receive_all(ws, count, latencies):
+    for _ in range(count):
+        message = json.loads(await ws.recv())
+        latencies.append(time.monotonic() - message['payload']['sent'])
+
+async def run(url, device_id, viewers, messages, broadcast):
+    """Sends messages from a device to all its viewers and times delivery"""
+
+    device = await connect(f'{url}/register_device', {
+        "message_type": "register", "device_id": device_id, "device_info": {}}, 1)
+    clients = await asyncio.gather(*[
+        connect(f'{url}/connect_client',
+                {"message_type": "connect", "device_id": device_id}, 2)
+        for _ in range(viewers)])
+    client_ids = list(range(1, viewers + 1))
+
+    latencies = []
+    receivers = [asyncio.ensure_future(receive_all(ws, messages, latencies))
+                 for ws in clients]
+    start = time.monotonic()
+    for i in range(messages):
+        candidate = dict(sig_load.fake_candidate(i), type='ice-candidate')
+        if broadcast:
+            await device.send(sig_load.forward(candidate, client_id='*'))
+        else:
+            for client_id in client_ids:
+                await device.send(sig_load.forward(dict(candidate), client_id=client_id))
+    sent = time.monotonic()
+    await asyncio.gather(*receivers)
+    done = time.monotonic()
+
+    await asyncio.gather(*[ws.close() for ws in clients + [device]])
+    return {"viewers": viewers,
+            "device_send_ms": round((sent - start) * 1000, 1),
+            "deliveries_per_s": round(viewers * messages / (done - start)),
+            "latency_ms": {"p50": round(sig_load.percentile(latencies, 0.5) * 1000, 3),
+                           "p99": round(sig_load.percentile(latencies, 0.99) * 1000, 3)}}
+
+async def run_all(args):
+    url = f'ws://127.0.0.1:{args.port}'
+    results = {"broadcast": [], "per_client": []}
+    for viewers in [int(count) for count in args.viewers.split(',')]:
+        for mode in results:
+            results[mode].append(await run(url, f'fanout-{mode}-{viewers}', viewers,
+                                           args.messages, mode == 'broadcast'))
+    return results
+
+def print_table(results):
+    print(f'{"viewers":>7} {"mode":<10} {"send ms":>9} {"deliv/s":>9} '
+          f'{"p50 ms":>8} {"p99 ms":>8}', file=sys.stderr)
+    for broadcast, per_client in zip(results['broadcast'], results['per_client']):
+        for mode, run in [('broadcast', broadcast), ('per_client', per_client)]:
+            print(f'{run["viewers"]:>7} {mode:<10} {run["device_send_ms"]:>9} '
+                  f'{run["deliveries_per_s"]:>9} {run["latency_ms"]["p50"]:>8} '
+                  f'{run["latency_ms"]["p99"]:>8}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    sig_load.raise_fd_limit()
+    server = sig_load.start_server(args)
+    try:
+        results = asyncio.run(run_all(args))
+    finally:
+        server.terminate()
+        server.wait()
+
+    print_table(results)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    print(output)
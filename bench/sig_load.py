@@ -0,0 +1,289 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import websockets
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(
+    description='Replays WebRTC signaling traffic against the signaling server')
+parser.add_argument('--devices', type=int, default=1000)
+parser.add_argument('--clients_per_device', type=int, default=1)
+parser.add_argument('--candidates', type=int, default=8,
+                    help='ICE candidates sent by each side of a session')
+parser.add_argument('--ice_interval', type=float, default=0.01,
+                    help='seconds between two ICE candidates')
+parser.add_argument('--rounds', type=int, default=3,
+                    help='offer/answer exchanges per session')
+parser.add_argument('--connect_concurrency', type=int, default=200)
+parser.add_argument('--port', type=int, default=8765)
+parser.add_argument('--url', default='',
+                    help='server to test instead of starting wsgi.py')
+parser.add_argument('--server_args', default='',
+                    help='extra arguments for wsgi.py, e.g. "--workers=4"')
+parser.add_argument('--timeout', type=float, default=120)
+parser.add_argument('--output', default='', help='write results to this file')
+parser.add_argument('--baseline', default='',
+                    help='results to compare with, exits 1 on regression')
+parser.add_argument('--tolerance', type=float, default=0.2,
+                    help='allowed relative regression against the baseline')
+
+
+def fake_sdp(kind):
+    """Returns an SDP about the size of a Cuttlefish audio and video offer"""
+
+    lines = ['v=0', f'o=- {random.getrandbits(60)} 2 IN IP4 127.0.0.1', 's=-', 't=0 0',
+             'a=group:BUNDLE 0 1 2', 'a=msid-semantic: WMS']
+    for mid, media in enumerate(['video', 'audio', 'application']):
+        lines += [f'm={media} 9 UDP/TLS/RTP/SAVPF 96 97 98 99 100 101 102',
+                  'c=IN IP4 0.0.0.0', 'a=rtcp:9 IN IP4 0.0.0.0',
+                  f'a=ice-ufrag:{random.getrandbits(32):08x}',
+                  f'a=ice-pwd:{random.getrandbits(128):032x}',
+                  'a=fingerprint:sha-256 ' + ':'.join(
+                      f'{random.getrandbits(8):02X}' for _ in range(32)),
+                  f'a=setup:{"actpass" if kind == "offer" else "active"}', f'a=mid:{mid}']
+        for payload_type in range(96, 103):
+            lines += [f'a=rtpmap:{payload_type} VP8/90000',
+                      f'a=rtcp-fb:{payload_type} goog-remb',
+                      f'a=rtcp-fb:{payload_type} transport-cc',
+                      f'a=rtcp-fb:{payload_type} nack pli']
+    return '\r\n'.join(lines) + '\r\n'
+
+# Generated once, so the load generator spends its time on the sockets
+OFFERS = [fake_sdp('offer') for _ in range(16)]
+ANSWERS = [fake_sdp('answer') for _ in range(16)]
+
+def fake_candidate(index):
+    return {"candidate": f'candidate:{random.getrandbits(31)} 1 udp 1677729535 '
+                         f'203.0.113.{index % 250} {40000 + index} typ srflx '
+                         f'raddr 10.0.0.5 rport {40000 + index} generation 0 '
+                         f'ufrag abcd network-cost 999',
+            "sdpMid": str(index % 3), "sdpMLineIndex": index % 3}
+
+
+class Stats:
+
+    def __init__(self):
+        self.latencies = [] # seconds
+        self.messages = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def received(self, raw):
+        message = json.loads(raw)
+        if message.get('message_type') in ('client_msg', 'device_msg'):
+            self.latencies.append(time.monotonic() - message['payload']['sent'])
+            self.messages += 1
+            self.bytes += len(raw)
+        return message
+
+
+def forward(payload, **fields):
+    payload['sent'] = time.monotonic()
+    return json.dumps(dict(fields, message_type='forward', payload=payload))
+
+
+async def run_device(ws, device_id, args, stats):
+    """Answers every offer, then trickles ICE candidates"""
+
+    expected = args.clients_per_device * args.rounds * (1 + args.candidates)
+    received = 0
+    while received < expected:
+        message = stats.received(await ws.recv())
+        received += 1
+        payload = message['payload']
+        if payload['type'] == 'offer':
+            client_id = message['client_id']
+            await ws.send(forward({"type": "answer", "sdp": random.choice(ANSWERS)},
+                                  client_id=client_id))
+            asyncio.ensure_future(send_candidates(ws, args, client_id=client_id))
+
+async def run_client(ws, args, stats):
+    """Sends an offer and candidates, waits for the answer and candidates"""
+
+    for _ in range(args.rounds):
+        await ws.send(forward({"type": "offer", "sdp": random.choice(OFFERS)}))
+        sender = asyncio.ensure_future(send_candidates(ws, args))
+        for _ in range(1 + args.candidates):
+            stats.received(await ws.recv())
+        await sender
+
+async def send_candidates(ws, args, **fields):
+    for i in range(args.candidates):
+        await asyncio.sleep(args.ice_interval)
+        await ws.send(forward(dict(fake_candidate(i), type='ice-candidate'), **fields))
+
+
+async def connect_all(url, messages, concurrency, stats):
+    """Opens one connection per message. Returns the connections and rate."""
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def connect(message):
+        async with semaphore:
+            ws = await websockets.connect(url, max_size=None, ping_interval=None,
+                                          open_timeout=60)
+            await ws.send(json.dumps(message))
+            config = json.loads(await ws.recv())
+            if config.get('message_type') != 'config':
+                stats.errors += 1
+            if message['message_type'] == 'connect':
+                await ws.recv() # device_info
+            return ws
+
+    start = time.monotonic()
+    connections = await asyncio.gather(*[connect(message) for message in messages])
+    elapsed = time.monotonic() - start
+    return connections, len(messages) / elapsed
+
+
+def process_rss_kb(pid):
+    """Returns the resident memory of a process and its children"""
+
+    total = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f'/proc/{current}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+            with open(f'/proc/{current}/task/{current}/children') as children:
+                pids.extend(int(child) for child in children.read().split())
+        except FileNotFoundError:
+            pass
+    return total
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def run_benchmark(args, server_pid):
+    url = args.url or f'ws://127.0.0.1:{args.port}'
+    stats = Stats()
+    rss_start = process_rss_kb(server_pid) if server_pid else None
+
+    device_ids = [f'bench-device-{i}' for i in range(args.devices)]
+    devices, device_rate = await connect_all(f'{url}/register_device', [
+        {"message_type": "register", "device_id": device_id,
+         "device_info": {"bench": True}} for device_id in device_ids],
+        args.connect_concurrency, stats)
+    clients, client_rate = await connect_all(f'{url}/connect_client', [
+        {"message_type": "connect", "device_id": device_id}
+        for device_id in device_ids for _ in range(args.clients_per_device)],
+        args.connect_concurrency, stats)
+    rss_connected = process_rss_kb(server_pid) if server_pid else None
+
+    start = time.monotonic()
+    await asyncio.wait_for(asyncio.gather(
+        *[run_device(ws, device_id, args, stats)
+          for ws, device_id in zip(devices, device_ids)],
+        *[run_client(ws, args, stats) for ws in clients]), args.timeout)
+    elapsed = time.monotonic() - start
+
+    await asyncio.gather(*[ws.close() for ws in devices + clients])
+
+    connections = len(devices) + len(clients)
+    return {
+        "config": {name: value for name, value in vars(args).items()
+                   if name not in ('output', 'baseline')},
+        "connections": connections,
+        "connect_rate": {"devices_per_s": round(device_rate, 1),
+                         "clients_per_s": round(client_rate, 1)},
+        "throughput": {"messages_per_s": round(stats.messages / elapsed, 1),
+                       "bytes_per_s": round(stats.bytes / elapsed),
+                       "messages": stats.messages},
+        "forward_latency_ms": {
+            name: round(percentile(stats.latencies, fraction) * 1000, 3)
+            for name, fraction in [('p50', 0.5), ('p99', 0.99), ('max', 1.0)]},
+        "rss_kb": {"idle": rss_start, "connected": rss_connected,
+                   "per_connection": round((rss_connected - rss_start) / connections, 2)
+                                     if server_pid else None},
+        "errors": stats.errors,
+    }
+
+
+# Metrics compared against a baseline, and whether higher is better
+COMPARED = [(('connect_rate', 'devices_per_s'), True),
+            (('connect_rate', 'clients_per_s'), True),
+            (('throughput', 'messages_per_s'), True),
+            (('forward_latency_ms', 'p50'), False),
+            (('forward_latency_ms', 'p99'), False),
+            (('rss_kb', 'per_connection'), False)]
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for (section, name), higher_is_better in COMPARED:
+        current = results[section].get(name)
+        previous = baseline.get(section, {}).get(name)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append({"metric": f'{section}.{name}', "baseline": previous,
+                                "current": current, "change": round(change, 3)})
+    return regressions
+
+
+def start_server(args):
+    command = [sys.executable, os.path.join(REPO_DIR, 'wsgi.py'),
+               '--port', str(args.port), '--log_level', 'WARNING'] + args.server_args.split()
+    server = subprocess.Popen(command, cwd=REPO_DIR, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', args.port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    sys.exit('Signaling server did not start')
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def benchmark(args):
+    """Runs one benchmark, starting and stopping the server if needed"""
+
+    server = None if args.url else start_server(args)
+    try:
+        return asyncio.run(run_benchmark(args, server.pid if server else None))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    raise_fd_limit()
+    results = benchmark(args)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file),
+                                           args.tolerance)
+        results['regressions'] = regressions
+        exit_code = 1 if regressions else 0
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    print(output)
+    sys.exit(exit_code)
@@ -1,35 +1,74 @@
 import os, sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import halyard_utils as utils
-from instance.node_manager import list_nodes
-
-def list_disks(driver):
-    disks = driver.list_volumes()
-    disk_list = []
-    for disk in disks:
-        disk_list.append({"name": disk.name})
-    halyard_disks = list(filter(lambda x: x['name'].startswith('halyard-user'), disk_list))
-    return halyard_disks
-
-def list_stopped_disks(driver):
-    disks = driver.list_volumes()
-    disk_list = []
-    for disk in disks:
-        disk_list.append({"name": disk.name})
-
-    active_nodes = list_nodes(driver)
-    halyard_nodes = list(filter(lambda x: x['name'].startswith('halyard'), active_nodes))
-    node_ids = [x['name'][8:] for x in halyard_nodes]
-    
-    halyard_disks = list(filter(lambda x: x['name'].startswith('halyard-user'), disk_list))
-    stopped_instances = [{"name": x['name']} for x in halyard_disks if x['name'][13:] not in node_ids]
-
-    return stopped_instances
-
-def delete_disk(driver, disk_name, zone):
-    disk = utils.find_disk(driver, disk_name, zone)
+import inventory_cache as cache
+import state_store
+import zone_index
+from concurrent.futures import ThreadPoolExecutor
+
+def list_disks(driver, prefix=utils.USER_DISK_PREFIX, zone=None,
+               limit=None, page_token=None):
+    """Yields pages of user disks whose name starts with prefix."""
+
+    if state_store.store:
+        return utils.iter_pages(lambda max_results, page_token: state_store.store.disks(
+            prefix, zone, max_results, page_token), limit, page_token)
+
+    filter_expr = utils.gce_filter(name=utils.prefix_pattern(prefix))
+
+    def fetch_page(max_results, page_token):
+        items, next_page_token = utils.list_page(
+            driver, 'disks', filter_expr, zone, max_results, page_token)
+        return [{"name": item['name']} for item in items], next_page_token
+
+    def cached_page(max_results, page_token):
+        return cache.get(cache.VOLUMES,
+            lambda: fetch_page(max_results, page_token),
+            prefix, zone, max_results, page_token)
+
+    return utils.iter_pages(cached_page, limit, page_token)
+
+def list_stopped_disks(driver, prefix=utils.USER_DISK_PREFIX, zone=None,
+                       limit=None, page_token=None):
+    """Yields pages of user disks that don't belong to an active instance"""
+
+    if state_store.store:
+        yield from utils.iter_pages(lambda max_results, page_token:
+            state_store.store.stopped_disks(prefix, zone, max_results, page_token),
+            limit, page_token)
+        return
+
+    def fetch_nodes():
+        return utils.list_by_prefix(
+            driver, 'instances', utils.INSTANCE_PREFIX, zone)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        pages = list_disks(driver, prefix, zone, limit, page_token)
+        first_page = executor.submit(next, pages)
+        nodes = executor.submit(cache.get, cache.NODES, fetch_nodes,
+                                utils.INSTANCE_PREFIX, zone)
+
+    active_user_ids = {utils.instance_user_id(node) for node in nodes.result()}
+
+    def stopped(disks):
+        return [disk for disk in disks
+                if utils.user_id_from_name(disk['name'], utils.USER_DISK_PREFIX)
+                not in active_user_ids]
+
+    disks, next_page_token = first_page.result()
+    yield stopped(disks), next_page_token
+    for disks, next_page_token in pages:
+        yield stopped(disks), next_page_token
+
+def delete_disk(driver, disk_name, zone=None):
+    """Deletes a disk, looked up in every configured zone without zone"""
+
+    disk, _ = zone_index.find_disk(driver, disk_name, zone)
     if disk:
         driver.destroy_volume(disk)
+        zone_index.forget(zone_index.DISKS, disk_name)
+        state_store.delete(state_store.DISKS, disk_name)
+        cache.invalidate(cache.VOLUMES)
         return {"deleted_disk": disk_name}
     else:
         return {"error": "disk not found"}
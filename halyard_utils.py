@@ -1,20 +1,73 @@
-import os
+import re
+import threading
 import time
+from concurrent import futures
+import readiness_prober
+import remote_exec
+
+INSTANCE_PREFIX = 'halyard-'
+USER_DISK_PREFIX = 'halyard-user-'
+
+# Labels of hosts in the warm pool
+POOL_LABEL = 'halyard-pool'
+STATE_LABEL = 'halyard-state'
+USER_LABEL = 'halyard-user'
+
+PAGE_SIZE = 500 # maximum page size allowed by the GCE API
+GLOBAL_APIS = ['images']
+
+LOGIN_INTERVAL = 5 # seconds between SSH logins to a booting instance
+
+class HalyardError(Exception):
+    """Error that stops the current operation"""
+
+_progress = threading.local()
 
 def add_flag(parser, flag_name, default):
     parser.add_argument(f'--{flag_name}', dest=flag_name,
                         action='store', default=default)
 
-def wait_for_instance(instance_name, zone):
-    not_running = 1
-    while not_running != 0:
-        time.sleep(5)
-        # uptime returns a value other than 0 when not successful
-        not_running = os.system(f'gcloud compute ssh {instance_name} --zone={zone} -- uptime')
+def wait_for_instance(driver, instance_name, zone,
+                      timeout=readiness_prober.DEFAULT_DEADLINE):
+    """Blocks until the instance accepts SSH logins.
+       The SSH port answers before the guest agent installed the keys, so
+       logins are retried until the deadline. The first one opens the
+       connection later commands reuse."""
+
+    deadline = time.monotonic() + timeout
+    prober = readiness_prober.get_prober(driver)
+    try:
+        # The prober fails the instance at the deadline, this only guards
+        # against a prober that stopped answering
+        address = prober.watch(instance_name, zone, timeout).result(
+            timeout + readiness_prober.MAX_INTERVAL)
+    except readiness_prober.InstanceNotReady as e:
+        fatal_error(str(e))
+    except futures.TimeoutError:
+        fatal_error(f'{instance_name} not reachable after {timeout} seconds')
+
+    while True:
+        try:
+            remote_exec.run(instance_name, zone, 'true')
+            return address
+        except remote_exec.RemoteExecError as e:
+            if time.monotonic() + LOGIN_INTERVAL > deadline:
+                fatal_error(f'{instance_name} accepts no SSH logins: {e}')
+        time.sleep(LOGIN_INTERVAL)
 
 def fatal_error(msg):
     print(f'Error: {msg}')
-    exit()
+    raise HalyardError(msg)
+
+def set_progress_reporter(reporter):
+    """Sets callback receiving (phase, progress) updates on this thread"""
+    _progress.reporter = reporter
+
+def report_progress(phase, progress):
+    """Reports current phase and progress (0 to 1) of a long operation"""
+    reporter = getattr(_progress, 'reporter', None)
+    if reporter:
+        reporter(phase, progress)
 
 def find_instance(driver, instance_name, zone):
     try:
@@ -43,4 +96,81 @@ def find_gpu(driver, gpu_type, zone):
             gpu_type, zone=zone)
     except:
         gpu = None
-    return gpu
\ No newline at end of file
+    return gpu
+
+def user_id_from_name(name, prefix):
+    """Strips the halyard resource prefix from an instance or disk name"""
+    return name[len(prefix):]
+
+def instance_user_id(instance):
+    """Returns the user of a raw GCE instance.
+       Warm pool hosts carry it in a label, other instances in their name."""
+
+    labels = instance.get('labels', {})
+    if USER_LABEL in labels:
+        return labels[USER_LABEL]
+    return user_id_from_name(instance['name'], INSTANCE_PREFIX)
+
+def get_public_ips(instance):
+    return [config['natIP']
+            for interface in instance.get('networkInterfaces', [])
+            for config in interface.get('accessConfigs', [])
+            if 'natIP' in config]
+
+def gce_filter(**patterns):
+    """Builds a GCE list filter matching each field against a regex"""
+
+    expressions = [f'{field} eq {pattern}' for field, pattern in patterns.items()]
+    if len(expressions) == 1:
+        return expressions[0]
+    return ' '.join(f'({expression})' for expression in expressions)
+
+def prefix_pattern(prefix):
+    return f'{re.escape(prefix)}.*'
+
+def list_page(driver, api_name, filter_expr, zone=None,
+              max_results=PAGE_SIZE, page_token=None):
+    """Requests a single page of raw GCE resources matching filter_expr.
+       Uses the driver zone by default, or every zone when zone is 'all'.
+       Returns the items and the token of the next page, if any."""
+
+    if api_name in GLOBAL_APIS:
+        request_path = f'/global/{api_name}'
+    elif zone == 'all':
+        request_path = f'/aggregated/{api_name}'
+    else:
+        request_path = f'/zones/{zone or driver.zone.name}/{api_name}'
+
+    params = {'filter': filter_expr, 'maxResults': max_results}
+    if page_token:
+        params['pageToken'] = page_token
+
+    response = driver.connection.request(
+        request_path, method='GET', params=params).object
+
+    if request_path.startswith('/aggregated'):
+        items = []
+        for scoped in response.get('items', {}).values():
+            items.extend(scoped.get(api_name, []))
+    else:
+        items = response.get('items', [])
+    return items, response.get('nextPageToken')
+
+def iter_pages(fetch_page, limit=None, page_token=None):
+    """Yields (items, next_page_token) from fetch_page(max_results, page_token).
+       Only one page is fetched when limit is given, otherwise all of them."""
+
+    while True:
+        items, page_token = fetch_page(limit or PAGE_SIZE, page_token)
+        yield items, page_token
+        if limit or not page_token:
+            return
+
+def list_by_prefix(driver, api_name, name_prefix, zone=None):
+    """Lists raw GCE resources whose name starts with name_prefix.
+       Filtering is done by the GCE API instead of the client."""
+
+    filter_expr = gce_filter(name=prefix_pattern(name_prefix))
+    pages = iter_pages(lambda max_results, page_token: list_page(
+        driver, api_name, filter_expr, zone, max_results, page_token))
+    return [item for items, _ in pages for item in items]
@@ -0,0 +1,171 @@
+import hashlib, json, os, shlex, subprocess, tempfile, urllib.request
+
+# Cuttlefish .deb packages keyed by repository url, branch and commit
+DEBS = 'debs'
+# fetch_cvd outputs keyed by build target and build_id
+ARTIFACTS = 'artifacts'
+
+BUILD_API = 'https://www.googleapis.com/android/internal/build/v3/builds'
+
+store = None # Cache used by image builds, if any
+
+def configure(location):
+    """Uses a gs:// bucket or a local directory as the artifact cache"""
+
+    global store
+    if not location:
+        store = None
+    elif location.startswith('gs://'):
+        store = BucketCache(location)
+    else:
+        store = LocalCache(location)
+
+def content_key(*parts):
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+def resolve_commit(repository_url, repository_branch):
+    """Returns the commit a branch points to, or None"""
+
+    result = subprocess.run(
+        ['git', 'ls-remote', repository_url, f'refs/heads/{repository_branch}'],
+        capture_output=True, text=True)
+    fields = result.stdout.split()
+    return fields[0] if result.returncode == 0 and fields else None
+
+def latest_build_id(build_branch, build_target):
+    """Returns the latest successful build of a target, or None"""
+
+    url = (f'{BUILD_API}?branch={build_branch}&buildAttemptStatus=complete'
+           f'&buildType=submitted&maxResults=1&successful=true&target={build_target}')
+    try:
+        with urllib.request.urlopen(url, timeout=30) as response:
+            return json.load(response)['builds'][0]['buildId']
+    except Exception:
+        return None
+
+
+class BucketCache:
+    """Cache in a GCS bucket, read and written by the build instance"""
+
+    scope = 'storage-rw'
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def location(self, kind, key):
+        return f'{self.url}/{kind}/{key}.tar'
+
+    def contains(self, kind, key):
+        result = subprocess.run(['gsutil', '-q', 'stat', self.location(kind, key)])
+        return result.returncode == 0
+
+    def fetch(self, kind, key, build_instance, build_zone):
+        """Returns where the build instance reads a cached tarball from,
+           or None when it couldn't be made available there"""
+        return self.location(kind, key)
+
+    def destination(self, kind, key):
+        """Returns where the build instance writes a new tarball to"""
+        return self.location(kind, key)
+
+    def collect(self, kind, key, build_instance, build_zone):
+        """Stores a tarball written by the build instance"""
+        return True
+
+
+class LocalCache:
+    """Cache in a directory of the API server, copied to and from the
+       build instance over scp"""
+
+    scope = 'storage-ro'
+    remote_dir = 'halyard-cache'
+
+    def __init__(self, path):
+        self.path = path
+
+    def location(self, kind, key):
+        return os.path.join(self.path, kind, f'{key}.tar')
+
+    def contains(self, kind, key):
+        return os.path.exists(self.location(kind, key))
+
+    def fetch(self, kind, key, build_instance, build_zone):
+        remote_path = f'{self.remote_dir}/{kind}.tar'
+        status = os.system(f'gcloud compute ssh --zone={build_zone} {build_instance} \
+            -- mkdir -p {self.remote_dir}')
+        if status == 0:
+            status = os.system(f'gcloud compute scp {self.location(kind, key)} \
+                {build_instance}:{remote_path} --zone={build_zone}')
+        if status != 0:
+            print(f'Could not copy cached {kind} to {build_instance}')
+            return None
+        return remote_path
+
+    def destination(self, kind, key):
+        return f'{self.remote_dir}-out/{kind}.tar'
+
+    def collect(self, kind, key, build_instance, build_zone):
+        location = self.location(kind, key)
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        # Written next to its final name, so a partial copy is never used
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(location))
+        os.close(fd)
+        status = os.system(f'gcloud compute scp \
+            {build_instance}:{self.destination(kind, key)} {tmp_path} --zone={build_zone}')
+        if status != 0:
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, location)
+        return True
+
+
+def plan_build(build_instance, build_zone, repository_url, repository_branch,
+               build_branch, build_target, build_id):
+    """Looks up the packages and artifacts of a build in the cache.
+       Returns the build_id to use, the environment of
+       create_base_image_gce.sh, the steps taken from the cache and the
+       (kind, key) pairs the build should store."""
+
+    plan = {"build_id": build_id, "env": {}, "cached": [], "store": []}
+    if not store:
+        return plan
+
+    commit = resolve_commit(repository_url, repository_branch)
+    if not build_id:
+        build_id = latest_build_id(build_branch, build_target) or ''
+    plan['build_id'] = build_id
+
+    steps = []
+    if commit:
+        plan['env']['REPOSITORY_COMMIT'] = commit
+        steps.append((DEBS, content_key(repository_url, repository_branch, commit)))
+    if build_id:
+        steps.append((ARTIFACTS, content_key(build_target, build_id)))
+
+    for kind, key in steps:
+        cached = None
+        if store.contains(kind, key):
+            cached = store.fetch(kind, key, build_instance, build_zone)
+        if cached:
+            plan['env'][f'CACHED_{kind.upper()}'] = cached
+            plan['cached'].append(kind)
+        else:
+            # Built again when the cached copy couldn't be fetched
+            plan['env'][f'SAVE_{kind.upper()}'] = store.destination(kind, key)
+            plan['store'].append((kind, key))
+    return plan
+
+def build_env(plan):
+    """Returns the plan environment as shell variable assignments"""
+    return ' '.join(f'{name}={shlex.quote(value)}' for name, value in plan['env'].items())
+
+def store_results(plan, build_instance, build_zone):
+    """Adds the outputs of a finished build to the cache"""
+
+    stored = []
+    for kind, key in plan['store']:
+        if store.collect(kind, key, build_instance, build_zone):
+            stored.append(kind)
+        else:
+            print(f'Could not store {kind} in the artifact cache')
+    return stored
@@ -3,25 +3,73 @@
 set -x
 set -o errexit
 
-sudo apt-get update
-
-# Stuff we need to get build support
-sudo apt install -y debhelper ubuntu-dev-tools equivs cloud-utils git bsdtar
-
 repository_url=$1
 repository_branch=$2
 build_branch=$3
 build_target=$4
 build_id=$5
 
+# Artifact cache, see artifact_cache.py. CACHED_* name tarballs of earlier
+# builds to use instead of building, SAVE_* where to store what is built
+# here. Both are gs:// URIs or paths on this instance, empty when unused.
+# Relative paths are relative to the home directory.
+cache_path() {
+  if [[ -n "$1" && "$1" != gs://* && "$1" != /* ]]; then
+    echo "${HOME}/$1"
+  else
+    echo "$1"
+  fi
+}
+
+repository_commit="${REPOSITORY_COMMIT:-}"
+cached_debs="$(cache_path "${CACHED_DEBS:-}")"
+cached_artifacts="$(cache_path "${CACHED_ARTIFACTS:-}")"
+save_debs="$(cache_path "${SAVE_DEBS:-}")"
+save_artifacts="$(cache_path "${SAVE_ARTIFACTS:-}")"
+
+# Completed steps are recorded here, so running the script again on the
+# same instance after a failure resumes with the step that failed.
+steps_dir=~/halyard-build-steps
+mkdir -p "${steps_dir}"
+
+step_done() {
+  [[ -f "${steps_dir}/$1" ]]
+}
+
+finish_step() {
+  touch "${steps_dir}/$1"
+}
+
+cache_get() {
+  if [[ "$1" == gs://* ]]; then
+    gsutil -q cp "$1" "$2"
+  else
+    cp "$1" "$2"
+  fi
+}
+
+cache_put() {
+  if [[ "$2" == gs://* ]]; then
+    gsutil -q cp "$1" "$2"
+  else
+    mkdir -p "$(dirname "$2")"
+    cp "$1" "$2"
+  fi
+}
+
 # Gets debian packages from Cuttlefish repo
 fetch_cf_package() {
   local url="$1"
   local branch="$2"
+  local commit="$3"
   local repository_dir="${url/*\//}"
   local debian_dir="$(basename "${repository_dir}" .git)"
 
   git clone "${url}" -b "${branch}"
+  # Builds the commit the cache key was computed from
+  if [[ -n "${commit}" ]]; then
+    git -C "${debian_dir}" checkout "${commit}"
+  fi
   dpkg-source -b "${debian_dir}"
   rm -rf "${debian_dir}"
 }
@@ -32,112 +80,183 @@ get_cf_version() {
   cf_version="${cf_version//\./-}"
 }
 
+mount_once() {
+  local target="${@: -1}"
+  if ! mountpoint -q "${target}"; then
+    sudo mount "$@"
+  fi
+}
 
-fetch_cf_package "${repository_url}" "${repository_branch}" 
-get_cf_version
-
-# Gets latest successful build_id from target branch in case no build_id is specified
-if [[ -z "${build_id}" ]]; then
-  build_id=`curl "https://www.googleapis.com/android/internal/build/v3/builds?branch=$build_branch&buildAttemptStatus=complete&buildType=submitted&maxResults=1&successful=true&target=$build_target" 2>/dev/null | \
-  python2 -c "import sys, json; print json.load(sys.stdin)['builds'][0]['buildId']"`
-fi
-
-# Writes dest image and family values into file
-name_values=("cf_version=${cf_version}" "build_id=${build_id}")
-printf "%s\n" "${name_values[@]}" > image_name_values
 
-# Install the cuttlefish build deps
-for dsc in *.dsc; do
-  yes | sudo mk-build-deps -i "${dsc}" -t apt-get
-done
+if ! step_done tools; then
+  sudo apt-get update
 
-# Installing the build dependencies left some .deb files around. Remove them
-# to keep them from landing on the image.
-yes | rm -f *.deb
+  # Stuff we need to get build support
+  sudo apt install -y debhelper ubuntu-dev-tools equivs cloud-utils git bsdtar
+  finish_step tools
+fi
 
-for dsc in *.dsc; do
-  # Unpack the source and build it
+if ! step_done packages; then
+  # Packages are built in a directory of their own, so a failed attempt
+  # leaves nothing behind for the next one
+  rm -rf packages
+  mkdir packages
+  pushd packages
+
+  if [[ -n "${cached_debs}" ]]; then
+    cache_get "${cached_debs}" debs.tar
+    tar -xf debs.tar
+    rm debs.tar
+    cf_version=$(cat cf_version)
+  else
+    fetch_cf_package "${repository_url}" "${repository_branch}" "${repository_commit}"
+    get_cf_version
+  fi
+
+  # Gets latest successful build_id from target branch in case no build_id is specified
+  if [[ -z "${build_id}" ]]; then
+    build_id=`curl "https://www.googleapis.com/android/internal/build/v3/builds?branch=$build_branch&buildAttemptStatus=complete&buildType=submitted&maxResults=1&successful=true&target=$build_target" 2>/dev/null | \
+    python2 -c "import sys, json; print json.load(sys.stdin)['builds'][0]['buildId']"`
+  fi
+
+  # Writes dest image and family values into file
+  name_values=("cf_version=${cf_version}" "build_id=${build_id}")
+  printf "%s\n" "${name_values[@]}" > ~/image_name_values
+
+  if [[ -z "${cached_debs}" ]]; then
+    # Install the cuttlefish build deps
+    for dsc in *.dsc; do
+      yes | sudo mk-build-deps -i "${dsc}" -t apt-get
+    done
+
+    # Installing the build dependencies left some .deb files around. Remove them
+    # to keep them from landing on the image.
+    yes | rm -f *.deb
+
+    for dsc in *.dsc; do
+      # Unpack the source and build it
+
+      dpkg-source -x "${dsc}"
+      dir="$(basename "${dsc}" .dsc)"
+      dir="${dir/_/-}"
+      pushd "${dir}/"
+      debuild -uc -us
+      popd
+    done
+
+    if [[ -n "${save_debs}" ]]; then
+      echo "${cf_version}" > cf_version
+      tar -cf debs.tar *.deb cf_version
+      cache_put debs.tar "${save_debs}"
+      rm debs.tar cf_version
+    fi
+  fi
 
-  dpkg-source -x "${dsc}"
-  dir="$(basename "${dsc}" .dsc)"
-  dir="${dir/_/-}"
-  pushd "${dir}/"
-  debuild -uc -us
   popd
-done
+  finish_step packages
+fi
+
+# Build id the packages step resolved
+build_id=$(sed -n 's/^build_id=//p' ~/image_name_values)
 
 # Now gather all of the *.deb files to copy them into the image
-debs=(*.deb)
+debs=(packages/*.deb)
 
 tmp_debs=()
 for i in "${debs[@]}"; do
   tmp_debs+=(/tmp/"$(basename "$i")")
 done
 
-# Fix partition table size
-sudo growpart /dev/sdb 1
-sudo e2fsck -f /dev/sdb1
-sudo resize2fs /dev/sdb1
-
-# Now install the packages on the disk
-sudo mkdir /mnt/image
-sudo mount /dev/sdb1 /mnt/image
-cp "${debs[@]}" /mnt/image/tmp
-
-sudo mount -t sysfs none /mnt/image/sys
-sudo mount -t proc none /mnt/image/proc
-sudo mount --bind /dev/ /mnt/image/dev
-sudo mount --bind /dev/pts /mnt/image/dev/pts
-sudo mount --bind /run /mnt/image/run
+if ! step_done resize_disk; then
+  # Fix partition table size
+  sudo growpart /dev/sdb 1
+  sudo e2fsck -f /dev/sdb1
+  sudo resize2fs /dev/sdb1
+  finish_step resize_disk
+fi
+
+# Mounts don't survive a reboot of the build instance, so they are not a step
+sudo mkdir -p /mnt/image
+mount_once /dev/sdb1 /mnt/image
+
+mount_once -t sysfs none /mnt/image/sys
+mount_once -t proc none /mnt/image/proc
+mount_once --bind /dev/ /mnt/image/dev
+mount_once --bind /dev/pts /mnt/image/dev/pts
+mount_once --bind /run /mnt/image/run
 # resolv.conf is needed on Debian but not Ubuntu
 sudo cp /etc/resolv.conf /mnt/image/etc/
-sudo chroot /mnt/image /usr/bin/apt update
-sudo chroot /mnt/image /usr/bin/apt install -y "${tmp_debs[@]}"
-# install tools dependencies
-sudo chroot /mnt/image /usr/bin/apt install -y python
-sudo chroot /mnt/image /usr/bin/apt install -y openjdk-11-jre
-sudo chroot /mnt/image /usr/bin/apt install -y unzip bzip2 lzop bsdtar
-sudo chroot /mnt/image /usr/bin/apt install -y aapt
-sudo chroot /mnt/image /usr/bin/apt install -y screen # needed by tradefed
-
-# Fetches build artifacts 
-sudo mkdir /mnt/image/usr/local/share/cuttlefish
-sudo chmod -R 777 /mnt/image/usr/local/share/cuttlefish
-sudo chmod 777 'download_artifacts.sh'
-sudo cp 'download_artifacts.sh' /mnt/image/usr/local/share/cuttlefish
-sudo target="${build_target}" build_id="${build_id}" \
-  chroot /mnt/image sh -c \
-    'cd /usr/local/share/cuttlefish; \
-    ./download_artifacts.sh ${target} ${build_id}; \
-    rm download_artifacts.sh'
-sudo chmod -R 777 /mnt/image/usr/local/share/cuttlefish
+
+if ! step_done install_packages; then
+  # Now install the packages on the disk
+  cp "${debs[@]}" /mnt/image/tmp
+  sudo chroot /mnt/image /usr/bin/apt update
+  sudo chroot /mnt/image /usr/bin/apt install -y "${tmp_debs[@]}"
+  # install tools dependencies
+  sudo chroot /mnt/image /usr/bin/apt install -y python
+  sudo chroot /mnt/image /usr/bin/apt install -y openjdk-11-jre
+  sudo chroot /mnt/image /usr/bin/apt install -y unzip bzip2 lzop bsdtar
+  sudo chroot /mnt/image /usr/bin/apt install -y aapt
+  sudo chroot /mnt/image /usr/bin/apt install -y screen # needed by tradefed
+  finish_step install_packages
+fi
+
+if ! step_done artifacts; then
+  # Fetches build artifacts
+  sudo mkdir -p /mnt/image/usr/local/share/cuttlefish
+  sudo chmod -R 777 /mnt/image/usr/local/share/cuttlefish
+  if [[ -n "${cached_artifacts}" ]]; then
+    cache_get "${cached_artifacts}" artifacts.tar
+    tar -C /mnt/image/usr/local/share/cuttlefish -xf artifacts.tar
+    rm artifacts.tar
+  else
+    sudo chmod 777 'download_artifacts.sh'
+    sudo cp 'download_artifacts.sh' /mnt/image/usr/local/share/cuttlefish
+    sudo target="${build_target}" build_id="${build_id}" \
+      chroot /mnt/image sh -c \
+        'cd /usr/local/share/cuttlefish; \
+        ./download_artifacts.sh ${target} ${build_id}; \
+        rm download_artifacts.sh'
+
+    if [[ -n "${save_artifacts}" ]]; then
+      sudo tar -C /mnt/image/usr/local/share/cuttlefish -cf artifacts.tar .
+      cache_put artifacts.tar "${save_artifacts}"
+      sudo rm artifacts.tar
+    fi
+  fi
+  sudo chmod -R 777 /mnt/image/usr/local/share/cuttlefish
+  finish_step artifacts
+fi
 
 sudo chroot /mnt/image /usr/bin/find /home -ls
 
 
-# Install GPU driver dependencies
-sudo chroot /mnt/image /usr/bin/apt install -y gcc
-sudo chroot /mnt/image /usr/bin/apt install -y linux-source
-sudo chroot /mnt/image /usr/bin/apt install -y linux-headers-`uname -r`
-sudo chroot /mnt/image /usr/bin/apt install -y make
+if ! step_done gpu_driver; then
+  # Install GPU driver dependencies
+  sudo chroot /mnt/image /usr/bin/apt install -y gcc
+  sudo chroot /mnt/image /usr/bin/apt install -y linux-source
+  sudo chroot /mnt/image /usr/bin/apt install -y linux-headers-`uname -r`
+  sudo chroot /mnt/image /usr/bin/apt install -y make
 
-# Download the latest GPU driver installer
-gsutil cp \
-  $(gsutil ls gs://nvidia-drivers-us-public/GRID/GRID*/*-Linux-x86_64-*.run \
-    | sort \
-    | tail -n 1) \
-  /mnt/image/tmp/nvidia-driver-installer.run
+  # Download the latest GPU driver installer
+  gsutil cp \
+    $(gsutil ls gs://nvidia-drivers-us-public/GRID/GRID*/*-Linux-x86_64-*.run \
+      | sort \
+      | tail -n 1) \
+    /mnt/image/tmp/nvidia-driver-installer.run
 
-# Make GPU driver installer executable
-chmod +x /mnt/image/tmp/nvidia-driver-installer.run
+  # Make GPU driver installer executable
+  chmod +x /mnt/image/tmp/nvidia-driver-installer.run
 
-# Install the latest GPU driver with default options and the dispatch libs
-sudo chroot /mnt/image /tmp/nvidia-driver-installer.run \
-  --silent \
-  --install-libglvnd
+  # Install the latest GPU driver with default options and the dispatch libs
+  sudo chroot /mnt/image /tmp/nvidia-driver-installer.run \
+    --silent \
+    --install-libglvnd
 
-# Cleanup after install
-rm /mnt/image/tmp/nvidia-driver-installer.run
+  # Cleanup after install
+  rm /mnt/image/tmp/nvidia-driver-installer.run
+  finish_step gpu_driver
+fi
 
 # Verify
 query_nvidia() {
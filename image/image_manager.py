@@ -1,16 +1,42 @@
-import os, sys
+import collections, hashlib, os, re, sys, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import halyard_utils as utils
+import inventory_cache as cache
+import placement
+import state_store
+from image import artifact_cache
 
-def list_images(driver):
-    images = driver.list_images()
-    image_list = []
-    for image in images:
-        image_list.append({"name": image.name})
-    halyard_images = list(filter(lambda x: x['name'].startswith('halyard'), image_list))
-    return halyard_images
+def list_images(driver, prefix='halyard', family=None, limit=None, page_token=None):
+    """Yields pages of images whose name starts with prefix."""
+
+    if state_store.store:
+        return utils.iter_pages(lambda max_results, page_token: state_store.store.images(
+            prefix, family, max_results, page_token), limit, page_token)
+
+    patterns = {'name': utils.prefix_pattern(prefix)}
+    if family:
+        patterns['family'] = re.escape(family)
+    filter_expr = utils.gce_filter(**patterns)
+
+    def fetch_page(max_results, page_token):
+        items, next_page_token = utils.list_page(
+            driver, 'images', filter_expr, None, max_results, page_token)
+        images = [{"name": item['name']} for item in items
+                  if 'deprecated' not in item]
+        return images, next_page_token
+
+    def cached_page(max_results, page_token):
+        return cache.get(cache.IMAGES,
+            lambda: fetch_page(max_results, page_token),
+            prefix, family, max_results, page_token)
+
+    return utils.iter_pages(cached_page, limit, page_token)
 
 def get_image(driver, image_name):
+    stored = state_store.store.image(image_name) if state_store.store else None
+    if stored:
+        return stored
     image = utils.find_image(driver, image_name)
     if image:
         return {"name": image.name,
@@ -24,6 +50,8 @@ def delete_image(driver, image_name):
     image = utils.find_image(driver, image_name)
     if image:
         driver.ex_delete_image(image)
+        state_store.delete(state_store.IMAGES, image_name)
+        cache.invalidate(cache.IMAGES)
         return {"deleted_image": image_name}
     else:
         return {"Error": f"image {image_name} not found."}
@@ -31,16 +59,24 @@ def delete_image(driver, image_name):
 
 PATH = 'image'
 
+BUILD_GPU = 'nvidia-tesla-p100-vws'
+BUILD_CPUS = 16 # n1-standard-16
+BUILD_DISK_GB = 30
+DEFAULT_BUILD_ZONE = 'europe-west4-a'
+
 def get_dest_names(build_branch, build_target, build_id, build_instance, build_zone,
                       dest_image, dest_family):
     """Updates cf_version and build_id values extracted from gce script to name the new image"""
 
+    # Builds of a matrix run concurrently, each one gets a file of its own
+    fd, values_path = tempfile.mkstemp(prefix='image_name_values', dir=PATH)
+    os.close(fd)
     os.system(f'gcloud compute scp {build_instance}:~/image_name_values \
-        {PATH}/image_name_values --zone={build_zone}')
+        {values_path} --zone={build_zone}')
 
     variables = {}
 
-    with open(f'{PATH}/image_name_values') as f:
+    with open(values_path) as f:
         for line in f:
             name, value = line.split('=')
             variables[name] = value.strip()
@@ -48,7 +84,7 @@ def get_dest_names(build_branch, build_target, build_id, build_instance, build_z
     cf_version = variables['cf_version']
     build_id = variables['build_id']
 
-    os.remove(f'{PATH}/image_name_values')
+    os.remove(values_path)
 
     build_target = build_target.replace('_','-')
 
@@ -61,105 +97,400 @@ def get_dest_names(build_branch, build_target, build_id, build_instance, build_z
     return {'dest_image': dest_image, 'dest_family': dest_family}
 
 
-def create_base_image(driver,
+# Phases of an image build. The last completed one is checkpointed in the
+# labels of the image disk, which carries the state of the build.
+BUILD_PHASES = ['create_build_instance', 'build_image', 'create_image']
+CHECKPOINT_KEY = 'halyard-build-key'
+CHECKPOINT_PHASE = 'halyard-build-phase'
+CHECKPOINT_IMAGE = 'halyard-dest-image'
+CHECKPOINT_FAMILY = 'halyard-dest-family'
+CHECKPOINT_CACHED = 'halyard-cached-steps'
+
+def build_key(*params):
+    """Identifies the build a checkpoint was made for"""
+    return hashlib.sha1('\n'.join(map(str, params)).encode()).hexdigest()[:16]
+
+def read_checkpoint(build_volume, key):
+    """Returns the checkpoint of an image disk, or None when the disk
+       belongs to another build"""
+
+    labels = build_volume.extra.get('labels') or {}
+    if labels.get(CHECKPOINT_KEY) != key or labels.get(CHECKPOINT_PHASE) not in BUILD_PHASES:
+        return None
+    cached = labels.get(CHECKPOINT_CACHED, '')
+    return {"phase": labels[CHECKPOINT_PHASE],
+            "dest_image": labels.get(CHECKPOINT_IMAGE, ''),
+            "dest_family": labels.get(CHECKPOINT_FAMILY, ''),
+            "cached_steps": cached.split('_') if cached else []}
+
+def save_checkpoint(driver, image_disk, zone, key, phase,
+                    dest_image='', dest_family='', cached_steps=[]):
+    """Records phase as the last completed one in the image disk labels"""
+
+    # Labels are set against the disk's current label fingerprint, which
+    # changes with every checkpoint
+    build_volume = utils.find_disk(driver, image_disk, zone)
+    if not build_volume:
+        utils.fatal_error(f'Image disk {image_disk} disappeared during the build')
+    labels = {CHECKPOINT_KEY: key, CHECKPOINT_PHASE: phase}
+    if dest_image:
+        labels[CHECKPOINT_IMAGE] = dest_image
+        labels[CHECKPOINT_FAMILY] = dest_family
+    if cached_steps:
+        labels[CHECKPOINT_CACHED] = '_'.join(cached_steps)
+    driver.ex_set_volume_labels(build_volume, labels)
+    print(f'{image_disk}: finished {phase}')
+    return {"phase": phase, "dest_image": dest_image,
+            "dest_family": dest_family, "cached_steps": cached_steps}
+
+def phase_done(checkpoint, phase):
+    return bool(checkpoint) and BUILD_PHASES.index(checkpoint['phase']) >= BUILD_PHASES.index(phase)
+
+def build_node_ready(build_node, image_disk):
+    """Checks that the build instance runs with the image disk attached"""
+
+    if not build_node or build_node.state != 'running':
+        return False
+    disks = build_node.extra.get('disks') or []
+    return any(disk.get('source', '').endswith(f'/disks/{image_disk}') for disk in disks)
+
+
+def create_base_image(driver, build_zone=None, image_disk='halyard-image-disk',
+        zones=None, **kwargs):
+    """Creates a base image in build_zone, see build_base_image.
+       Without a build_zone, a build left by an earlier attempt continues in
+       its zone. Otherwise the placement scheduler picks a zone with build
+       GPUs, within zones if given, and the next candidate is tried when
+       one runs out of capacity."""
+
+    zone = build_zone or placement.disk_zone(driver, image_disk)
+    if zone:
+        candidates = [zone]
+    else:
+        candidates = placement.place(BUILD_CPUS, 2 * BUILD_DISK_GB, BUILD_GPU, 1,
+                                     zones=zones, default=DEFAULT_BUILD_ZONE)
+    if not candidates:
+        utils.fatal_error(f'No zone has {BUILD_GPU} GPUs and quota left for a build.')
+
+    build_instance = kwargs.get('build_instance', 'halyard-build')
+
+    def remove_build(zone):
+        # Nothing was built yet, the next zone starts over
+        for resource, destroy in [
+                (utils.find_instance(driver, build_instance, zone), driver.destroy_node),
+                (utils.find_disk(driver, image_disk, zone), driver.destroy_volume)]:
+            if resource:
+                destroy(resource)
+        cache.invalidate(cache.NODES, cache.VOLUMES)
+
+    zone, result = placement.try_zones(candidates,
+        lambda zone: build_base_image(driver, build_zone=zone,
+                                      image_disk=image_disk, **kwargs),
+        remove_build, BUILD_CPUS, 2 * BUILD_DISK_GB, BUILD_GPU, 1)
+    placement.placed(zone, build_instance, BUILD_CPUS, 2 * BUILD_DISK_GB, BUILD_GPU, 1)
+    result['zone'] = zone
+    return result
+
+def build_base_image(driver,
         source_image_family='debian-10', source_image_project='debian-cloud',
         repository_url='https://github.com/google/android-cuttlefish.git',
         repository_branch='main', build_branch='aosp-master',
         build_target='aosp_cf_x86_phone-userdebug', build_id='',
-        build_instance='halyard-build', build_zone='europe-west4-a', tags=[],
-        dest_image='', dest_family='', image_disk='halyard-image-disk', respin=False):
-    """Creates new base image that holds Cuttlefish packages and Android build artifacts"""
+        build_instance='halyard-build', build_zone=DEFAULT_BUILD_ZONE, tags=[],
+        dest_image='', dest_family='', image_disk='halyard-image-disk', respin=False,
+        resume=True):
+    """Creates new base image that holds Cuttlefish packages and Android build artifacts.
+       Packages and artifacts found in the artifact cache are not built again.
+       With resume, a failed build of the same parameters continues after its
+       last completed phase, on the build instance and image disk it left."""
 
     # SETUP
-    
-    build_node = utils.find_instance(driver, build_instance, build_zone)
-    if build_node:
-        driver.destroy_node(build_node)
-        print('successfully deleted', build_instance)
-
-    build_volume = utils.find_disk(driver, image_disk, build_zone)
-    if build_volume:
-        driver.destroy_volume(build_volume)
-        print('successfully deleted', image_disk)
-
-
-    # BUILD INSTANCE CREATION
-
-    build_volume = driver.create_volume(
-        30, image_disk,
-        location=build_zone,
-        ex_image_family=source_image_family)
-
-    print('built', source_image_family, 'disk')
-
-    gpu_type='nvidia-tesla-p100-vws'
-    gpu = utils.find_gpu(driver, gpu_type, build_zone)
-    if not gpu:
-        utils.fatal_error(f'Please use a zone with {gpu_type} GPUs available')
+    utils.report_progress('setup', 0.0)
 
-    build_node = driver.create_node(
-        build_instance,
-        'n1-standard-16',
-        None,
-        location=build_zone,
-        ex_image_family=source_image_family,
-        ex_accelerator_type=gpu_type,
-        ex_on_host_maintenance='TERMINATE',
-        ex_accelerator_count=1,
-        ex_service_accounts=[{'scopes':['storage-ro']}],
-        ex_disk_size=30,
-        ex_tags=tags)
-    print('successfully created', build_instance)
+    key = build_key(source_image_family, source_image_project, repository_url,
+                    repository_branch, build_branch, build_target, build_id,
+                    dest_image, dest_family)
 
-    utils.wait_for_instance(build_instance, build_zone)
-
-    driver.attach_volume(build_node, build_volume)
-
-    src_files = ['create_base_image_gce.sh', 'download_artifacts.sh']
-    src_files = [PATH + '/' + file for file in src_files]
-    src = ' '.join(list(map(str,src_files)))
-
-    os.system(f'gcloud compute scp {src} {build_instance}: \
-        --zone={build_zone}')
-
-
-    # IMAGE CREATION
-
-    os.system(f'gcloud compute ssh --zone={build_zone} \
-        {build_instance} -- ./create_base_image_gce.sh \
-        {repository_url} {repository_branch} \
-        {build_branch} {build_target} {build_id}')
-
-    dest_names = get_dest_names(
-        build_branch, build_target, build_id,
-        build_instance, build_zone, dest_image, dest_family)
-    
-    dest_image = dest_names['dest_image']
-    dest_family = dest_names['dest_family']
-
-    try:
-        build_image = driver.ex_get_image(dest_image)
-    except:
-        build_image = None
-
-    if build_image:
-        if respin:
-            driver.ex_delete_image(build_image)
-        else:
-            utils.fatal_error(f'''Image {dest_image} already exists.
-            (To replace run with flag --respin)''')
-
-    driver.destroy_node(build_node)
+    build_node = utils.find_instance(driver, build_instance, build_zone)
+    build_volume = utils.find_disk(driver, image_disk, build_zone)
 
-    driver.ex_create_image(
-        dest_image,
-        build_volume,
-        ex_licenses=['https://www.googleapis.com/compute/v1/projects/vm-options/global/licenses/enable-vmx'],
-        family=dest_family
-    )
+    checkpoint = None
+    if resume and build_volume:
+        checkpoint = read_checkpoint(build_volume, key)
+    # Until the image is built its disk is only usable with the same instance
+    if (checkpoint and not phase_done(checkpoint, 'build_image')
+            and not build_node_ready(build_node, image_disk)):
+        checkpoint = None
 
-    print(f'Created image {dest_image} in {dest_family} family')
+    if checkpoint:
+        print(f'resuming build on {image_disk} after {checkpoint["phase"]}')
+    else:
+        if build_node:
+            driver.destroy_node(build_node)
+            print('successfully deleted', build_instance)
+
+        if build_volume:
+            driver.destroy_volume(build_volume)
+            print('successfully deleted', image_disk)
+
+        cache.invalidate(cache.NODES, cache.VOLUMES)
+
+    if not phase_done(checkpoint, 'create_build_instance'):
+        # BUILD INSTANCE CREATION
+        utils.report_progress('create_build_instance', 0.05)
+
+        build_volume = driver.create_volume(
+            BUILD_DISK_GB, image_disk,
+            location=build_zone,
+            ex_image_family=source_image_family)
+
+        print('built', source_image_family, 'disk')
+
+        storage_scope = artifact_cache.store.scope if artifact_cache.store else 'storage-ro'
+
+        gpu = utils.find_gpu(driver, BUILD_GPU, build_zone)
+        if not gpu:
+            utils.fatal_error(f'Please use a zone with {BUILD_GPU} GPUs available')
+
+        build_node = driver.create_node(
+            build_instance,
+            'n1-standard-16',
+            None,
+            location=build_zone,
+            ex_image_family=source_image_family,
+            ex_accelerator_type=BUILD_GPU,
+            ex_on_host_maintenance='TERMINATE',
+            ex_accelerator_count=1,
+            ex_service_accounts=[{'scopes':[storage_scope]}],
+            ex_disk_size=BUILD_DISK_GB,
+            ex_tags=tags)
+        cache.invalidate(cache.NODES, cache.VOLUMES)
+        print('successfully created', build_instance)
+
+        utils.report_progress('wait_for_instance', 0.1)
+        utils.wait_for_instance(driver, build_instance, build_zone)
+
+        driver.attach_volume(build_node, build_volume)
+
+        src_files = ['create_base_image_gce.sh', 'download_artifacts.sh']
+        src_files = [PATH + '/' + file for file in src_files]
+        src = ' '.join(list(map(str,src_files)))
+
+        status = os.system(f'gcloud compute scp {src} {build_instance}: \
+            --zone={build_zone}')
+        if status != 0:
+            utils.fatal_error(f'Could not copy build scripts to {build_instance}')
+
+        checkpoint = save_checkpoint(driver, image_disk, build_zone, key,
+                                     'create_build_instance')
+
+    if not phase_done(checkpoint, 'build_image'):
+        # ARTIFACT CACHE
+        utils.report_progress('artifact_cache', 0.15)
+
+        plan = artifact_cache.plan_build(
+            build_instance, build_zone, repository_url, repository_branch,
+            build_branch, build_target, build_id)
+        build_id = plan['build_id']
+        for step in plan['cached']:
+            print(f'using cached {step}')
+
+        # IMAGE CREATION
+        utils.report_progress('build_image', 0.2)
+
+        # The script skips the steps an earlier attempt on this instance finished
+        status = os.system(f'gcloud compute ssh --zone={build_zone} \
+            {build_instance} -- {artifact_cache.build_env(plan)} ./create_base_image_gce.sh \
+            {repository_url} {repository_branch} \
+            {build_branch} {build_target} {build_id}')
+        if status != 0:
+            utils.fatal_error(f'Image build on {build_instance} failed, '
+                              'run again to resume it')
+
+        if plan['store']:
+            for step in artifact_cache.store_results(plan, build_instance, build_zone):
+                print(f'stored {step} in the artifact cache')
+
+        dest_names = get_dest_names(
+            build_branch, build_target, build_id,
+            build_instance, build_zone, dest_image, dest_family)
+
+        checkpoint = save_checkpoint(driver, image_disk, build_zone, key, 'build_image',
+            dest_names['dest_image'], dest_names['dest_family'], plan['cached'])
+
+    dest_image = checkpoint['dest_image']
+    dest_family = checkpoint['dest_family']
+
+    if not phase_done(checkpoint, 'create_image'):
+        try:
+            build_image = driver.ex_get_image(dest_image)
+        except:
+            build_image = None
+
+        if build_image:
+            if respin:
+                driver.ex_delete_image(build_image)
+                cache.invalidate(cache.IMAGES)
+            else:
+                utils.fatal_error(f'''Image {dest_image} already exists.
+                (To replace run with flag --respin)''')
+
+        build_node = utils.find_instance(driver, build_instance, build_zone)
+        if build_node:
+            driver.destroy_node(build_node)
+
+        utils.report_progress('create_image', 0.9)
+        driver.ex_create_image(
+            dest_image,
+            build_volume,
+            ex_licenses=['https://www.googleapis.com/compute/v1/projects/vm-options/global/licenses/enable-vmx'],
+            family=dest_family
+        )
+
+        print(f'Created image {dest_image} in {dest_family} family')
+
+        checkpoint = save_checkpoint(driver, image_disk, build_zone, key, 'create_image',
+            dest_image, dest_family, checkpoint['cached_steps'])
 
     driver.destroy_volume(build_volume)
-
-    return {"name": dest_image, "family": dest_family}
+    cache.invalidate(cache.IMAGES, cache.NODES, cache.VOLUMES)
+
+    return {"name": dest_image, "family": dest_family,
+            "cached_steps": checkpoint['cached_steps']}
+
+def resource_name(prefix, *parts):
+    """Returns a valid GCE resource name made of prefix and parts"""
+
+    name = '-'.join([prefix] + [re.sub('[^a-z0-9]+', '-', part.lower()) for part in parts])
+    name = name.strip('-')
+    if len(name) > 63:
+        digest = hashlib.sha1(name.encode()).hexdigest()[:8]
+        name = f'{name[:54].rstrip("-")}-{digest}'
+    return name
+
+class GpuSlots:
+    """Hands out build zones so that no region runs more builds than it
+       has free GPUs for"""
+
+    def __init__(self, driver, zones):
+        self.zone_regions = {}
+        self.free = {}
+        self.running = collections.Counter()
+        self.condition = threading.Condition()
+        for zone in zones:
+            if not utils.find_gpu(driver, BUILD_GPU, zone):
+                print(f'{zone} has no {BUILD_GPU} GPUs, skipping it')
+                continue
+            region = placement.region_of(zone)
+            if region not in self.free:
+                try:
+                    quotas = placement.region_quotas(driver, region)
+                except Exception as e:
+                    print(f'Could not read quotas of {region}: {e}')
+                    quotas = {}
+                free = quotas.get(placement.GPU_QUOTAS[BUILD_GPU])
+                self.free[region] = int(free) if free is not None else None
+            if self.free[region] != 0:
+                self.zone_regions[zone] = region
+
+    def available(self, zone):
+        free = self.free[self.zone_regions[zone]]
+        if free is None:
+            return float('inf')
+        return free - self.running[self.zone_regions[zone]]
+
+    def acquire(self):
+        """Blocks until a zone has a free GPU and returns the least busy one"""
+
+        with self.condition:
+            while True:
+                zones = [zone for zone in self.zone_regions if self.available(zone) > 0]
+                if zones:
+                    zone = max(zones, key=lambda z: (self.available(z),
+                                                     -self.running[self.zone_regions[z]]))
+                    self.running[self.zone_regions[zone]] += 1
+                    return zone
+                self.condition.wait()
+
+    def release(self, zone):
+        with self.condition:
+            self.running[self.zone_regions[zone]] -= 1
+            self.condition.notify_all()
+
+
+class BuildTimeline:
+    """Records when each phase of a build started"""
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.phases = []
+
+    def report(self, phase, progress):
+        self.phases.append((phase, time.time()))
+
+    def to_list(self, finished):
+        ends = [started for _, started in self.phases[1:]] + [finished]
+        return [{"phase": phase,
+                 "start": round(started - self.origin, 1),
+                 "duration": round(end - started, 1)}
+                for (phase, started), end in zip(self.phases, ends)]
+
+
+def create_base_image_matrix(driver, builds, zones=['europe-west4-a'], parallelism=4,
+        **kwargs):
+    """Creates base images for many (build_branch, build_target) pairs concurrently.
+       Each build has a build instance and image disk of its own, in one of
+       the zones with GPUs left, and waits while every region runs as many
+       builds as it has free GPUs. A failed build doesn't stop the others."""
+
+    if placement.scheduler:
+        # Only the zones the scheduler knows to have quota left
+        zones = placement.place(BUILD_CPUS, 2 * BUILD_DISK_GB, BUILD_GPU, 1,
+                                zones=zones) or zones
+    slots = GpuSlots(driver, zones)
+    if not slots.zone_regions:
+        utils.fatal_error(f'None of {", ".join(zones)} has {BUILD_GPU} GPUs available')
+
+    origin = time.time()
+
+    # Build instances, disks and zones are chosen by the matrix
+    owned = ('build_instance', 'image_disk', 'build_zone', 'zones')
+
+    def build(params):
+        params = {name: value for name, value in dict(kwargs, **params).items()
+                  if name not in owned}
+        branch, target = params['build_branch'], params['build_target']
+        timeline = BuildTimeline(origin)
+        utils.set_progress_reporter(timeline.report)
+        result = {"build_branch": branch, "build_target": target}
+        zone = None
+        try:
+            utils.report_progress('waiting_for_gpu', 0.0)
+            zone = slots.acquire()
+            result['zone'] = zone
+            image = create_base_image(driver,
+                build_instance=resource_name('halyard-build', branch, target),
+                image_disk=resource_name('halyard-image-disk', branch, target),
+                build_zone=zone, **params)
+            result.update(image)
+        except Exception as e:
+            print(f'Could not build image for {branch} {target}: {e}')
+            result['error'] = str(e) or e.__class__.__name__
+        finally:
+            if zone:
+                slots.release(zone)
+            utils.set_progress_reporter(None)
+            result['timeline'] = timeline.to_list(time.time())
+        return result
+
+    with ThreadPoolExecutor(max_workers=parallelism,
+                            thread_name_prefix='halyard-image-build') as executor:
+        futures = [executor.submit(build, params) for params in builds]
+        for done, _ in enumerate(as_completed(futures), 1):
+            utils.report_progress('building', done / len(futures))
+    results = [future.result() for future in futures]
+
+    failed = sum(1 for result in results if 'error' in result)
+    return {"images": results,
+            "succeeded": len(results) - failed,
+            "failed": failed}
@@ -1,39 +1,140 @@
-import os, sys
+import os, re, sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import collections
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import halyard_utils as utils
-
-def list_nodes(driver):
-    nodes = driver.list_nodes()
-    node_list = []
-    for node in nodes:
-        node_list.append({"name": node.name,
-                          "creationTimestamp": node.extra['creationTimestamp'],
-                          "image": node.extra['image'],
-                          "public_ips": node.public_ips})
-    halyard_nodes = list(filter(lambda x: x['name'].startswith('halyard'), node_list))
-    return halyard_nodes
-
-def get_node(driver, instance_name, zone):
-    node = utils.find_instance(driver, instance_name, zone)
-    if node:
-        return {"name": node.name,
-                "creationTimestamp": node.extra['creationTimestamp'],
-                "image": node.extra['image'],
-                "public_ips": node.public_ips}
+import inventory_cache as cache
+import placement
+import remote_exec
+import state_store
+import zone_index
+from step_graph import StepGraph
+
+BOOT_DISK_CHUNK = 50 # disk names looked up per request
+
+HOST_CPUS = 4 # n1-standard-4
+HOST_DISK_GB = 30
+
+CUTTLEFISH_DIR = '/usr/local/share/cuttlefish'
+USER_DATA_DIR = '/mnt/user_data'
+
+# With the startup_script launch mode the user disk is attached by the
+# create call and the guest mounts it and launches Cuttlefish while booting
+LAUNCH_MODES = ('ssh', 'startup_script')
+USER_DATA_DEVICE = 'user-data'
+CVD_USER = 'halyard'
+LAUNCH_ATTRIBUTE = 'halyard/launch'
+
+def list_nodes(driver, prefix='halyard', zone=None, limit=None, page_token=None):
+    """Yields pages of instances whose name starts with prefix."""
+
+    if state_store.store:
+        return utils.iter_pages(lambda max_results, page_token: state_store.store.instances(
+            prefix, zone, max_results, page_token), limit, page_token)
+
+    filter_expr = utils.gce_filter(name=utils.prefix_pattern(prefix))
+
+    def fetch_page(max_results, page_token):
+        items, next_page_token = utils.list_page(
+            driver, 'instances', filter_expr, zone, max_results, page_token)
+        boot_images = get_boot_images(driver, items, zone)
+        nodes = [{"name": item['name'],
+                  "creationTimestamp": item.get('creationTimestamp'),
+                  "image": boot_images.get(item['name']),
+                  "public_ips": utils.get_public_ips(item)} for item in items
+                 if not is_idle_warm_host(item)]
+        return nodes, next_page_token
+
+    def cached_page(max_results, page_token):
+        return cache.get(cache.NODES,
+            lambda: fetch_page(max_results, page_token),
+            prefix, zone, max_results, page_token)
+
+    return utils.iter_pages(cached_page, limit, page_token)
+
+def is_idle_warm_host(instance):
+    return instance.get('labels', {}).get(utils.STATE_LABEL) == 'idle'
+
+def get_boot_images(driver, instances, zone):
+    """Maps instance names to the image their boot disk was created from"""
+
+    boot_disks = {} # disk url -> instance name
+    for instance in instances:
+        for disk in instance.get('disks', []):
+            if disk.get('boot'):
+                boot_disks[disk['source']] = instance['name']
+
+    disk_names = [url.rsplit('/', 1)[-1] for url in boot_disks]
+    boot_images = {}
+    for i in range(0, len(disk_names), BOOT_DISK_CHUNK):
+        names = '|'.join(re.escape(name)
+                         for name in disk_names[i:i + BOOT_DISK_CHUNK])
+        disks, _ = utils.list_page(
+            driver, 'disks', utils.gce_filter(name=f'({names})'), zone)
+        for disk in disks:
+            instance_name = boot_disks.get(disk.get('selfLink'))
+            if instance_name and disk.get('sourceImage'):
+                boot_images[instance_name] = disk['sourceImage'].rsplit('/', 1)[-1]
+    return boot_images
+
+def get_node(driver, instance_name, zone=None):
+    """Describes an instance, from the state store when it has the instance,
+       otherwise looked up in every configured zone without zone"""
+
+    stored = state_store.store.instance(instance_name) if state_store.store else None
+    if stored and (not zone or stored['zone'] == zone):
+        zone = stored.pop('zone')
+        startup_script = stored.pop('startup_script')
+        result = stored
     else:
-        return {}
+        node, zone = zone_index.find_instance(driver, instance_name, zone)
+        if not node:
+            return {}
+        items = (node.extra.get('metadata') or {}).get('items', [])
+        startup_script = any(item.get('key') == 'startup-script' for item in items)
+        result = {"name": node.name,
+                  "creationTimestamp": node.extra['creationTimestamp'],
+                  "image": node.extra['image'],
+                  "public_ips": node.public_ips}
+    # Only instances launched by a startup script report their launch
+    if startup_script:
+        result['launch_status'] = get_launch_status(driver, instance_name, zone)
+    return result
+
+def get_launch_status(driver, instance_name, zone):
+    """Returns what the startup script of an instance reported about
+       launching Cuttlefish"""
 
-def delete_node(driver, instance_name, zone):
-    node = utils.find_instance(driver, instance_name, zone)
+    try:
+        response = driver.connection.request(
+            f'/zones/{zone}/instances/{instance_name}/getGuestAttributes',
+            params={'queryPath': LAUNCH_ATTRIBUTE}).object
+    except Exception:
+        # Nothing was reported yet
+        return 'booting'
+    values = response.get('queryValue', {}).get('items', [])
+    return values[0]['value'] if values else 'booting'
+
+def delete_node(driver, instance_name, zone=None):
+    node, zone = zone_index.find_instance(driver, instance_name, zone)
     if node:
         driver.destroy_node(node)
+        zone_index.forget(zone_index.INSTANCES, instance_name)
+        state_store.delete(state_store.INSTANCES, instance_name)
+        remote_exec.close(instance_name, zone)
+        cache.invalidate(cache.NODES, cache.VOLUMES)
         return {"stopped_instance": instance_name}
     else:
         return {"error": f"instance {instance_name} not found"}
 
 
 def get_base_image_from_labels(user_disk):
-    """Gets original base image from GCP disk labels"""
+    """Gets original base image from GCP disk labels.
+       The disk was just fetched to be attached, so its own labels are
+       fresher than the state store's copy and cost no extra call."""
 
     labels = ['cf_version', 'branch', 'target', 'build_id']
     disk_labels = user_disk.extra['labels']
@@ -60,94 +161,300 @@ def set_base_image_labels(driver, user_disk, img_name, branch, target):
     driver.ex_set_volume_labels(user_disk,
         {'cf_version': cf_version, 'branch': branch,
          'target': target, 'build_id': build_id})
+    cache.invalidate(cache.VOLUMES)
 
 
+def create_user_node(driver, instance_name, image, zone, tags, user_disk=None,
+                     metadata=None):
+    """Creates a Cuttlefish host from image.
+       When user_disk is given it is attached by the create call itself."""
+
+    if not user_disk:
+        return driver.create_node(
+            instance_name,
+            'n1-standard-4',
+            image.name,
+            location=zone,
+            ex_service_accounts=[{'scopes': ['storage-ro']}],
+            ex_disk_size=30,
+            ex_tags=tags)
+
+    disks = [{'boot': True,
+              'autoDelete': True,
+              'type': 'PERSISTENT',
+              'mode': 'READ_WRITE',
+              'deviceName': instance_name,
+              'initializeParams': {'diskName': instance_name,
+                                   'diskSizeGb': 30,
+                                   'sourceImage': image.extra['selfLink']}},
+             {'boot': False,
+              'autoDelete': False,
+              'type': 'PERSISTENT',
+              'mode': 'READ_WRITE',
+              'deviceName': USER_DATA_DEVICE,
+              'source': user_disk.extra['selfLink']}]
+    return driver.create_node(
+        instance_name,
+        'n1-standard-4',
+        None,
+        location=zone,
+        ex_disks_gce_struct=disks,
+        ex_metadata=metadata,
+        ex_service_accounts=[{'scopes': ['storage-ro']}],
+        ex_tags=tags)
+
 def create_or_restore_instance(driver,
+        user_id, sig_server_addr, sig_server_port, zone=None, zones=None, **kwargs):
+    """Creates or restores the instance of a user in zone.
+       Without a zone, users with a disk are restored in the disk's zone
+       and new users are placed by the placement scheduler, within zones
+       if given. The next candidate zone is tried when one runs out of
+       capacity."""
+
+    disk_name = f'{utils.USER_DISK_PREFIX}{user_id}'
+    disk_zone = zone or placement.disk_zone(driver, disk_name)
+    if disk_zone:
+        candidates = [disk_zone]
+    else:
+        candidates = placement.place(HOST_CPUS, 2 * HOST_DISK_GB, zones=zones)
+    if not candidates:
+        utils.fatal_error('No zone has quota left for a new instance.')
+
+    def remove_user_disk(zone):
+        # A new user gets a new disk in the next zone
+        user_disk = utils.find_disk(driver, disk_name, zone)
+        if user_disk:
+            driver.destroy_volume(user_disk)
+            cache.invalidate(cache.VOLUMES)
+
+    zone, result = placement.try_zones(candidates,
+        lambda zone: create_or_restore_in_zone(driver, user_id,
+            sig_server_addr, sig_server_port, zone, **kwargs),
+        remove_user_disk, HOST_CPUS, 2 * HOST_DISK_GB,
+        # An idle warm host beats any zone ranking
+        preferred=warm_pool.zone if warm_pool else None)
+    placement.placed(zone, result['name'], HOST_CPUS, 2 * HOST_DISK_GB)
+    result['zone'] = zone
+    return result
+
+def create_or_restore_in_zone(driver,
         user_id, sig_server_addr, sig_server_port, zone='us-central1-b',
-        tags=[], branch='aosp-master', target='aosp_cf_x86_phone-userdebug'):
+        tags=[], branch='aosp-master', target='aosp_cf_x86_phone-userdebug',
+        launch_mode='ssh'):
     """Restores instance with existing user disk and original base image.
        Creates a new instance with latest image if user disk doesn't exist.
        Stores runtime data in external GCP disk.
-       Launches Cuttlefish if creation is successful."""
+       Launches Cuttlefish if creation is successful, over SSH or, with the
+       startup_script launch mode, from a startup script of the instance."""
 
     # SETUP
+    utils.report_progress('setup', 0.0)
+    if launch_mode not in LAUNCH_MODES:
+        utils.fatal_error(f'launch_mode must be one of {", ".join(LAUNCH_MODES)}')
     target = target.replace('_','-')
     instance_name = f'halyard-{user_id}'
     disk_name = f'halyard-user-{user_id}'
     image_family = f'halyard-{branch}-{target}'
 
-    # Stops execution if instance already exists
-    instance = utils.find_instance(driver, instance_name, zone)
-    if instance:
-        utils.fatal_error(f'Instance {instance_name} already exists.')
-
-    # Looks for existing user disk
-    user_disk = utils.find_disk(driver, disk_name, zone)
-    if user_disk:
-        base_image = get_base_image_from_labels(user_disk)
-    else:
-        user_disk = driver.create_volume(
-            30, disk_name, location=zone, image='blank-halyard')
-        base_image = None
+    # Steps run as soon as the ones they depend on are done, so lookups,
+    # disk creation, image resolution and labeling overlap
+    graph = StepGraph()
 
+    # Stops execution if instance already exists
+    def check_instance():
+        if utils.find_instance(driver, instance_name, zone):
+            utils.fatal_error(f'Instance {instance_name} already exists.')
 
-    # CREATE INSTANCE
+    def check_claimed_host():
+        claimed_host = find_claimed_host(driver, user_id, zone)
+        if claimed_host:
+            utils.fatal_error(f'Instance {claimed_host} already exists for {user_id}.')
 
-    # If existing user, use original base image
-    if base_image:
+    # Resolved before knowing whether the user needs it, it's a single call
+    def resolve_family():
         try:
-            driver.ex_get_image(base_image)
+            return driver.ex_get_image_from_family(image_family)
         except:
-            utils.fatal_error(f'Image {base_image} does not exist.')
+            return None
 
-        new_instance = driver.create_node(
-            instance_name,
-            'n1-standard-4',
-            base_image,
-            location=zone,
-            ex_service_accounts=[{'scopes': ['storage-ro']}],
-            ex_disk_size=30,
-            ex_tags=tags)
-
-    # If new user, use image family
-    else:
-        try:
-            img = driver.ex_get_image_from_family(image_family)
-        except:
+    # Looks for existing user disk
+    def prepare_user_disk(user_disk, *checks):
+        if user_disk:
+            return user_disk, get_base_image_from_labels(user_disk)
+        user_disk = driver.create_volume(
+            30, disk_name, location=zone, image='blank-halyard')
+        cache.invalidate(cache.VOLUMES)
+        zone_index.remember(zone_index.DISKS, disk_name, zone)
+        return user_disk, None
+
+    # Takes an already booted host when one matches the base image
+    def claim_warm_host(disk):
+        _, base_image = disk
+        if warm_pool and warm_pool.zone == zone:
+            return warm_pool.claim(image_family, user_id, base_image, tags)
+        return None, None
+
+    # Claimed hosts already run their image
+    def resolve_image(disk, claim, family_image):
+        _, base_image = disk
+        host, _ = claim
+        if host:
+            return None
+        # If existing user, use original base image
+        if base_image:
+            try:
+                return driver.ex_get_image(base_image)
+            except:
+                utils.fatal_error(f'Image {base_image} does not exist.')
+        # If new user, use image family
+        if not family_image:
             utils.fatal_error(f'Image in family {image_family} does not exist.')
-
-        set_base_image_labels(driver, user_disk, img.name, branch, target)
-
-        new_instance = driver.create_node(
-            instance_name,
-            'n1-standard-4',
-            None,
-            location=zone,
-            ex_image_family=image_family,
-            ex_service_accounts=[{'scopes': ['storage-ro']}],
-            ex_disk_size=30,
-            ex_tags=tags)
-
-
-    # ATTACH USER DISK AND LAUNCH
-
-    utils.wait_for_instance(instance_name, zone)
-    print('successfully created new instance', instance_name)
-
-    driver.attach_volume(new_instance, user_disk)
-    print(f'attached {disk_name} to {instance_name}')
-
-    os.system(f'gcloud compute ssh --zone={zone} {instance_name} -- \
-        sudo mkdir /mnt/user_data')
-    os.system(f'gcloud compute ssh --zone={zone} {instance_name} -- \
-        sudo mount /dev/sdb /mnt/user_data')
-    os.system(f'gcloud compute ssh --zone={zone} {instance_name} -- \
-        sudo chmod -R 777 /mnt/user_data')
-    # FIXME : should assign specific user permissions
-
-    launch_cvd(instance_name, zone, sig_server_addr, sig_server_port)
-
-    return {"name": instance_name}
+        return family_image
+
+    def label_user_disk(disk, claim, img):
+        user_disk, base_image = disk
+        _, img_name = claim
+        if not base_image:
+            set_base_image_labels(driver, user_disk, img_name or img.name, branch, target)
+
+    def create_node(disk, claim, img):
+        user_disk, _ = disk
+        host, _ = claim
+        if host:
+            print(f'claimed warm host {host.name} for {user_id}')
+            return host
+        # Boot, mount and launch overlap in the guest, nothing waits on SSH
+        if launch_mode == 'startup_script':
+            metadata = {'startup-script': startup_script(
+                            instance_name, sig_server_addr, sig_server_port),
+                        'enable-guest-attributes': 'TRUE'}
+            node = create_user_node(driver, instance_name, img, zone, tags,
+                                    user_disk, metadata)
+        else:
+            node = create_user_node(driver, instance_name, img, zone, tags)
+        cache.invalidate(cache.NODES, cache.VOLUMES)
+        zone_index.remember(zone_index.INSTANCES, instance_name, zone)
+        return node
+
+    graph.add('check_instance', check_instance)
+    graph.add('check_claimed_host', check_claimed_host)
+    graph.add('find_disk', lambda: zone_index.find_disk(driver, disk_name, zone)[0])
+    graph.add('resolve_family', resolve_family)
+    graph.add('prepare_user_disk', prepare_user_disk,
+              after=['find_disk', 'check_instance', 'check_claimed_host'])
+    graph.add('claim_warm_host', claim_warm_host, after=['prepare_user_disk'])
+    graph.add('resolve_image', resolve_image,
+              after=['prepare_user_disk', 'claim_warm_host', 'resolve_family'])
+    graph.add('label_user_disk', label_user_disk,
+              after=['prepare_user_disk', 'claim_warm_host', 'resolve_image'])
+    graph.add('create_node', create_node,
+              after=['prepare_user_disk', 'claim_warm_host', 'resolve_image'])
+
+    def report(last_step, **result):
+        graph.result('label_user_disk')
+        result['timings'] = graph.timings()
+        result['critical_path'] = graph.critical_path(last_step)
+        return result
+
+    # Steps still running when one fails may use the user disk, which the
+    # capacity fallback destroys once this returns
+    try:
+        # CREATE INSTANCE
+        utils.report_progress('create_instance', 0.1)
+        new_instance = graph.result('create_node')
+        instance_name = new_instance.name
+
+        if launch_mode == 'startup_script' and not graph.result('claim_warm_host')[0]:
+            print(f'created {instance_name} with {disk_name}, launching from its startup script')
+            return report('create_node', name=instance_name, launch_mode=launch_mode)
+
+
+        # ATTACH USER DISK AND LAUNCH
+        utils.report_progress('wait_for_instance', 0.3)
+
+        # The disk is attached while the instance boots.
+        # Returns after a single probe for warm hosts.
+        graph.add('wait_for_instance',
+                  lambda node: utils.wait_for_instance(driver, node.name, zone),
+                  after=['create_node'])
+        graph.add('attach_disk',
+                  lambda node, disk: driver.attach_volume(node, disk[0]),
+                  after=['create_node', 'prepare_user_disk'])
+        graph.result('wait_for_instance')
+        print('successfully created new instance', instance_name)
+
+        utils.report_progress('attach_disk', 0.7)
+        graph.result('attach_disk')
+        print(f'attached {disk_name} to {instance_name}')
+
+        def mount_user_disk(*ready):
+            mount_results = remote_exec.run_batch(instance_name, zone, [
+                f'sudo mkdir -p {USER_DATA_DIR}',
+                f'sudo mount /dev/sdb {USER_DATA_DIR}',
+                f'sudo chmod -R 777 {USER_DATA_DIR}'])
+            # FIXME : should assign specific user permissions
+            for result in mount_results:
+                if result.exit_code != 0:
+                    utils.fatal_error(f'`{result.command}` failed on {instance_name}: \
+                        {result.stderr}')
+
+        graph.add('mount_user_disk', mount_user_disk,
+                  after=['wait_for_instance', 'attach_disk'])
+        graph.add('launch_cvd', lambda *ready: launch_cvd(
+                      instance_name, zone, sig_server_addr, sig_server_port),
+                  after=['mount_user_disk'])
+        graph.result('mount_user_disk')
+
+        utils.report_progress('launch_cvd', 0.9)
+        graph.result('launch_cvd')
+
+        return report('launch_cvd', name=instance_name, launch_mode='ssh')
+    finally:
+        graph.close()
+
+def create_instance_batch(driver, user_ids, sig_server_addr, sig_server_port,
+        zones=['us-central1-b'], parallelism=8, **kwargs):
+    """Creates or restores instances for many users concurrently.
+       Users with an existing disk are restored in its zone, new users are
+       spread across zones, by the placement scheduler when there is one.
+       A failed user doesn't stop the others."""
+
+    disk_zones = {disk['name']: disk['zone'].rsplit('/', 1)[-1]
+                  for disk in utils.list_by_prefix(
+                      driver, 'disks', utils.USER_DISK_PREFIX, 'all')}
+    zone_index.remember_all(zone_index.DISKS, disk_zones)
+
+    zone_load = collections.Counter({zone: 0 for zone in zones})
+    placements = []
+    for user_id in user_ids:
+        zone = disk_zones.get(f'{utils.USER_DISK_PREFIX}{user_id}')
+        if not zone and not placement.scheduler:
+            zone = min(zones, key=lambda z: zone_load[z])
+            zone_load[zone] += 1
+        placements.append((user_id, zone))
+
+    def provision(user_id, zone):
+        try:
+            instance = create_or_restore_instance(driver, user_id,
+                sig_server_addr, sig_server_port, zone=zone, zones=zones, **kwargs)
+            return {"user_id": user_id, "zone": instance.get('zone', zone),
+                    "name": instance['name']}
+        except Exception as e:
+            print(f'Could not provision instance for {user_id}: {e}')
+            return {"user_id": user_id, "zone": zone, "error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=parallelism,
+                            thread_name_prefix='halyard-batch') as executor:
+        futures = [executor.submit(provision, user_id, zone)
+                   for user_id, zone in placements]
+        for done, _ in enumerate(as_completed(futures), 1):
+            utils.report_progress('provisioning', done / len(futures))
+    results = [future.result() for future in futures]
+
+    failed = sum(1 for result in results if 'error' in result)
+    return {"instances": results,
+            "succeeded": len(results) - failed,
+            "failed": failed}
 
 def create_instance(driver,
         user_id, sig_server_addr, sig_server_port, zone='us-central1-b',
@@ -180,7 +487,10 @@ def create_instance(driver,
         ex_disk_size=30,
         ex_tags=tags)
 
-    utils.wait_for_instance(instance_name, zone)
+    cache.invalidate(cache.NODES, cache.VOLUMES)
+    zone_index.remember(zone_index.INSTANCES, instance_name, zone)
+
+    utils.wait_for_instance(driver, instance_name, zone)
 
     print('successfully created new instance', instance_name)
 
@@ -188,30 +498,248 @@ def create_instance(driver,
 
     return {"name": instance_name}
 
-def launch_cvd(instance_name, zone, sig_server_addr, sig_server_port, use_user_disk=True):
-    """Launch cvd on given instance and connect to operator on given address.
-       If use_user_disk is True it uses existing user data disk."""
-
-    cuttlefish_dir = '/usr/local/share/cuttlefish'
-    user_data_dir = '/mnt/user_data'
-
-    launch_command = f'gcloud compute ssh --zone={zone} {instance_name} -- '
+def launch_cvd_command(instance_name, sig_server_addr, sig_server_port, use_user_disk=True):
+    """Shell command launching cvd and connecting it to the operator"""
 
     if use_user_disk:
-        launch_command += f'HOME={user_data_dir} \
-            ANDROID_HOST_OUT={cuttlefish_dir} \
-            ANDROID_PRODUCT_OUT={cuttlefish_dir} '
+        launch_command = f'HOME={USER_DATA_DIR} \
+            ANDROID_HOST_OUT={CUTTLEFISH_DIR} \
+            ANDROID_PRODUCT_OUT={CUTTLEFISH_DIR} '
     else:
-        launch_command += f'HOME={cuttlefish_dir} '
+        launch_command = f'HOME={CUTTLEFISH_DIR} '
 
-    launch_command += f'{cuttlefish_dir}/bin/launch_cvd \
+    launch_command += f'{CUTTLEFISH_DIR}/bin/launch_cvd \
         --start_webrtc --daemon \
         --webrtc_sig_server_addr={sig_server_addr} \
         --webrtc_sig_server_port={sig_server_port} \
         --start_webrtc_sig_server=false \
         --webrtc_device_id={instance_name} \
         --report_anonymous_usage_stats=y'
+    return launch_command
+
+def startup_script(instance_name, sig_server_addr, sig_server_port):
+    """Boot script mounting the user disk and launching cvd as CVD_USER.
+       Its outcome is reported in the LAUNCH_ATTRIBUTE guest attribute."""
+
+    launch_command = ' '.join(launch_cvd_command(
+        instance_name, sig_server_addr, sig_server_port).split())
+    return f'''#!/bin/bash
+set -o errexit
+
+report() {{
+  curl -s -X PUT --data "$1" -H 'Metadata-Flavor: Google' \\
+    http://metadata.google.internal/computeMetadata/v1/instance/guest-attributes/{LAUNCH_ATTRIBUTE}
+}}
+trap 'report failed' ERR
+report launching
+
+mkdir -p {USER_DATA_DIR}
+if ! mountpoint -q {USER_DATA_DIR}; then
+  mount /dev/disk/by-id/google-{USER_DATA_DEVICE} {USER_DATA_DIR}
+fi
+chmod -R 777 {USER_DATA_DIR}
+
+if ! id {CVD_USER} > /dev/null 2>&1; then
+  useradd -m {CVD_USER}
+  for group in kvm cvdnetwork render; do
+    if getent group $group > /dev/null; then
+      usermod -aG $group {CVD_USER}
+    fi
+  done
+fi
+
+runuser -u {CVD_USER} -- env {launch_command}
+report launched
+'''
 
-    os.system(launch_command)
+def launch_cvd(instance_name, zone, sig_server_addr, sig_server_port, use_user_disk=True):
+    """Launch cvd on given instance and connect to operator on given address.
+       If use_user_disk is True it uses existing user data disk."""
+
+    launch_command = launch_cvd_command(
+        instance_name, sig_server_addr, sig_server_port, use_user_disk)
+    result = remote_exec.run(instance_name, zone, launch_command)
+    if result.exit_code != 0:
+        utils.fatal_error(f'launch_cvd failed on {instance_name}: {result.stderr}')
 
     print(f'Launched cuttlefish on {instance_name} at {sig_server_addr}:{sig_server_port}')
+
+
+def find_claimed_host(driver, user_id, zone):
+    """Returns name of the warm pool host claimed by user_id, if any"""
+
+    filter_expr = utils.gce_filter(**{f'labels.{utils.USER_LABEL}': re.escape(user_id)})
+    instances, _ = utils.list_page(driver, 'instances', filter_expr, zone)
+    return instances[0]['name'] if instances else None
+
+
+# WARM POOL
+
+WARM_PREFIX = 'halyard-warm-'
+
+warm_pool = None
+
+class WarmPool:
+    """Keeps idle, already booted hosts per image family.
+       New users claim one and only wait for their disk to be attached,
+       while the pool refills itself in the background."""
+
+    def __init__(self, driver, zone, max_size=10,
+                 refill_interval=60, demand_window=900):
+        self.driver = driver
+        self.zone = zone
+        self.max_size = max_size
+        self.refill_interval = refill_interval
+        self.demand_window = demand_window
+        self.sizes = {} # family -> configured number of idle hosts
+        self.idle = {} # family -> list of (node, image name)
+        self.booting = collections.Counter() # family -> hosts being booted
+        self.claims = collections.deque() # (time, family) of recent claims
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=4,
+                                            thread_name_prefix='halyard-warm')
+
+    def set_size(self, branch, target, size):
+        family = f'halyard-{branch}-{target.replace("_", "-")}'
+        with self._lock:
+            self.sizes[family] = int(size)
+        self._wake.set()
+
+    def target_size(self, family):
+        """Configured size, raised to the number of recent claims"""
+
+        with self._lock:
+            cutoff = time.monotonic() - self.demand_window
+            while self.claims and self.claims[0][0] < cutoff:
+                self.claims.popleft()
+            demand = sum(1 for _, f in self.claims if f == family)
+            return min(max(self.sizes.get(family, 0), demand), self.max_size)
+
+    def claim(self, family, user_id, image_name=None, tags=[]):
+        """Takes an idle host of family, booted from image_name if given.
+           Returns the node and its image, or (None, None) on a miss."""
+
+        node, node_image = None, None
+        with self._lock:
+            self.claims.append((time.monotonic(), family))
+            hosts = self.idle.get(family, [])
+            for i, (host, host_image) in enumerate(hosts):
+                if not image_name or host_image == image_name:
+                    node, node_image = hosts.pop(i)
+                    break
+        self._wake.set()
+
+        if node:
+            self.driver.ex_set_node_labels(node, {
+                utils.POOL_LABEL: family,
+                utils.STATE_LABEL: 'claimed',
+                utils.USER_LABEL: user_id})
+            if tags:
+                self.driver.ex_set_node_tags(node, tags)
+            cache.invalidate(cache.NODES)
+        return node, node_image
+
+    def start(self):
+        self.discover()
+        threading.Thread(target=self._run, name='warm-pool', daemon=True).start()
+
+    def discover(self):
+        """Adopts idle hosts left by a previous run of the server"""
+
+        filter_expr = utils.gce_filter(**{f'labels.{utils.STATE_LABEL}': 'idle'})
+        pages = utils.iter_pages(lambda max_results, page_token: utils.list_page(
+            self.driver, 'instances', filter_expr, self.zone, max_results, page_token))
+        for items, _ in pages:
+            boot_images = get_boot_images(self.driver, items, self.zone)
+            for item in items:
+                family = item['labels'].get(utils.POOL_LABEL)
+                node = utils.find_instance(self.driver, item['name'], self.zone)
+                if family and node and item['name'] in boot_images:
+                    with self._lock:
+                        self.idle.setdefault(family, []).append(
+                            (node, boot_images[item['name']]))
+
+    def _run(self):
+        while True:
+            try:
+                self.refill()
+            except Exception as e:
+                print(f'Warm pool refill failed: {e}')
+            self._wake.wait(self.refill_interval)
+            self._wake.clear()
+
+    def refill(self):
+        """Recycles hosts of outdated images and boots missing ones"""
+
+        with self._lock:
+            families = set(self.sizes) | set(self.idle) | {f for _, f in self.claims}
+
+        for family in families:
+            try:
+                latest = self.driver.ex_get_image_from_family(family).name
+            except Exception:
+                continue
+            self.recycle(family, latest)
+
+            target_size = self.target_size(family)
+            with self._lock:
+                missing = target_size - len(self.idle.get(family, [])) \
+                    - self.booting[family]
+                if missing > 0:
+                    self.booting[family] += missing
+            for _ in range(missing):
+                self._executor.submit(self._boot_host, family, latest)
+
+    def recycle(self, family, latest_image):
+        with self._lock:
+            hosts = self.idle.get(family, [])
+            stale = [host for host in hosts if host[1] != latest_image]
+            self.idle[family] = [host for host in hosts if host[1] == latest_image]
+
+        for node, image_name in stale:
+            self.driver.destroy_node(node)
+            print(f'recycled warm host {node.name} running {image_name}')
+        if stale:
+            cache.invalidate(cache.NODES, cache.VOLUMES)
+
+    def _boot_host(self, family, image_name):
+        instance_name = f'{WARM_PREFIX}{uuid.uuid4().hex[:8]}'
+        try:
+            node = self.driver.create_node(
+                instance_name,
+                'n1-standard-4',
+                image_name,
+                location=self.zone,
+                ex_service_accounts=[{'scopes': ['storage-ro']}],
+                ex_disk_size=30,
+                ex_labels={utils.POOL_LABEL: family, utils.STATE_LABEL: 'idle'})
+            cache.invalidate(cache.NODES, cache.VOLUMES)
+            utils.wait_for_instance(self.driver, instance_name, self.zone)
+            with self._lock:
+                self.idle.setdefault(family, []).append((node, image_name))
+            print(f'warm host {instance_name} ready with {image_name}')
+        except Exception as e:
+            print(f'Could not boot warm host {instance_name}: {e}')
+        finally:
+            with self._lock:
+                self.booting[family] -= 1
+
+    def stats(self):
+        with self._lock:
+            families = set(self.sizes) | set(self.idle)
+            return {family: {"idle": len(self.idle.get(family, [])),
+                             "booting": self.booting[family],
+                             "configured": self.sizes.get(family, 0)}
+                    for family in families}
+
+def start_warm_pool(driver, zone, pool_spec, max_size=10):
+    """Starts the warm pool from a 'branch:target:size,...' spec"""
+
+    global warm_pool
+    warm_pool = WarmPool(driver, zone, max_size=int(max_size))
+    for entry in filter(None, pool_spec.split(',')):
+        branch, target, size = entry.split(':')
+        warm_pool.set_size(branch, target, size)
+    warm_pool.start()
+    return warm_pool
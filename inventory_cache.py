@@ -0,0 +1,92 @@
+import threading
+import time
+
+# Resource kinds held in the cache
+NODES = 'nodes'
+IMAGES = 'images'
+VOLUMES = 'volumes'
+
+ttl = 30 # seconds a listing is served before going back to GCE
+
+_entries = {} # (kind, *key) -> (fetch_time, value)
+_generations = {} # kind -> number of invalidations so far
+_fetch_locks = {} # (kind, *key) -> lock held while fetching
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_listeners = [] # called with the kinds of every invalidation
+
+def configure(new_ttl):
+    global ttl
+    ttl = float(new_ttl)
+
+def get(kind, fetch, *key):
+    """Returns cached listing for kind and key, calling fetch on a miss.
+       Concurrent misses on the same key share a single fetch."""
+
+    entry_key = (kind,) + key
+    with _lock:
+        entry = _entries.get(entry_key)
+        if entry and time.monotonic() - entry[0] < ttl:
+            _stats['hits'] += 1
+            return entry[1]
+        fetch_lock = _fetch_locks.setdefault(entry_key, threading.Lock())
+
+    with fetch_lock:
+        # Another thread may have filled the entry while we waited
+        with _lock:
+            entry = _entries.get(entry_key)
+            if entry and time.monotonic() - entry[0] < ttl:
+                _stats['hits'] += 1
+                return entry[1]
+            _stats['misses'] += 1
+            generation = _generations.get(kind, 0)
+
+        fetch_time = time.monotonic()
+        try:
+            value = fetch()
+        finally:
+            # Threads already waiting hold the lock object and find the
+            # entry filled, later misses create a new one
+            with _lock:
+                _fetch_locks.pop(entry_key, None)
+
+        with _lock:
+            # Drop results that raced with a write to the same kind
+            if _generations.get(kind, 0) == generation:
+                _evict_expired()
+                _entries[entry_key] = (fetch_time, value)
+        return value
+
+def _evict_expired():
+    """Drops expired entries, every prefix, zone and page token gets one"""
+
+    now = time.monotonic()
+    for entry_key in [k for k, (fetch_time, _) in _entries.items()
+                      if now - fetch_time >= ttl]:
+        del _entries[entry_key]
+
+def invalidate(*kinds):
+    """Drops every cached listing of the given kinds"""
+
+    with _lock:
+        for kind in kinds:
+            _generations[kind] = _generations.get(kind, 0) + 1
+            for entry_key in [k for k in _entries if k[0] == kind]:
+                del _entries[entry_key]
+        _stats['invalidations'] += 1
+    for listener in _listeners:
+        listener(kinds)
+
+def on_invalidate(listener):
+    """Registers listener(kinds), called after every invalidation"""
+    _listeners.append(listener)
+
+def stats():
+    with _lock:
+        total = _stats['hits'] + _stats['misses']
+        return {"ttl": ttl,
+                "entries": len(_entries),
+                "hits": _stats['hits'],
+                "misses": _stats['misses'],
+                "invalidations": _stats['invalidations'],
+                "hit_rate": _stats['hits'] / total if total else 0.0}
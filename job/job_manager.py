@@ -0,0 +1,112 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import halyard_utils as utils
+
+JOB_RETENTION = 3600 # seconds a finished job stays queryable
+
+_jobs = {} # A dictionary of id to jobs
+_lock = threading.Lock()
+_executor = None
+_max_workers = 4
+_max_pending = 16
+
+def configure_pool(max_workers, max_pending):
+    """Sets worker pool size and how many jobs may wait or run at once"""
+
+    global _executor, _max_workers, _max_pending
+    with _lock:
+        _max_workers = int(max_workers)
+        _max_pending = int(max_pending)
+        if _executor:
+            _executor.shutdown(wait=False)
+        _executor = ThreadPoolExecutor(max_workers=_max_workers,
+                                       thread_name_prefix='halyard-job')
+
+
+class Job:
+    """Long running operation executed by the worker pool"""
+
+    def __init__(self, kind):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = 'queued'
+        self.phase = 'queued'
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def report(self, phase, progress):
+        self.phase = phase
+        self.progress = progress
+
+    def run(self, func, args, kwargs):
+        self.status = 'running'
+        self.started = time.time()
+        utils.set_progress_reporter(self.report)
+        try:
+            self.result = func(*args, **kwargs)
+            self.status = 'succeeded'
+            self.report('done', 1.0)
+        except BaseException as e:
+            self.status = 'failed'
+            self.error = str(e) or e.__class__.__name__
+            print(f'Job {self.job_id} ({self.kind}) failed: {self.error}')
+        finally:
+            utils.set_progress_reporter(None)
+            self.finished = time.time()
+
+    def to_dict(self):
+        return {"id": self.job_id,
+                "kind": self.kind,
+                "status": self.status,
+                "phase": self.phase,
+                "progress": round(self.progress, 2),
+                "result": self.result,
+                "error": self.error,
+                "created": self.created,
+                "started": self.started,
+                "finished": self.finished}
+
+
+def _prune_finished():
+    expired = [job_id for job_id, job in _jobs.items()
+               if job.finished and time.time() - job.finished > JOB_RETENTION]
+    for job_id in expired:
+        _jobs.pop(job_id)
+
+def submit_job(kind, func, *args, **kwargs):
+    """Enqueues func on the worker pool.
+       Returns the new job, or None when the pool is saturated."""
+
+    if not _executor:
+        configure_pool(_max_workers, _max_pending)
+
+    with _lock:
+        _prune_finished()
+        pending = sum(1 for job in _jobs.values() if not job.finished)
+        if pending >= _max_pending:
+            return None
+        job = Job(kind)
+        _jobs[job.job_id] = job
+
+    _executor.submit(job.run, func, args, kwargs)
+    return job.to_dict()
+
+def get_job(job_id):
+    with _lock:
+        job = _jobs.get(job_id)
+    if job:
+        return job.to_dict()
+    else:
+        return {}
+
+def list_jobs():
+    with _lock:
+        return [job.to_dict() for job in _jobs.values()]
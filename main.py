@@ -1,11 +1,24 @@
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, Response, request, render_template, make_response, jsonify
 from flask_restful import Api, Resource, abort
-import requests
+from concurrent.futures import ThreadPoolExecutor
 import argparse
-from halyard_utils import add_flag
+import itertools
+import json
+import threading
+import time
+from halyard_utils import add_flag, PAGE_SIZE, USER_DISK_PREFIX
+import inventory_cache as cache
+import placement
+import state_store
+import zone_index
 from instance.node_manager import list_nodes, get_node, delete_node, create_or_restore_instance
+from instance.node_manager import create_instance_batch, start_warm_pool
+import instance.node_manager as node_manager
 from image.image_manager import list_images, get_image, delete_image, create_base_image
+from image.image_manager import create_base_image_matrix
+from image import artifact_cache
 from disk.disk_manager import list_disks, delete_disk, list_stopped_disks
+from job.job_manager import configure_pool, submit_job, get_job, list_jobs
 
 from libcloud.compute.types import Provider
 from libcloud.compute.providers import get_driver
@@ -14,14 +27,42 @@ from libcloud.compute.providers import get_driver
 parser = argparse.ArgumentParser()
 add_flag(parser, 'datacenter', 'us-central1-b')
 add_flag(parser, 'project', 'cloud-android-testing')
+add_flag(parser, 'cache_ttl', cache.ttl)
+add_flag(parser, 'job_workers', 4)
+add_flag(parser, 'job_queue_size', 16)
+add_flag(parser, 'warm_pool', '')
+add_flag(parser, 'warm_pool_max', 10)
+add_flag(parser, 'batch_parallelism', 8)
+add_flag(parser, 'zones', '')
+add_flag(parser, 'image_build_parallelism', 4)
+add_flag(parser, 'placement_refresh', placement.REFRESH_INTERVAL)
+add_flag(parser, 'artifact_cache', '')
+add_flag(parser, 'state_db', '')
+add_flag(parser, 'state_reconcile', state_store.RECONCILE_INTERVAL)
 args = parser.parse_args()
 
+cache.configure(args.cache_ttl)
+artifact_cache.configure(args.artifact_cache)
+configure_pool(args.job_workers, args.job_queue_size)
+
 # Get GCE Driver
 ComputeEngine = get_driver(Provider.GCE)
 driver = ComputeEngine('', '',
                        datacenter=args.datacenter,
                        project=args.project)
 
+allowed_zones = args.zones.split(',') if args.zones else [args.datacenter]
+zone_index.configure([args.datacenter] + allowed_zones)
+
+if int(args.placement_refresh):
+    placement.configure(driver, allowed_zones, args.placement_refresh)
+
+if args.state_db:
+    state_store.configure(driver, args.state_db, args.state_reconcile)
+
+if args.warm_pool:
+    start_warm_pool(driver, args.datacenter, args.warm_pool, args.warm_pool_max)
+
 app = Flask(__name__)
 api = Api(app)
 
@@ -29,29 +70,110 @@ def abort_if_none(obj, name):
     if not obj:
         abort(404, message=f"Error: {name} not found.")
 
+def list_params(*names, name_prefix):
+    """Reads filter and pagination query parameters of list endpoints.
+       Prefixes must start with name_prefix, so only halyard resources
+       are listed."""
+
+    params = {name: request.args[name] for name in names if name in request.args}
+    if 'prefix' in params and not params['prefix'].startswith(name_prefix):
+        abort(400, message=f"Error: prefix must start with {name_prefix}.")
+    if 'limit' in request.args:
+        limit = request.args.get('limit', type=int)
+        if not limit or not 0 < limit <= PAGE_SIZE:
+            abort(400, message=f"Error: limit must be between 1 and {PAGE_SIZE}.")
+        params['limit'] = limit
+    if 'page_token' in request.args:
+        params['page_token'] = request.args['page_token']
+    return params
+
+def upstream_status(error):
+    """Status of a response to a failed GCE request"""
+
+    if error.http_code in (400, 404):
+        return error.http_code # e.g. an invalid page token
+    if error.http_code == 429:
+        return 503
+    return 502
+
+def stream_list(key, pages):
+    """Streams {key: [...], "next_page_token": ...} one page at a time.
+       The first page is fetched before the status is sent, so a failed
+       request gets an error instead of a truncated list."""
+
+    try:
+        first_page = next(pages)
+    except Exception as e:
+        if getattr(e, 'http_code', None) is None:
+            raise
+        abort(upstream_status(e), message=f"Error: {e}")
+
+    def generate():
+        yield f'{{"{key}": ['
+        separator = ''
+        next_page_token = None
+        for items, next_page_token in itertools.chain([first_page], pages):
+            for item in items:
+                yield separator + json.dumps(item)
+                separator = ', '
+        yield f'], "next_page_token": {json.dumps(next_page_token)}}}\n'
+
+    return Response(generate(), mimetype='application/json')
+
+def parallelism_param(body, max_parallelism):
+    """Reads the parallelism of a batch request, capped by max_parallelism"""
+
+    parallelism = body.pop('parallelism', max_parallelism)
+    if isinstance(parallelism, bool) or not isinstance(parallelism, int) or parallelism < 1:
+        abort(400, message="Error: parallelism must be a positive integer.")
+    return min(parallelism, max_parallelism)
+
+def accepted_job(job):
+    if not job:
+        abort(503, message="Error: job queue is full, try again later.")
+    return {"job": job}, 202, {"Location": f"/job/{job['id']}"}
+
 
 class Instance(Resource):
     """Cuttlefish instance manager"""
 
     def get(self, instance_name):
-        node = get_node(driver, instance_name, args.datacenter)
+        node = get_node(driver, instance_name, request.args.get('zone'))
         abort_if_none(node, instance_name)
         return {"instance": node}
 
     def delete(self, instance_name):
-        return delete_node(driver, instance_name, args.datacenter)
+        return delete_node(driver, instance_name, request.args.get('zone'))
 
 class InstanceList(Resource):
     """Shows a list of all instances and creates new ones"""
 
     def get(self):
-        nodes = list_nodes(driver)
-        return {"instances": nodes}
+        params = list_params('prefix', 'zone', name_prefix='halyard')
+        return stream_list("instances", list_nodes(driver, **params))
 
     def post(self):
         body = request.json
-        new_instance = create_or_restore_instance(driver, **body)
-        return {"new_instance": new_instance}
+        job = submit_job('create_instance',
+            create_or_restore_instance, driver, **body)
+        return accepted_job(job)
+
+class InstanceBatch(Resource):
+    """Creates or restores instances for a list of users"""
+
+    def post(self):
+        body = dict(request.json or {})
+        user_ids = body.pop('user_ids', None)
+        if not user_ids or not isinstance(user_ids, list):
+            abort(400, message="Error: user_ids must be a non-empty list.")
+        # Duplicates would race for the same instance and disk
+        user_ids = list(dict.fromkeys(map(str, user_ids)))
+
+        parallelism = parallelism_param(body, int(args.batch_parallelism))
+        zones = body.pop('zones', None) or allowed_zones
+        job = submit_job('create_instance_batch', create_instance_batch,
+            driver, user_ids, zones=zones, parallelism=parallelism, **body)
+        return accepted_job(job)
 
 class BaseImage(Resource):
     """Halyard base image manager"""
@@ -68,56 +190,176 @@ class BaseImageList(Resource):
     """Shows a list of all base images and creates new ones"""
 
     def get(self):
-        images = list_images(driver)
-        return {"images": images}
+        params = list_params('prefix', 'family', name_prefix='halyard')
+        return stream_list("images", list_images(driver, **params))
 
     def post(self):
         body = request.json
-        new_image = create_base_image(driver, **body)
-        return {"new_image": new_image}
+        job = submit_job('create_image', create_base_image, driver, **body)
+        return accepted_job(job)
+
+class BaseImageMatrix(Resource):
+    """Creates base images for a list of branch and target pairs"""
+
+    def post(self):
+        body = dict(request.json or {})
+        builds = body.pop('builds', None)
+        if (not builds or not isinstance(builds, list) or
+                not all(isinstance(build, dict) and 'build_branch' in build
+                        and 'build_target' in build for build in builds)):
+            abort(400, message="Error: builds must be a non-empty list of "
+                               "build_branch and build_target pairs.")
+        # Builds of a pair share their build instance and image disk
+        pairs = {}
+        for build in builds:
+            pairs.setdefault((build['build_branch'], build['build_target']), build)
+        builds = list(pairs.values())
+
+        parallelism = parallelism_param(body, int(args.image_build_parallelism))
+        zones = body.pop('zones', None) or allowed_zones
+        job = submit_job('create_image_matrix', create_base_image_matrix,
+            driver, builds, zones=zones, parallelism=parallelism, **body)
+        return accepted_job(job)
 
 class Disk(Resource):
     """Halyard disk manager"""
 
     def delete(self, disk_name):
-        return delete_disk(driver, disk_name, args.datacenter)
+        return delete_disk(driver, disk_name, request.args.get('zone'))
 
 class DiskList(Resource):
     """Shows a list of disks which can be used to restore instances"""
 
     def get(self):
-        stopped_instances = list_stopped_disks(driver)
-        return {"disks": stopped_instances}
+        params = list_params('prefix', 'zone', name_prefix=USER_DISK_PREFIX)
+        return stream_list("disks", list_stopped_disks(driver, **params))
+
+class Job(Resource):
+    """Reports phase, progress and result of a provisioning job"""
+
+    def get(self, job_id):
+        job = get_job(job_id)
+        abort_if_none(job, job_id)
+        return {"job": job}
+
+class JobList(Resource):
+    """Shows a list of all provisioning jobs"""
+
+    def get(self):
+        return {"jobs": list_jobs()}
+
+class WarmPoolStatus(Resource):
+    """Shows idle and booting warm pool hosts per image family"""
+
+    def get(self):
+        pool = node_manager.warm_pool
+        return {"warm_pool": pool.stats() if pool else {}}
+
+class PlacementStatus(Resource):
+    """Shows the zone data the placement scheduler decides with"""
+
+    def get(self):
+        scheduler = placement.scheduler
+        return {"placement": scheduler.stats() if scheduler else {}}
+
+class StateStoreStatus(Resource):
+    """Shows row counts and reconciliation state of the state store"""
+
+    def get(self):
+        store = state_store.store
+        return {"state_store": store.stats() if store else {}}
+
+class CacheStats(Resource):
+    """Shows inventory cache hit and miss counters"""
+
+    def get(self):
+        return {"cache": cache.stats(), "zone_index": zone_index.index.stats()}
+
+class RenderStats(Resource):
+    """Shows average and max render time of the demo pages"""
+
+    def get(self):
+        with render_stats_lock:
+            pages = {page: {"count": stats['count'],
+                            "avg_fetch_ms": stats['fetch_ms'] / stats['count'],
+                            "avg_render_ms": stats['render_ms'] / stats['count'],
+                            "max_ms": stats['max_ms']}
+                     for page, stats in render_stats.items()}
+        return {"pages": pages}
 
 api.add_resource(InstanceList, "/instance-list")
+api.add_resource(InstanceBatch, "/instance-batch")
 api.add_resource(BaseImageList, "/image-list")
+api.add_resource(BaseImageMatrix, "/image-matrix")
 api.add_resource(DiskList, "/disk-list")
 api.add_resource(Instance, "/instance/<string:instance_name>")
 api.add_resource(BaseImage, "/image/<string:image_name>")
 api.add_resource(Disk, "/disk/<string:disk_name>")
+api.add_resource(JobList, "/job-list")
+api.add_resource(Job, "/job/<string:job_id>")
+api.add_resource(WarmPoolStatus, "/warm-pool")
+api.add_resource(PlacementStatus, "/placement")
+api.add_resource(StateStoreStatus, "/state-store")
+api.add_resource(CacheStats, "/cache-stats")
+api.add_resource(RenderStats, "/render-stats")
 
 # Demo UI Endpoints
 
-BASE = "http://127.0.0.1:5000/"
 SIG_SERVER_HOST = "localhost:8443"
 
+ui_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='halyard-ui')
+render_stats = {} # A dictionary of page name to render timings
+render_stats_lock = threading.Lock()
+
+def fetch_page_data(**listings):
+    """Runs the given listings concurrently in process.
+       Listings share the inventory cache with the REST endpoints."""
+
+    futures = {name: ui_executor.submit(
+                   lambda pages=pages: [item for items, _ in pages() for item in items])
+               for name, pages in listings.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+def record_render(page, fetch_time, render_time):
+    with render_stats_lock:
+        stats = render_stats.setdefault(page, {
+            "count": 0, "fetch_ms": 0.0, "render_ms": 0.0, "max_ms": 0.0})
+        stats['count'] += 1
+        stats['fetch_ms'] += fetch_time * 1000
+        stats['render_ms'] += render_time * 1000
+        stats['max_ms'] = max(stats['max_ms'], (fetch_time + render_time) * 1000)
+
+def render_page(page, template, **listings):
+    """Renders a demo page and reports its timing in a Server-Timing header"""
+
+    start = time.perf_counter()
+    data = fetch_page_data(**listings)
+    fetched = time.perf_counter()
+    response = make_response(render_template(template, **data))
+    rendered = time.perf_counter()
+
+    record_render(page, fetched - start, rendered - fetched)
+    response.headers['Server-Timing'] = \
+        f'fetch;dur={(fetched - start) * 1000:.1f}, ' \
+        f'render;dur={(rendered - fetched) * 1000:.1f}'
+    return response
+
 @app.route('/')
 def index():
-    instances = requests.get(BASE + "instance-list").json()['instances']
-    disks = requests.get(BASE + "disk-list").json()['disks']
-    return render_template('instances.html', instances=instances, disks=disks)
+    return render_page('index', 'instances.html',
+        instances=lambda: list_nodes(driver),
+        disks=lambda: list_stopped_disks(driver))
 
 @app.route('/instances')
 def instances_page():
-    instances = requests.get(BASE + "instance-list").json()['instances']
-    disks = requests.get(BASE + "disk-list").json()['disks']
-    return render_template('instances.html',
-        instances=instances, disks=disks)
+    return render_page('instances', 'instances.html',
+        instances=lambda: list_nodes(driver),
+        disks=lambda: list_stopped_disks(driver))
 
 @app.route('/images')
 def images_page():
-    images = requests.get(BASE + "image-list").json()['images']
-    return render_template('images.html', images=images)
+    return render_page('images', 'images.html',
+        images=lambda: list_images(driver))
 
 @app.route('/connect')
 def enter_instance():
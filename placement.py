@@ -0,0 +1,292 @@
+import collections
+import itertools
+import threading
+import time
+
+import halyard_utils as utils
+import zone_index
+
+DEFAULT_ZONE = 'us-central1-b'
+REFRESH_INTERVAL = 300 # seconds between refreshes of the zone data
+COOLDOWN = 600 # seconds a zone is avoided after a capacity error
+
+# Errors GCE returns when a zone or region can't fit a resource
+CAPACITY_ERRORS = ('QUOTA_EXCEEDED', 'ZONE_RESOURCE_POOL_EXHAUSTED',
+                   'ZONE_RESOURCE_POOL_EXHAUSTED_WITH_DETAILS',
+                   'RESOURCE_OPERATION_RATE_EXCEEDED')
+
+# Region quotas a host uses besides GPUs
+QUOTA_METRICS = ('CPUS', 'DISKS_TOTAL_GB', 'IN_USE_ADDRESSES')
+GPU_QUOTAS = {'nvidia-tesla-p100-vws': 'NVIDIA_P100_VWS_GPUS'}
+
+scheduler = None
+
+
+def is_capacity_error(error):
+    code = getattr(error, 'code', None)
+    return code in CAPACITY_ERRORS or any(name in str(error) for name in CAPACITY_ERRORS)
+
+def region_of(zone):
+    return zone.rsplit('-', 1)[0]
+
+def host_needs(cpus, disk_gb=0, gpu_type=None, gpus=0):
+    """Quota metrics a host uses and their amounts"""
+
+    needs = {'CPUS': cpus, 'DISKS_TOTAL_GB': disk_gb, 'IN_USE_ADDRESSES': 1}
+    if gpu_type:
+        needs[GPU_QUOTAS.get(gpu_type, '')] = gpus
+    return needs
+
+def region_quotas(driver, region):
+    """Returns the free amount of each quota metric of a region"""
+
+    return {quota['metric']: quota['limit'] - quota['usage']
+            for quota in driver.ex_get_region(region).quotas or []}
+
+
+class PlacementScheduler:
+    """Picks the zone of new instances and build hosts.
+       Region quotas, accelerator types and instance counts are refreshed
+       in the background and adjusted locally between refreshes, so
+       placing a request costs no GCE call. Hosts being created hold a
+       reservation in their zone, so concurrent requests see each other."""
+
+    def __init__(self, driver, zones, refresh_interval=REFRESH_INTERVAL):
+        self.driver = driver
+        self.zones = list(zones)
+        self.refresh_interval = refresh_interval
+        self.quotas = {} # region -> {metric: free amount}
+        self.gpu_zones = {} # gpu type -> zones offering it
+        self.instances = collections.Counter() # zone -> halyard instances
+        self.cooldowns = {} # zone -> time until which it's avoided
+        self.reservations = {} # id -> (zone, needs) of hosts being created
+        self._reservation_ids = itertools.count(1)
+        self.refreshed = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def start(self):
+        self.refresh()
+        threading.Thread(target=self._run, name='placement', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.refresh_interval)
+            self._wake.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f'Placement refresh failed: {e}')
+
+    def refresh(self):
+        """Reloads quotas, accelerator types and instance counts"""
+
+        quotas = {}
+        for region in {region_of(zone) for zone in self.zones}:
+            try:
+                quotas[region] = region_quotas(self.driver, region)
+            except Exception as e:
+                print(f'Could not read quotas of {region}: {e}')
+
+        with self._lock:
+            gpu_types = list(self.gpu_zones)
+        gpu_zones = {gpu_type: self._find_gpu_zones(gpu_type) for gpu_type in gpu_types}
+
+        instances = collections.Counter()
+        instance_zones = {}
+        for item in utils.list_by_prefix(self.driver, 'instances',
+                                         utils.INSTANCE_PREFIX, 'all'):
+            zone = item['zone'].rsplit('/', 1)[-1]
+            instances[zone] += 1
+            instance_zones[item['name']] = zone
+
+        with self._lock:
+            self.quotas = quotas
+            self.gpu_zones.update(gpu_zones)
+            self.instances = instances
+            self.refreshed = time.time()
+        # The listing covers every zone, lookups by name get it for free
+        zone_index.remember_all(zone_index.INSTANCES, instance_zones)
+
+    def _find_gpu_zones(self, gpu_type):
+        return {zone for zone in self.zones
+                if utils.find_gpu(self.driver, gpu_type, zone)}
+
+    def _learn_gpu_zones(self, gpu_type):
+        if not gpu_type:
+            return
+        with self._lock:
+            known = gpu_type in self.gpu_zones
+        if not known:
+            # Looked up once, then kept fresh by the background refresh
+            found = self._find_gpu_zones(gpu_type)
+            with self._lock:
+                self.gpu_zones[gpu_type] = found
+
+    def candidates(self, cpus, disk_gb=0, gpu_type=None, gpus=0, zones=None):
+        """Zones that can fit a host, best first.
+           Zones with the most quota left and the fewest instances come
+           first, zones that recently ran out of capacity last."""
+
+        self._learn_gpu_zones(gpu_type)
+        with self._lock:
+            return self._rank(host_needs(cpus, disk_gb, gpu_type, gpus),
+                              gpu_type, zones or self.zones)
+
+    def _rank(self, needs, gpu_type, zones):
+        """The zones that can fit a host with needs, best first.
+           Reserved capacity counts as used. Called with the lock held."""
+
+        reserved = collections.Counter() # (region, metric) -> amount
+        reserved_hosts = collections.Counter() # zone -> hosts
+        for zone, reservation in self.reservations.values():
+            reserved_hosts[zone] += 1
+            for metric, amount in reservation.items():
+                reserved[(region_of(zone), metric)] += amount
+
+        now = time.time()
+        ranked = []
+        for zone in zones:
+            if gpu_type and zone not in self.gpu_zones.get(gpu_type, ()):
+                continue
+            region = region_of(zone)
+            quotas = self.quotas.get(region, {})
+            headroom = [(quotas[metric] - reserved[(region, metric)]) / amount
+                        for metric, amount in needs.items()
+                        if amount and metric in quotas]
+            if any(free < 1 for free in headroom):
+                continue
+            cooling = self.cooldowns.get(zone, 0) > now
+            ranked.append(((cooling, -min(headroom, default=float('inf')),
+                            self.instances[zone] + reserved_hosts[zone]), zone))
+        return [zone for _, zone in sorted(ranked)]
+
+    def reserve(self, candidates, cpus, disk_gb=0, gpu_type=None, gpus=0):
+        """Picks the best of candidates and reserves a host's capacity there
+           until release(). Ranking and reserving happen under one lock, so
+           concurrent requests spread out. When no candidate seems to fit,
+           the first is picked anyway, GCE has the final word.
+           Returns the zone and the reservation id."""
+
+        needs = host_needs(cpus, disk_gb, gpu_type, gpus)
+        self._learn_gpu_zones(gpu_type)
+        with self._lock:
+            ranked = self._rank(needs, gpu_type, candidates)
+            zone = ranked[0] if ranked else candidates[0]
+            reservation = next(self._reservation_ids)
+            self.reservations[reservation] = (zone, needs)
+        return zone, reservation
+
+    def release(self, reservation):
+        with self._lock:
+            self.reservations.pop(reservation, None)
+
+    def record_placement(self, zone, instance_name, cpus, disk_gb=0, gpu_type=None, gpus=0):
+        """Accounts for a host created since the last refresh"""
+
+        with self._lock:
+            quotas = self.quotas.get(region_of(zone), {})
+            used = host_needs(cpus, disk_gb, gpu_type, gpus)
+            for metric, amount in used.items():
+                if metric in quotas:
+                    quotas[metric] -= amount
+            self.instances[zone] += 1
+        zone_index.remember(zone_index.INSTANCES, instance_name, zone)
+
+    def record_capacity_error(self, zone):
+        with self._lock:
+            self.cooldowns[zone] = time.time() + COOLDOWN
+        # The quotas that made the zone look suitable are stale
+        self._wake.set()
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {"zones": self.zones,
+                    "quotas": {region: {metric: free for metric, free in quotas.items()
+                                        if metric in QUOTA_METRICS
+                                        or metric in GPU_QUOTAS.values()}
+                               for region, quotas in self.quotas.items()},
+                    "gpu_zones": {gpu_type: sorted(zones)
+                                  for gpu_type, zones in self.gpu_zones.items()},
+                    "instances": dict(self.instances),
+                    "cooling_down": sorted(zone for zone, until in self.cooldowns.items()
+                                           if until > now),
+                    "reserved": dict(collections.Counter(
+                        zone for zone, _ in self.reservations.values())),
+                    "refreshed": self.refreshed}
+
+
+def configure(driver, zones, refresh_interval=REFRESH_INTERVAL):
+    global scheduler
+    scheduler = PlacementScheduler(driver, zones, int(refresh_interval))
+    scheduler.start()
+    return scheduler
+
+def disk_zone(driver, disk_name):
+    """Zone of an existing disk.
+       Disks the zone index doesn't know are looked up in every zone, not
+       only the configured ones, so no user ever gets a second disk."""
+
+    zone = zone_index.get(zone_index.DISKS, disk_name)
+    if zone:
+        return zone
+    for disk in utils.list_by_prefix(driver, 'disks', disk_name, 'all'):
+        if disk['name'] == disk_name:
+            zone = disk['zone'].rsplit('/', 1)[-1]
+            zone_index.remember(zone_index.DISKS, disk_name, zone)
+            return zone
+    return None
+
+def place(cpus, disk_gb=0, gpu_type=None, gpus=0, zones=None, default=DEFAULT_ZONE):
+    """Candidate zones of a host, or the default zone without a scheduler"""
+
+    if not scheduler:
+        return [zones[0] if zones else default]
+    return scheduler.candidates(cpus, disk_gb, gpu_type, gpus, zones)
+
+def placed(zone, instance_name, cpus, disk_gb=0, gpu_type=None, gpus=0):
+    if scheduler:
+        scheduler.record_placement(zone, instance_name, cpus, disk_gb, gpu_type, gpus)
+
+def capacity_error(zone):
+    if scheduler:
+        scheduler.record_capacity_error(zone)
+
+def reserve(candidates, cpus, disk_gb=0, gpu_type=None, gpus=0):
+    """Zone picked from candidates and its reservation, or the first
+       candidate without a scheduler"""
+
+    if not scheduler:
+        return candidates[0], None
+    return scheduler.reserve(candidates, cpus, disk_gb, gpu_type, gpus)
+
+def release(reservation):
+    if scheduler and reservation:
+        scheduler.release(reservation)
+
+def try_zones(candidates, attempt, cleanup, cpus, disk_gb=0, gpu_type=None, gpus=0,
+              preferred=None):
+    """Calls attempt(zone) in candidate zones until one has capacity.
+       Each zone is picked when its attempt starts, the preferred one first
+       if it's a candidate, and a host's capacity stays reserved there
+       while the attempt runs.
+       cleanup(zone) removes what an attempt left in a zone that ran out.
+       Returns the zone and the result of its attempt."""
+
+    remaining = list(candidates)
+    while True:
+        picks = [preferred] if preferred in remaining else remaining
+        preferred = None
+        zone, reservation = reserve(picks, cpus, disk_gb, gpu_type, gpus)
+        remaining.remove(zone)
+        try:
+            return zone, attempt(zone)
+        except Exception as e:
+            if not is_capacity_error(e) or not remaining:
+                raise
+            print(f'{zone} is out of capacity, trying another zone: {e}')
+            capacity_error(zone)
+            cleanup(zone)
+        finally:
+            release(reservation)
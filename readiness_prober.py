@@ -0,0 +1,246 @@
+import errno
+import heapq
+import itertools
+import selectors
+import socket
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from libcloud.compute.types import NodeState
+
+SSH_PORT = 22
+DEFAULT_DEADLINE = 900 # seconds until an instance is considered failed
+MIN_INTERVAL = 0.5
+MAX_INTERVAL = 10
+BACKOFF = 1.5
+CONNECT_TIMEOUT = 3
+NODE_LOOKUP_WORKERS = 4 # threads making the driver calls of node probes
+
+_prober = None
+_prober_lock = threading.Lock()
+
+
+class InstanceNotReady(Exception):
+    """Instance did not accept SSH connections before its deadline"""
+
+
+class _Target:
+    """Instance being watched and its current probing state"""
+
+    def __init__(self, instance_name, zone, deadline):
+        self.instance_name = instance_name
+        self.zone = zone
+        self.deadline = deadline
+        self.future = Future()
+        self.phase = 'node' # node -> tcp -> banner
+        self.interval = MIN_INTERVAL
+        self.address = None
+        self.sock = None
+        self.probes = 0
+        self.token = None # latest schedule entry, older ones are stale
+
+    def backoff(self):
+        delay = self.interval
+        self.interval = min(self.interval * BACKOFF, MAX_INTERVAL)
+        return delay
+
+
+class ReadinessProber:
+    """Waits for many instances to become reachable from a single thread.
+       Cheap signals are checked first: node state through the driver,
+       then a non blocking TCP connect to port 22 that must answer with
+       an SSH banner. Driver calls block, so they run on a small pool and
+       hand their result back to the probing thread."""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self._selector = selectors.DefaultSelector()
+        self._schedule = [] # heap of (due_time, token, target)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._node_lookups = ThreadPoolExecutor(max_workers=NODE_LOOKUP_WORKERS,
+                                                thread_name_prefix='readiness-node')
+        self._looked_up = [] # (target, node) of finished node lookups
+        self._waker_r, self._waker_w = socket.socketpair()
+        self._waker_r.setblocking(False)
+        self._selector.register(self._waker_r, selectors.EVENT_READ, None)
+        self._thread = threading.Thread(target=self._run,
+                                        name='readiness-prober', daemon=True)
+        self._thread.start()
+
+    def watch(self, instance_name, zone, timeout=DEFAULT_DEADLINE):
+        """Starts watching an instance.
+           Returns a future resolved with the probed address when ready."""
+
+        target = _Target(instance_name, zone, time.monotonic() + timeout)
+        self._schedule_at(target, time.monotonic())
+        return target.future
+
+    def _schedule_at(self, target, due):
+        with self._lock:
+            target.token = next(self._seq)
+            heapq.heappush(self._schedule, (due, target.token, target))
+        self._wake()
+
+    def _wake(self):
+        if threading.current_thread() is not self._thread:
+            self._waker_w.send(b'\0')
+
+    def _retry(self, target):
+        target.phase = 'node' if target.address is None else 'tcp'
+        due = time.monotonic() + target.backoff()
+        self._schedule_at(target, min(due, target.deadline))
+
+    def _run(self):
+        while True:
+            try:
+                self._run_once()
+            except Exception as e:
+                # Targets fail on their own, the loop has to keep going
+                print(f'Readiness prober error: {e}')
+                time.sleep(MIN_INTERVAL)
+
+    def _run_once(self):
+        with self._lock:
+            next_due = self._schedule[0][0] if self._schedule else None
+        timeout = MAX_INTERVAL if next_due is None \
+            else max(0, next_due - time.monotonic())
+        for key, events in self._selector.select(timeout):
+            if key.data is None:
+                try:
+                    self._waker_r.recv(4096)
+                except BlockingIOError:
+                    pass
+            else:
+                self._guarded(key.data, self._on_socket_event, key.data, events)
+        with self._lock:
+            looked_up, self._looked_up = self._looked_up, []
+        for target, node in looked_up:
+            self._guarded(target, self._on_node, target, node)
+        self._run_due()
+
+    def _guarded(self, target, func, *args):
+        """Calls func, failing only the target when it raises"""
+
+        try:
+            func(*args)
+        except Exception as e:
+            if not target.future.done():
+                self._fail(target, e)
+
+    def _run_due(self):
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            while self._schedule and self._schedule[0][0] <= now:
+                _, token, target = heapq.heappop(self._schedule)
+                if token == target.token:
+                    due.append(target)
+        for target in due:
+            if target.future.done():
+                continue
+            if now >= target.deadline:
+                self._fail(target)
+            elif target.sock:
+                # Connect or banner read timed out
+                self._close_socket(target)
+                self._retry(target)
+            elif target.phase == 'node':
+                self._guarded(target, self._probe_node, target)
+            else:
+                self._guarded(target, self._probe_tcp, target)
+
+    def _probe_node(self, target):
+        target.probes += 1
+
+        def lookup():
+            try:
+                node = self.driver.ex_get_node(target.instance_name, target.zone)
+            except Exception:
+                node = None
+            with self._lock:
+                self._looked_up.append((target, node))
+            self._wake()
+
+        self._node_lookups.submit(lookup)
+
+    def _on_node(self, target, node):
+        if target.future.done():
+            return
+        if time.monotonic() >= target.deadline:
+            self._fail(target)
+            return
+        if node and node.state == NodeState.RUNNING:
+            ips = [ip for ip in node.public_ips + node.private_ips if ip]
+            if ips:
+                target.address = ips[0]
+                # The instance is booting, SSH is usually close behind
+                target.interval = MIN_INTERVAL
+                self._probe_tcp(target)
+                return
+        self._retry(target)
+
+    def _probe_tcp(self, target):
+        target.probes += 1
+        target.phase = 'tcp'
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            err = sock.connect_ex((target.address, SSH_PORT))
+        except OSError:
+            sock.close()
+            raise
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self._retry(target)
+            return
+        target.sock = sock
+        self._selector.register(sock, selectors.EVENT_WRITE, target)
+        self._schedule_at(target, time.monotonic() + CONNECT_TIMEOUT)
+
+    def _on_socket_event(self, target, events):
+        sock = target.sock
+        if target.phase == 'tcp':
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                self._close_socket(target)
+                self._retry(target)
+                return
+            target.phase = 'banner'
+            self._selector.modify(sock, selectors.EVENT_READ, target)
+        else:
+            try:
+                banner = sock.recv(64)
+            except OSError:
+                banner = b''
+            self._close_socket(target)
+            if banner.startswith(b'SSH-'):
+                target.future.set_result(target.address)
+            else:
+                self._retry(target)
+
+    def _close_socket(self, target):
+        self._selector.unregister(target.sock)
+        target.sock.close()
+        target.sock = None
+
+    def _fail(self, target, error=None):
+        if target.sock:
+            try:
+                self._close_socket(target)
+            except Exception:
+                target.sock = None
+        reason = f', {error}' if error else ''
+        target.future.set_exception(InstanceNotReady(
+            f'{target.instance_name} not reachable on port {SSH_PORT} '
+            f'after {target.probes} probes (last phase: {target.phase}{reason})'))
+
+
+def get_prober(driver):
+    """Returns the process wide prober, starting it on first use"""
+
+    global _prober
+    with _prober_lock:
+        if not _prober:
+            _prober = ReadinessProber(driver)
+        return _prober
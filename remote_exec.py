@@ -0,0 +1,214 @@
+import collections
+import hashlib
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+IDLE_TIMEOUT = 300 # seconds an unused connection is kept open
+COMMAND_TIMEOUT = 1800
+
+CommandResult = collections.namedtuple(
+    'CommandResult', ['command', 'exit_code', 'stdout', 'stderr'])
+
+
+class RemoteExecError(Exception):
+    """Connection to an instance could not be established"""
+
+
+class GcloudSSHTransport:
+    """Persistent OpenSSH master connection to one instance.
+       The master is opened once through gcloud, which takes care of keys
+       and known hosts. Commands then reuse its control socket, so each
+       one costs a single round trip instead of a full SSH handshake."""
+
+    _control_dir = None # created with the first connection
+    _control_dir_lock = threading.Lock()
+
+    def __init__(self, instance_name, zone, idle_timeout=IDLE_TIMEOUT):
+        self.instance_name = instance_name
+        self.zone = zone
+        self.idle_timeout = idle_timeout
+        # Unix socket paths are limited to ~100 characters
+        self.digest = hashlib.sha1(f'{zone}/{instance_name}'.encode()).hexdigest()[:16]
+
+    @classmethod
+    def control_dir(cls):
+        with cls._control_dir_lock:
+            if not cls._control_dir:
+                cls._control_dir = tempfile.mkdtemp(prefix='halyard-ssh-')
+            return cls._control_dir
+
+    @property
+    def control_path(self):
+        return os.path.join(self.control_dir(), self.digest)
+
+    def _ssh_options(self):
+        return ['-o', f'ControlPath={self.control_path}',
+                '-o', f'ControlPersist={int(self.idle_timeout)}',
+                '-o', 'ServerAliveInterval=30']
+
+    def open(self):
+        command = ['gcloud', 'compute', 'ssh', self.instance_name,
+                   f'--zone={self.zone}', '--',
+                   '-M', '-N', '-f'] + self._ssh_options()
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RemoteExecError(
+                f'Could not connect to {self.instance_name}: {result.stderr}')
+
+    def is_alive(self):
+        result = subprocess.run(
+            ['ssh', '-S', self.control_path, '-O', 'check', self.instance_name],
+            capture_output=True)
+        return result.returncode == 0
+
+    def run(self, script, timeout=COMMAND_TIMEOUT):
+        """Runs a shell script over the master connection"""
+
+        result = subprocess.run(
+            ['ssh', '-S', self.control_path, self.instance_name, 'bash -s'],
+            input=script, capture_output=True, text=True, timeout=timeout)
+        return result.returncode, result.stdout, result.stderr
+
+    def close(self):
+        subprocess.run(
+            ['ssh', '-S', self.control_path, '-O', 'exit', self.instance_name],
+            capture_output=True)
+
+
+class _Session:
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.opened = False
+
+
+def _batch_script(commands, marker, stop_on_error):
+    """Wraps commands in one script that delimits each command's output.
+       End markers start with a newline so output without one is kept."""
+
+    lines = []
+    for i, command in enumerate(commands):
+        lines.append(f'echo "{marker} begin {i}"; echo "{marker} begin {i}" >&2')
+        lines.append(f'( {command}\n)')
+        lines.append(f'rc=$?; printf "\\n{marker} end {i} $rc\\n"; '
+                     f'printf "\\n{marker} end {i}\\n" >&2')
+        if stop_on_error:
+            lines.append('[ $rc -eq 0 ] || exit $rc')
+    return '\n'.join(lines) + '\n'
+
+def _split_output(output, marker):
+    """Returns {index: [text, exit_code]} from a delimited output stream"""
+
+    sections = {}
+    current = None
+    for line in output.splitlines(keepends=True):
+        if line.startswith(marker):
+            fields = line.split()
+            if fields[1] == 'begin':
+                current = int(fields[2])
+                sections[current] = ['', None]
+            elif current is not None:
+                # Drop the newline printed before the end marker
+                sections[current][0] = sections[current][0][:-1]
+                if len(fields) > 3:
+                    sections[current][1] = int(fields[3])
+                current = None
+        elif current is not None:
+            sections[current][0] += line
+    return sections
+
+
+class SessionPool:
+    """Keeps one persistent connection per instance and expires idle ones"""
+
+    def __init__(self, transport_factory=GcloudSSHTransport,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.transport_factory = transport_factory
+        self.idle_timeout = idle_timeout
+        self._sessions = {} # (instance_name, zone) -> session
+        self._lock = threading.Lock()
+
+    def _session(self, instance_name, zone):
+        self.reap_idle()
+        key = (instance_name, zone)
+        with self._lock:
+            session = self._sessions.get(key)
+            if not session:
+                session = _Session(self.transport_factory(
+                    instance_name, zone, idle_timeout=self.idle_timeout))
+                self._sessions[key] = session
+        return session
+
+    def run_batch(self, instance_name, zone, commands, stop_on_error=True):
+        """Runs commands in a single round trip.
+           Returns a CommandResult per command that was executed."""
+
+        session = self._session(instance_name, zone)
+        marker = f'__halyard_{uuid.uuid4().hex}__'
+        script = _batch_script(commands, marker, stop_on_error)
+
+        with session.lock:
+            if not session.opened or not session.transport.is_alive():
+                session.transport.open()
+                session.opened = True
+            exit_code, stdout, stderr = session.transport.run(script)
+            session.last_used = time.monotonic()
+
+        outputs = _split_output(stdout, marker)
+        errors = _split_output(stderr, marker)
+        results = []
+        for i, command in enumerate(commands):
+            if i not in outputs:
+                break
+            text, code = outputs[i]
+            if code is None:
+                # Connection dropped in the middle of the command
+                code = exit_code if exit_code != 0 else -1
+            results.append(CommandResult(
+                command, code, text, errors.get(i, ('', None))[0]))
+        return results
+
+    def run(self, instance_name, zone, command):
+        return self.run_batch(instance_name, zone, [command])[0]
+
+    def close(self, instance_name, zone):
+        with self._lock:
+            session = self._sessions.pop((instance_name, zone), None)
+        if session and session.opened:
+            with session.lock:
+                session.transport.close()
+
+    def reap_idle(self):
+        """Closes connections unused for longer than the idle timeout"""
+
+        now = time.monotonic()
+        with self._lock:
+            idle = [key for key, session in self._sessions.items()
+                    if now - session.last_used > self.idle_timeout
+                    and not session.lock.locked()]
+        for instance_name, zone in idle:
+            self.close(instance_name, zone)
+
+    def close_all(self):
+        with self._lock:
+            keys = list(self._sessions)
+        for instance_name, zone in keys:
+            self.close(instance_name, zone)
+
+
+pool = SessionPool()
+
+def run(instance_name, zone, command):
+    return pool.run(instance_name, zone, command)
+
+def run_batch(instance_name, zone, commands, stop_on_error=True):
+    return pool.run_batch(instance_name, zone, commands, stop_on_error)
+
+def close(instance_name, zone):
+    pool.close(instance_name, zone)
@@ -0,0 +1,359 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import os
+import socket
+import threading
+
+REQUEST_TIMEOUT = 10
+
+
+class InMemoryBroker:
+    """Device registry and message routing for a single server process.
+       Each device has its own table of connected clients."""
+
+    def __init__(self):
+        self.devices = {} # A dictionary of id to device entries
+        self.lock = threading.Lock()
+
+    def register_device(self, device_id, device_info, deliver):
+        """Registers a device, returns False if the id is taken"""
+
+        with self.lock:
+            if device_id in self.devices:
+                return False
+            self.devices[device_id] = {"info": device_info, "deliver": deliver,
+                                       "clients": {}, "next_client_id": 1}
+            return True
+
+    def unregister_device(self, device_id):
+        with self.lock:
+            self.devices.pop(device_id, None)
+
+    def get_device_info(self, device_id):
+        with self.lock:
+            device = self.devices.get(device_id)
+            return device['info'] if device else None
+
+    def register_client(self, device_id, deliver):
+        """Adds a client to a device, returns its id or None"""
+
+        with self.lock:
+            device = self.devices.get(device_id)
+            if not device:
+                return None
+            client_id = device['next_client_id']
+            device['next_client_id'] += 1
+            device['clients'][client_id] = deliver
+            return client_id
+
+    def unregister_client(self, device_id, client_id):
+        with self.lock:
+            device = self.devices.get(device_id)
+            if device:
+                device['clients'].pop(client_id, None)
+
+    def send_to_device(self, device_id, frame, droppable=False):
+        with self.lock:
+            device = self.devices.get(device_id)
+        if not device:
+            return False
+        device['deliver'](frame, droppable)
+        return True
+
+    def send_to_client(self, device_id, client_id, frame, droppable=False):
+        with self.lock:
+            device = self.devices.get(device_id)
+            deliver = device['clients'].get(client_id) if device else None
+        if not deliver:
+            return False
+        deliver(frame, droppable)
+        return True
+
+    def send_to_clients(self, device_id, client_ids, frame, droppable=False):
+        """Sends one frame to several clients of a device, or to all of them
+           when client_ids is None. Returns the number of recipients."""
+
+        with self.lock:
+            device = self.devices.get(device_id)
+            if not device:
+                return 0
+            clients = device['clients']
+            if client_ids is None:
+                delivers = list(clients.values())
+            else:
+                delivers = [clients[client_id] for client_id in client_ids
+                            if client_id in clients]
+        for deliver in delivers:
+            deliver(frame, droppable)
+        return len(delivers)
+
+    def client_ids(self, device_id):
+        with self.lock:
+            device = self.devices.get(device_id)
+            return list(device['clients']) if device else []
+
+
+# Broker protocol: every message is a JSON header line, followed by
+# header['length'] bytes of raw frame for the to_* and deliver operations.
+
+def _encode(header, body=b''):
+    header['length'] = len(body)
+    return json.dumps(header).encode() + b'\n' + body
+
+def connect(address):
+    """Opens a socket to a 'unix:/path' or 'tcp:host:port' broker address"""
+
+    kind, _, location = address.partition(':')
+    if kind == 'unix':
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(location)
+    else:
+        host, port = location.rsplit(':', 1)
+        sock = socket.create_connection((host, int(port)))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class SocketBroker:
+    """Worker side of a registry shared by several server processes.
+       Registrations go through the broker process, which routes frames
+       to the worker holding the target connection. Frames between
+       connections of the same worker are delivered directly.
+       Frames sent to another worker are routed without waiting for an
+       answer, the broker reports those it couldn't deliver back to
+       on_undeliverable(device_id, client_id)."""
+
+    def __init__(self, address, on_undeliverable=None):
+        self.sock = connect(address)
+        self.on_undeliverable = on_undeliverable
+        self.reader = self.sock.makefile('rb')
+        self.local_devices = {} # device_id -> deliver
+        self.local_clients = {} # (device_id, client_id) -> deliver
+        self.pending = {} # request id -> [event, result]
+        self.request_ids = itertools.count(1)
+        self.write_lock = threading.Lock()
+        threading.Thread(target=self._read_loop, name='sig-broker',
+                         daemon=True).start()
+
+    def _send(self, header, body=b''):
+        data = _encode(header, body)
+        with self.write_lock:
+            self.sock.sendall(data)
+
+    def _call(self, op, **fields):
+        request_id = next(self.request_ids)
+        waiter = [threading.Event(), None]
+        self.pending[request_id] = waiter
+        self._send(dict(fields, op=op, req=request_id))
+        if not waiter[0].wait(REQUEST_TIMEOUT):
+            self.pending.pop(request_id, None)
+            raise TimeoutError(f'Broker did not answer {op}')
+        return waiter[1]
+
+    def _read_loop(self):
+        while True:
+            line = self.reader.readline()
+            if not line:
+                print('ERROR - lost connection to broker')
+                os._exit(1)
+            header = json.loads(line)
+            body = self.reader.read(header['length']) if header['length'] else b''
+            if header['op'] == 'reply':
+                waiter = self.pending.pop(header['req'], None)
+                if waiter:
+                    waiter[1] = header['result']
+                    waiter[0].set()
+            elif header['op'] == 'undeliverable':
+                if self.on_undeliverable:
+                    self.on_undeliverable(header['device_id'], header.get('client_id'))
+            elif header['op'] == 'deliver':
+                if 'client_ids' in header:
+                    frame = body.decode()
+                    for client_id in header['client_ids']:
+                        deliver = self.local_clients.get((header['device_id'], client_id))
+                        if deliver:
+                            deliver(frame, header['droppable'])
+                    continue
+                if 'client_id' in header:
+                    key = (header['device_id'], header['client_id'])
+                    deliver = self.local_clients.get(key)
+                else:
+                    deliver = self.local_devices.get(header['device_id'])
+                if deliver:
+                    deliver(body.decode(), header.get('droppable', False))
+
+    def register_device(self, device_id, device_info, deliver):
+        # A duplicate must not replace the route of the registered device
+        if device_id in self.local_devices:
+            return False
+        if not self._call('register_device', device_id=device_id,
+                          device_info=device_info):
+            return False
+        self.local_devices[device_id] = deliver
+        return True
+
+    def unregister_device(self, device_id):
+        self.local_devices.pop(device_id, None)
+        self._send({"op": "unregister_device", "device_id": device_id})
+
+    def get_device_info(self, device_id):
+        return self._call('get_device_info', device_id=device_id)
+
+    def register_client(self, device_id, deliver):
+        client_id = self._call('register_client', device_id=device_id)
+        if client_id is not None:
+            self.local_clients[(device_id, client_id)] = deliver
+        return client_id
+
+    def unregister_client(self, device_id, client_id):
+        self.local_clients.pop((device_id, client_id), None)
+        self._send({"op": "unregister_client", "device_id": device_id,
+                    "client_id": client_id})
+
+    def send_to_device(self, device_id, frame, droppable=False):
+        deliver = self.local_devices.get(device_id)
+        if deliver:
+            deliver(frame, droppable)
+        else:
+            self._send({"op": "to_device", "device_id": device_id,
+                        "droppable": droppable}, frame.encode())
+        return True
+
+    def send_to_client(self, device_id, client_id, frame, droppable=False):
+        deliver = self.local_clients.get((device_id, client_id))
+        if deliver:
+            deliver(frame, droppable)
+        else:
+            self._send({"op": "to_client", "device_id": device_id,
+                        "client_id": client_id, "droppable": droppable},
+                       frame.encode())
+        return True
+
+    def send_to_clients(self, device_id, client_ids, frame, droppable=False):
+        """Sends the frame to the broker once, which passes it on once to
+           each worker holding recipients. The recipient count is unknown
+           here, so it is only returned when client_ids is given."""
+
+        self._send({"op": "to_clients", "device_id": device_id,
+                    "client_ids": client_ids, "droppable": droppable},
+                   frame.encode())
+        return len(client_ids) if client_ids is not None else None
+
+
+class BrokerServer:
+    """Broker process holding the registry shared by all workers"""
+
+    def __init__(self):
+        self.registry = InMemoryBroker()
+        self.client_workers = {} # (device_id, client_id) -> worker writer
+
+    async def handle_worker(self, reader, writer):
+        devices = set() # registered through this worker
+        clients = set()
+
+        def deliver_to(route):
+            return lambda frame, droppable: writer.write(
+                _encode(dict(route, droppable=droppable), frame))
+
+        def undeliverable(device_id, client_id=None):
+            writer.write(_encode({"op": "undeliverable", "device_id": device_id,
+                                  "client_id": client_id}))
+
+        def reply(header, result):
+            writer.write(_encode({"op": "reply", "req": header['req'],
+                                  "result": result}))
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                header = json.loads(line)
+                body = await reader.readexactly(header['length'])
+                op = header['op']
+                device_id = header.get('device_id')
+
+                if op == 'to_device':
+                    if not self.registry.send_to_device(
+                            device_id, body, header['droppable']):
+                        undeliverable(device_id)
+                elif op == 'to_client':
+                    client_id = header['client_id']
+                    if not self.registry.send_to_client(
+                            device_id, client_id, body, header['droppable']):
+                        undeliverable(device_id, client_id)
+                elif op == 'to_clients':
+                    client_ids = header['client_ids']
+                    if client_ids is None:
+                        client_ids = self.registry.client_ids(device_id)
+                    workers = collections.defaultdict(list)
+                    for client_id in client_ids:
+                        worker = self.client_workers.get((device_id, client_id))
+                        if worker:
+                            workers[worker].append(client_id)
+                    for worker, worker_client_ids in workers.items():
+                        worker.write(_encode({
+                            "op": "deliver", "device_id": device_id,
+                            "client_ids": worker_client_ids,
+                            "droppable": header['droppable']}, body))
+                elif op == 'register_device':
+                    route = {"op": "deliver", "device_id": device_id}
+                    registered = self.registry.register_device(
+                        device_id, header['device_info'], deliver_to(route))
+                    if registered:
+                        devices.add(device_id)
+                    reply(header, registered)
+                elif op == 'unregister_device':
+                    self.registry.unregister_device(device_id)
+                    devices.discard(device_id)
+                elif op == 'get_device_info':
+                    reply(header, self.registry.get_device_info(device_id))
+                elif op == 'register_client':
+                    # The route learns its client id once one is assigned
+                    route = {"op": "deliver", "device_id": device_id}
+                    client_id = self.registry.register_client(
+                        device_id, deliver_to(route))
+                    if client_id is not None:
+                        route['client_id'] = client_id
+                        clients.add((device_id, client_id))
+                        self.client_workers[(device_id, client_id)] = writer
+                    reply(header, client_id)
+                elif op == 'unregister_client':
+                    self.registry.unregister_client(device_id, header['client_id'])
+                    clients.discard((device_id, header['client_id']))
+                    self.client_workers.pop((device_id, header['client_id']), None)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # Connections of a dead worker are gone too
+            for device_id in devices:
+                self.registry.unregister_device(device_id)
+            for device_id, client_id in clients:
+                self.registry.unregister_client(device_id, client_id)
+                self.client_workers.pop((device_id, client_id), None)
+            writer.close()
+
+    async def serve(self, address):
+        kind, _, location = address.partition(':')
+        if kind == 'unix':
+            if os.path.exists(location):
+                os.remove(location)
+            server = await asyncio.start_unix_server(self.handle_worker, location)
+        else:
+            host, port = location.rsplit(':', 1)
+            server = await asyncio.start_server(self.handle_worker, host, int(port))
+        print(f'Broker listening on {address}')
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--address', dest='address', action='store',
+                        default='unix:/tmp/halyard-sig-broker.sock')
+    args = parser.parse_args()
+    asyncio.run(BrokerServer().serve(args.address))
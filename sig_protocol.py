@@ -0,0 +1,540 @@
+import collections
+import json
+import logging
+import random
+import re
+import time
+import weakref
+import sig_metrics
+from sig_broker import InMemoryBroker
+from timer_wheel import TimerWheel
+
+# Uses the fastest JSON backend installed
+try:
+    import orjson
+    json_loads = orjson.loads
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    try:
+        import ujson
+        json_loads = ujson.loads
+        json_dumps = ujson.dumps
+    except ImportError:
+        json_loads = json.loads
+        json_dumps = json.dumps
+
+# Device registry and routing, shared by all workers when sharded
+broker = InMemoryBroker()
+
+def set_broker(new_broker):
+    global broker
+    broker = new_broker
+
+SERVER_CONFIG = {"ice_servers": [{"urls":["stun:stun.l.google.com:19302"]}],
+                 "message_type": "config"}
+
+# Events are logged as JSON lines. Per message events are only logged at
+# debug level, and only for a sample of the messages.
+
+log = logging.getLogger('sig_server')
+LOG_SAMPLE_RATE = 0.01
+
+def configure_logging(sample_rate):
+    global LOG_SAMPLE_RATE
+    LOG_SAMPLE_RATE = float(sample_rate)
+
+def log_event(level, event, **fields):
+    if log.isEnabledFor(level):
+        log.log(level, json_dumps(dict(fields, event=event)))
+
+def log_sampled(event, **fields):
+    if log.isEnabledFor(logging.DEBUG) and random.random() < LOG_SAMPLE_RATE:
+        log.debug(json_dumps(dict(fields, event=event)))
+
+def send_error(msg):
+    log_event(logging.WARNING, 'error', error=msg)
+
+def report_undeliverable(device_id, client_id=None):
+    """Reports a frame the broker of a sharded server couldn't route"""
+
+    if client_id is None:
+        send_error(f'Device id {device_id} not registered.')
+    else:
+        send_error(f'Unregistered client id {client_id}.')
+
+
+metrics = sig_metrics.Registry()
+outboxes = weakref.WeakSet()
+
+REGISTRATIONS = metrics.counter('sig_registrations_total',
+    'Device registration requests', ['result'])
+CONNECTS = metrics.counter('sig_connects_total',
+    'Client requests to connect to a device', ['result'])
+FORWARDS = metrics.counter('sig_forwards_total',
+    'Forwarded messages', ['direction'])
+DEVICE_MESSAGES = metrics.counter('sig_device_messages_total',
+    'Messages forwarded to or from a device', ['device_id'])
+DEVICE_BYTES = metrics.counter('sig_device_bytes_total',
+    'Bytes forwarded to or from a device', ['device_id'])
+FORWARD_LATENCY = metrics.histogram('sig_forward_latency_seconds',
+    'Time from receiving a message to queuing it for its recipient', ['direction'])
+OUTBOX_WAIT = metrics.histogram('sig_outbox_wait_seconds',
+    'Time frames spend in outbound queues')
+OUTBOX_DROPS = metrics.counter('sig_outbox_drops_total',
+    'Frames dropped from full outbound queues', ['reason'])
+CONNECTIONS = metrics.gauge('sig_connections',
+    'Open websocket connections', ['kind'])
+BROADCAST_RECIPIENTS = metrics.histogram('sig_broadcast_recipients',
+    'Clients reached by a broadcast forward', buckets=[1, 2, 5, 10, 20, 50, 100, 200])
+EVICTIONS = metrics.counter('sig_idle_evictions_total',
+    'Connections closed after missing heartbeats', ['kind'])
+metrics.gauge('sig_outbox_frames', 'Frames waiting in outbound queues',
+    callback=lambda: {(): sum(len(outbox.frames) for outbox in list(outboxes))})
+metrics.gauge('sig_outbox_max_frames', 'Frames waiting in the longest outbound queue',
+    callback=lambda: {(): max((len(outbox.frames) for outbox in list(outboxes)), default=0)})
+
+def record_forward(direction, device_id, frame, received):
+    FORWARDS.inc(direction)
+    DEVICE_MESSAGES.inc(device_id)
+    DEVICE_BYTES.inc(device_id, amount=len(frame))
+    FORWARD_LATENCY.observe(time.perf_counter() - received, direction)
+
+def send_server_config(outbox):
+    config_json = json_dumps(SERVER_CONFIG)
+    outbox.put(config_json)
+
+def send_data_ws(outbox, data):
+    data_json = encode_message(data)
+    outbox.put(data_json)
+
+def is_ice_candidate(message):
+    """ICE candidates may be dropped when a connection falls behind"""
+
+    payload = message['payload']
+    return isinstance(payload, dict) and payload.get('type') == 'ice-candidate'
+
+
+# Frames are queued per websocket and written by a writer of their own,
+# so a slow peer only fills its own queue instead of blocking the sender.
+
+OUTBOX_SIZE = 256
+DROP_ICE = 'drop_ice' # drop the oldest queued ICE candidate on overflow
+DISCONNECT = 'disconnect'
+overflow_policy = DROP_ICE
+PING = object() # queued in place of a frame to send a websocket ping
+
+def configure_outbox(size, policy):
+    global OUTBOX_SIZE, overflow_policy
+    if policy not in (DROP_ICE, DISCONNECT):
+        raise ValueError(f'Unknown overflow policy: {policy}')
+    OUTBOX_SIZE = int(size)
+    overflow_policy = policy
+
+class Outbox:
+    """Bounded queue of frames waiting to be sent on a websocket.
+       Each backend drains it with a writer of its own."""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.frames = collections.deque() # (frame, droppable, queued) tuples
+        self.closed = False
+        outboxes.add(self)
+
+    def put(self, frame, droppable=False):
+        """Queues a frame, returns False if the connection was dropped"""
+
+        if self.closed:
+            return False
+        if len(self.frames) >= OUTBOX_SIZE and not self.make_room():
+            send_error('Outbound queue full, disconnecting.')
+            OUTBOX_DROPS.inc('disconnect')
+            self.abort()
+            return False
+        self.frames.append((frame, droppable, time.perf_counter()))
+        self.wake()
+        return True
+
+    def make_room(self):
+        if overflow_policy != DROP_ICE:
+            return False
+        for i, (_, droppable, _) in enumerate(self.frames):
+            if droppable:
+                del self.frames[i]
+                OUTBOX_DROPS.inc('ice')
+                return True
+        return False
+
+    def next_frame(self):
+        frame, _, queued = self.frames.popleft()
+        OUTBOX_WAIT.observe(time.perf_counter() - queued)
+        return frame
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        self.wake()
+
+    def wake(self):
+        """Signals the writer that frames are waiting"""
+        raise NotImplementedError
+
+    def abort(self):
+        """Drops the connection, which ends its receive loop too"""
+        raise NotImplementedError
+
+
+# Connections are pinged after PING_INTERVAL seconds without traffic and
+# evicted after IDLE_TIMEOUT, which also catches half-open TCP connections.
+# Checks are scheduled on a timer wheel, and traffic only updates a
+# timestamp, so each connection is checked about once per ping interval.
+
+PING_INTERVAL = 20
+IDLE_TIMEOUT = 60
+HEARTBEAT_TICK = 1
+
+def configure_heartbeat(ping_interval, idle_timeout):
+    global PING_INTERVAL, IDLE_TIMEOUT
+    PING_INTERVAL = float(ping_interval)
+    IDLE_TIMEOUT = float(idle_timeout)
+
+class Heartbeat:
+    """Pings quiet connections and evicts idle ones.
+       Backends call tick() every HEARTBEAT_TICK seconds once started."""
+
+    def __init__(self):
+        self.now = time.monotonic() # updated every tick
+        self.wheel = None
+
+    def watch(self, connection):
+        """Starts tracking traffic received on a connection"""
+
+        # Ticks only run once the first connection started them
+        self.now = time.monotonic()
+        if not self.wheel:
+            self.wheel = TimerWheel(HEARTBEAT_TICK,
+                                    max(PING_INTERVAL, IDLE_TIMEOUT), self.now)
+            self.start()
+        connection.last_activity = self.now
+        self.wheel.schedule(connection, PING_INTERVAL)
+
+    def forget(self, connection):
+        if self.wheel:
+            self.wheel.cancel(connection)
+
+    def touch(self, connection):
+        connection.last_activity = self.now
+
+    def tick(self):
+        self.now = time.monotonic()
+        for connection in self.wheel.advance(self.now):
+            self.check(connection)
+
+    def check(self, connection):
+        idle = self.now - connection.last_activity
+        if idle >= IDLE_TIMEOUT:
+            EVICTIONS.inc(connection.kind)
+            log_event(logging.INFO, 'idle_eviction', kind=connection.kind,
+                      device_id=connection.device_id, idle=round(idle, 1))
+            connection.outbox.abort()
+            return
+        if idle >= PING_INTERVAL:
+            connection.outbox.put(PING, droppable=True)
+            next_check = min(IDLE_TIMEOUT - idle, PING_INTERVAL)
+        else:
+            next_check = PING_INTERVAL - idle
+        self.wheel.schedule(connection, next_check)
+
+    def start(self):
+        raise NotImplementedError
+
+
+# Payloads of large messages (SDP offers and answers) are never decoded.
+# Only the message envelope is parsed and the raw payload text is spliced
+# into the outgoing message. Small messages like ICE candidates are cheaper
+# to decode fully.
+
+RAW_PAYLOAD_MIN_SIZE = 2048
+
+_decoder = json.JSONDecoder()
+_TOKEN = re.compile(r'["{}\[\]]')
+_WHITESPACE = re.compile(r'\s*')
+
+class RawPayload(str):
+    """Undecoded JSON text of a message payload"""
+
+def _string_end(raw, idx):
+    """Returns the index just past the JSON string starting at idx"""
+
+    pos = idx + 1
+    while True:
+        pos = raw.index('"', pos)
+        backslashes = 0
+        while raw[pos - backslashes - 1] == '\\':
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return pos + 1
+        pos += 1
+
+def _value_end(raw, idx):
+    """Returns the index just past the JSON value starting at idx"""
+
+    if raw[idx] == '"':
+        return _string_end(raw, idx)
+    if raw[idx] not in '{[':
+        return _decoder.raw_decode(raw, idx)[1]
+    closing = [] # closing brackets of the open objects and arrays
+    pos = idx
+    while True:
+        token = _TOKEN.search(raw, pos)
+        if token.group() == '"':
+            pos = _string_end(raw, token.start())
+            continue
+        if token.group() in '{[':
+            closing.append('}' if token.group() == '{' else ']')
+        elif closing.pop() != token.group():
+            raise ValueError('Mismatched bracket')
+        pos = token.end()
+        if not closing:
+            return pos
+
+def parse_message(raw):
+    """Decodes a message.
+       Large messages keep their payload as undecoded RawPayload text.
+       Messages the envelope parser rejects are decoded fully, so malformed
+       ones raise the decoder's error."""
+
+    if isinstance(raw, bytes):
+        raw = raw.decode()
+    if len(raw) < RAW_PAYLOAD_MIN_SIZE:
+        return json_loads(raw)
+    try:
+        message = {}
+        pos = _WHITESPACE.match(raw, 0).end()
+        if raw[pos] != '{':
+            return json_loads(raw)
+        pos = _WHITESPACE.match(raw, pos + 1).end()
+        expect_key = False
+        while expect_key or raw[pos] != '}':
+            if raw[pos] != '"':
+                raise ValueError('Expected key')
+            key, pos = json.decoder.scanstring(raw, pos + 1)
+            pos = _WHITESPACE.match(raw, pos).end()
+            if raw[pos] != ':':
+                raise ValueError('Expected colon')
+            pos = _WHITESPACE.match(raw, pos + 1).end()
+            if key == 'payload':
+                end = _value_end(raw, pos)
+                message[key] = RawPayload(raw[pos:end])
+            else:
+                message[key], end = _decoder.raw_decode(raw, pos)
+            pos = _WHITESPACE.match(raw, end).end()
+            expect_key = raw[pos] == ','
+            if expect_key:
+                pos = _WHITESPACE.match(raw, pos + 1).end()
+            elif raw[pos] != '}':
+                raise ValueError('Expected comma')
+        if _WHITESPACE.match(raw, pos + 1).end() != len(raw):
+            raise ValueError('Trailing data')
+        return message
+    except (IndexError, AttributeError, ValueError):
+        return json_loads(raw)
+
+def encode_message(message):
+    """Encodes a message, splicing RawPayload values in as they are"""
+
+    if not any(isinstance(value, RawPayload) for value in message.values()):
+        return json_dumps(message)
+    fields = []
+    for key, value in message.items():
+        encoded = value if isinstance(value, RawPayload) else json_dumps(value)
+        fields.append(f'{json_dumps(key)}: {encoded}')
+    return '{' + ', '.join(fields) + '}'
+
+class Client:
+    """Client class for users that connect to devices"""
+
+    kind = 'client'
+    broker_calls = ('connect',) # message types that wait for the broker
+    client_id = None
+    device_id = None
+    ws = None
+
+    def __init__(self, ws, outbox):
+        self.ws = ws
+        self.outbox = outbox
+        CONNECTIONS.inc(self.kind)
+
+    def deliver(self, frame, droppable=False):
+        """Queues a frame routed to this client by the broker"""
+        self.outbox.put(frame, droppable)
+
+    def send_device_info(self, device_info):
+        device_info_msg = {}
+        device_info_msg['message_type'] = 'device_info'
+        device_info_msg['device_info'] = device_info
+        send_data_ws(self.outbox, device_info_msg)
+
+    def handle_connect(self, message):
+        """Connects client user to device"""
+        
+        if 'device_id' not in message:
+            send_error('Missing device_id field.')
+            return
+
+        device_id = message['device_id']        
+        if self.client_id:
+            send_error('Attempt to connect to multiple devices over same websocket.')
+        else:
+            send_server_config(self.outbox)
+            device_info = broker.get_device_info(device_id)
+            client_id = None
+            if device_info is not None:
+                client_id = broker.register_client(device_id, self.deliver)
+            if client_id is None:
+                CONNECTS.inc('unknown_device')
+                send_error(f'Device id {device_id} not registered.')
+            else:
+                self.device_id = device_id
+                self.client_id = client_id
+                CONNECTS.inc('ok')
+                log_event(logging.INFO, 'client_connected',
+                          device_id=device_id, client_id=client_id)
+                self.send_device_info(device_info)
+
+    def handle_forward(self, message, received):
+        """Handle forward for client"""
+
+        if not self.client_id:
+            send_error('No device associated to client.')
+        elif 'payload' not in message:
+            send_error('Missing payload field.')
+        else:
+            client_msg = {}
+            client_msg['message_type'] = 'client_msg'
+            client_msg['client_id'] = self.client_id
+            client_msg['payload'] = message['payload']
+            frame = encode_message(client_msg)
+            if broker.send_to_device(self.device_id, frame, is_ice_candidate(message)):
+                record_forward('client_to_device', self.device_id, frame, received)
+                log_sampled('forward', direction='client_to_device',
+                            device_id=self.device_id, client_id=self.client_id)
+            else:
+                send_error(f'Device id {self.device_id} not registered.')
+
+    def process_request(self, message, received):
+        if 'message_type' not in message:
+            send_error('Missing field message_type')
+        elif message['message_type'] == 'connect':
+            self.handle_connect(message)
+        elif message['message_type'] == 'forward':
+            self.handle_forward(message, received)
+        else:
+            send_error(f'Unknown message type: {message["message_type"]}')
+
+    def close(self):
+        """Disconnects the client from its device"""
+
+        if self.client_id:
+            broker.unregister_client(self.device_id, self.client_id)
+            log_event(logging.INFO, 'client_disconnected',
+                      device_id=self.device_id, client_id=self.client_id)
+        CONNECTIONS.dec(self.kind)
+        self.outbox.close()
+
+
+BROADCAST = '*' # client_id of a forward to every client of the device
+
+class Device:
+
+    kind = 'device'
+    broker_calls = ('register',) # message types that wait for the broker
+    device_id = None
+    device_info = None
+
+    def __init__(self, ws, outbox):
+        self.ws = ws
+        self.outbox = outbox
+        CONNECTIONS.inc(self.kind)
+
+    def deliver(self, frame, droppable=False):
+        """Queues a frame routed to this device by the broker"""
+        self.outbox.put(frame, droppable)
+
+    def handle_registration(self, message):
+        """Registers device id and info in the broker and sends config"""
+
+        if 'device_id' not in message:
+            send_error('Missing device id in registration request')
+            return
+
+        device_id = message['device_id']
+        if 'device_info' not in message:
+            send_error('Missing device info in registration request.')
+        elif not broker.register_device(device_id, message['device_info'], self.deliver):
+            REGISTRATIONS.inc('duplicate')
+            send_error(f'Device with id {device_id} already exists.')
+        else:
+            self.device_id = device_id
+            self.device_info = message['device_info']
+            send_server_config(self.outbox)
+            REGISTRATIONS.inc('ok')
+            log_event(logging.INFO, 'device_registered', device_id=device_id)
+
+    def handle_forward(self, message, received):
+        """Handles forward for device"""
+
+        if 'client_id' not in message:
+            send_error('Missing client id in forward message.')
+        elif 'payload' not in message:
+            send_error('Missing payload field in forward message.')
+        else:
+            client_id = message['client_id']
+            device_msg = {}
+            device_msg['message_type'] = 'device_msg'
+            device_msg['payload'] = message['payload']
+            frame = encode_message(device_msg)
+            if client_id == BROADCAST or isinstance(client_id, list):
+                client_ids = None if client_id == BROADCAST else client_id
+                self.broadcast(client_ids, frame, is_ice_candidate(message), received)
+            elif broker.send_to_client(self.device_id, client_id, frame,
+                                       is_ice_candidate(message)):
+                record_forward('device_to_client', self.device_id, frame, received)
+                log_sampled('forward', direction='device_to_client',
+                            device_id=self.device_id, client_id=client_id)
+            else:
+                send_error(f'Unregistered client id {client_id}.')
+
+    def broadcast(self, client_ids, frame, droppable, received):
+        """Sends one encoded frame to the given clients, or all of them.
+           Each client's outbox applies its own overflow policy."""
+
+        recipients = broker.send_to_clients(self.device_id, client_ids, frame, droppable)
+        if recipients is not None:
+            BROADCAST_RECIPIENTS.observe(recipients)
+        record_forward('device_broadcast', self.device_id, frame, received)
+        log_sampled('forward', direction='device_broadcast',
+                    device_id=self.device_id, recipients=recipients)
+        if client_ids is not None and recipients is not None and recipients < len(client_ids):
+            send_error(f'Broadcast reached {recipients} of {len(client_ids)} clients.')
+
+    def process_request(self, message, received):
+        if 'message_type' not in message:
+            send_error('Missing field message_type')
+        elif message['message_type'] == 'register':
+            self.handle_registration(message)
+        elif message['message_type'] == 'forward':
+            self.handle_forward(message, received)
+        else:
+            send_error(f'Unknown message type: {message["message_type"]}')
+
+    def close(self):
+        """Removes the device from the registry"""
+
+        if self.device_id:
+            broker.unregister_device(self.device_id)
+            DEVICE_MESSAGES.remove(self.device_id)
+            DEVICE_BYTES.remove(self.device_id)
+            log_event(logging.INFO, 'device_unregistered', device_id=self.device_id)
+        CONNECTIONS.dec(self.kind)
+        self.outbox.close()
@@ -0,0 +1,130 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from websockets.asyncio.server import serve
+from sig_protocol import Client, Device, Heartbeat, Outbox, PING, HEARTBEAT_TICK
+from sig_protocol import metrics, parse_message
+
+# Signaling server on asyncio and the websockets library, without gevent.
+# It speaks the same protocol as sig_server.py through the same Client and
+# Device classes, and is selected with wsgi.py --backend=asyncio.
+
+class AsyncOutbox(Outbox):
+    """Outbox written by an asyncio task of its own"""
+
+    def __init__(self, ws):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.ready = asyncio.Event()
+        self.on_pong = None
+        super().__init__(ws)
+        self.writer = asyncio.ensure_future(self.write_loop())
+
+    def put(self, frame, droppable=False):
+        # The socket broker delivers frames from other workers on its own thread
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(Outbox.put, self, frame, droppable)
+            return True
+        return super().put(frame, droppable)
+
+    def wake(self):
+        self.ready.set()
+
+    async def write_loop(self):
+        while not self.closed:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.frames and not self.closed:
+                frame = self.next_frame()
+                try:
+                    if frame is PING:
+                        pong = await self.ws.ping()
+                        if self.on_pong:
+                            pong.add_done_callback(self.on_pong)
+                    else:
+                        await self.ws.send(frame)
+                except Exception:
+                    self.abort()
+
+    def abort(self):
+        self.close()
+        if self.ws.transport:
+            self.ws.transport.abort()
+
+class AsyncHeartbeat(Heartbeat):
+
+    def start(self):
+        asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_TICK)
+            self.tick()
+
+    def watch(self, connection):
+        super().watch(connection)
+        def pong_received(pong):
+            if not pong.cancelled() and not pong.exception():
+                self.touch(connection)
+        connection.outbox.on_pong = pong_received
+
+heartbeat = AsyncHeartbeat()
+
+# A sharded broker answers registrations and connects over a socket. They
+# wait for it on these threads, so the event loop keeps serving the other
+# connections meanwhile.
+BROKER_CALL_WORKERS = 16
+broker_calls = ThreadPoolExecutor(max_workers=BROKER_CALL_WORKERS,
+                                  thread_name_prefix='sig-broker-call')
+
+ROUTES = {'/register_device': Device, '/connect_client': Client}
+
+def process_request(ws, request):
+    """Answers plain HTTP requests, websocket upgrades go on to handle()"""
+
+    if request.path == '/metrics':
+        response = ws.respond(200, metrics.render())
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return response
+    if request.path not in ROUTES:
+        return ws.respond(404, 'Not Found\n')
+    return None
+
+async def handle(ws):
+    """Handles messages of a device or client until it disconnects"""
+
+    connection = ROUTES[ws.request.path](ws, AsyncOutbox(ws))
+    heartbeat.watch(connection)
+    try:
+        async for raw_message in ws:
+            heartbeat.touch(connection)
+            received = time.perf_counter()
+            message = parse_message(raw_message)
+            if isinstance(message, dict) and \
+                    message.get('message_type') in connection.broker_calls:
+                # Awaited, so the connection's messages stay in order
+                await asyncio.get_running_loop().run_in_executor(
+                    broker_calls, connection.process_request, message, received)
+            else:
+                connection.process_request(message, received)
+    except Exception:
+        pass
+    finally:
+        heartbeat.forget(connection)
+        connection.close()
+
+async def serve_forever(listener, metrics_port=0):
+    options = dict(process_request=process_request, max_size=None,
+                   compression=None, ping_interval=None)
+    if isinstance(listener, tuple):
+        server = await serve(handle, *listener, **options)
+    else:
+        server = await serve(handle, sock=listener, **options)
+    if metrics_port:
+        await serve(handle, '', metrics_port, **options)
+    await server.serve_forever()
+
+def run(listener, metrics_port=0):
+    """Serves on a (host, port) address or an already listening socket"""
+    asyncio.run(serve_forever(listener, metrics_port))
@@ -0,0 +1,346 @@
+import json
+import sqlite3
+import threading
+import time
+
+import halyard_utils as utils
+import inventory_cache as cache
+
+# The managers list and look up resources in the store when there is one,
+# filtering and paginating with SQL, and through the GCE API otherwise.
+
+# Resource kinds, named after the GCE APIs they are listed from
+INSTANCES = 'instances'
+DISKS = 'disks'
+IMAGES = 'images'
+KINDS = (INSTANCES, DISKS, IMAGES)
+
+# Writes through the inventory cache make the reconciler resync the kind
+CACHE_KINDS = {cache.NODES: INSTANCES, cache.VOLUMES: DISKS, cache.IMAGES: IMAGES}
+
+RECONCILE_INTERVAL = 60 # seconds between full reconciliations
+NAME_PREFIX = 'halyard' # resources the store keeps
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS instances (
+    name TEXT PRIMARY KEY,
+    zone TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    boot_disk TEXT,
+    creation_timestamp TEXT,
+    public_ips TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    pool_state TEXT,
+    startup_script INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS instances_zone ON instances (zone, name);
+CREATE INDEX IF NOT EXISTS instances_user ON instances (user_id, zone);
+
+CREATE TABLE IF NOT EXISTS disks (
+    name TEXT PRIMARY KEY,
+    zone TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    source_image TEXT,
+    creation_timestamp TEXT,
+    labels TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS disks_zone ON disks (zone, name);
+CREATE INDEX IF NOT EXISTS disks_user ON disks (user_id, zone);
+
+CREATE TABLE IF NOT EXISTS images (
+    name TEXT PRIMARY KEY,
+    family TEXT,
+    creation_timestamp TEXT,
+    disk_size_gb TEXT,
+    deprecated INTEGER NOT NULL,
+    labels TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_family ON images (family, name);
+
+CREATE TABLE IF NOT EXISTS syncs (
+    kind TEXT PRIMARY KEY,
+    synced REAL NOT NULL
+);
+'''
+
+store = None
+
+
+def basename(url):
+    return url.rsplit('/', 1)[-1] if url else None
+
+def instance_row(item):
+    boot_disks = [basename(disk.get('source'))
+                  for disk in item.get('disks', []) if disk.get('boot')]
+    metadata = (item.get('metadata') or {}).get('items', [])
+    labels = item.get('labels', {})
+    return {"name": item['name'],
+            "zone": basename(item['zone']),
+            "user_id": utils.instance_user_id(item),
+            "boot_disk": boot_disks[0] if boot_disks else None,
+            "creation_timestamp": item.get('creationTimestamp'),
+            "public_ips": json.dumps(utils.get_public_ips(item)),
+            "labels": json.dumps(labels),
+            "pool_state": labels.get(utils.STATE_LABEL),
+            "startup_script": any(entry.get('key') == 'startup-script'
+                                  for entry in metadata),
+            "fingerprint": '/'.join([item.get('status', ''),
+                                     item.get('labelFingerprint', ''),
+                                     (item.get('metadata') or {}).get('fingerprint', ''),
+                                     json.dumps(utils.get_public_ips(item))])}
+
+def disk_row(item):
+    return {"name": item['name'],
+            "zone": basename(item['zone']),
+            "user_id": utils.user_id_from_name(item['name'], utils.USER_DISK_PREFIX),
+            "source_image": basename(item.get('sourceImage')),
+            "creation_timestamp": item.get('creationTimestamp'),
+            "labels": json.dumps(item.get('labels', {})),
+            "fingerprint": '/'.join([item.get('status', ''),
+                                     item.get('labelFingerprint', ''),
+                                     item.get('sizeGb', '')])}
+
+def image_row(item):
+    deprecated = item.get('deprecated', {})
+    return {"name": item['name'],
+            "family": item.get('family'),
+            "creation_timestamp": item.get('creationTimestamp'),
+            "disk_size_gb": item.get('diskSizeGb'),
+            "deprecated": bool(deprecated),
+            "labels": json.dumps(item.get('labels', {})),
+            "fingerprint": '/'.join([item.get('status', ''),
+                                     item.get('labelFingerprint', ''),
+                                     deprecated.get('state', '')])}
+
+ROWS = {INSTANCES: instance_row, DISKS: disk_row, IMAGES: image_row}
+
+
+class StateStore:
+    """Local SQLite copy of halyard instances, disks and images.
+       A background reconciler lists every kind page by page and writes
+       only the rows whose GCE fingerprints changed, so list and get
+       requests are answered by indexed queries instead of cloud scans."""
+
+    def __init__(self, driver, path, reconcile_interval=RECONCILE_INTERVAL):
+        self.driver = driver
+        self.path = path
+        self.reconcile_interval = reconcile_interval
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.dirty = set() # kinds written since their last sync
+        self.reconciles = {kind: 0 for kind in KINDS}
+        self.writes = {kind: 0 for kind in KINDS}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def start(self):
+        # A store left by a previous run answers right away, a new one
+        # waits for its first reconciliation
+        if self.synced():
+            self.dirty.update(KINDS)
+            self._wake.set()
+        else:
+            self.reconcile()
+        cache.on_invalidate(self.changed)
+        threading.Thread(target=self._run, name='state-store', daemon=True).start()
+
+    def _run(self):
+        next_full = time.monotonic() + self.reconcile_interval
+        while True:
+            self._wake.wait(max(next_full - time.monotonic(), 0))
+            self._wake.clear()
+            with self._lock:
+                kinds, self.dirty = self.dirty, set()
+            if time.monotonic() >= next_full:
+                kinds = set(KINDS)
+                next_full = time.monotonic() + self.reconcile_interval
+            try:
+                self.reconcile(kinds)
+            except Exception as e:
+                print(f'State reconciliation failed: {e}')
+
+    def changed(self, cache_kinds):
+        kinds = {CACHE_KINDS[kind] for kind in cache_kinds if kind in CACHE_KINDS}
+        if kinds:
+            with self._lock:
+                self.dirty.update(kinds)
+            self._wake.set()
+
+    def reconcile(self, kinds=KINDS):
+        for kind in kinds:
+            self._sync(kind)
+
+    def _sync(self, kind):
+        """Applies a listing of kind to its table.
+           Rows are written only when their fingerprint changed, and rows
+           missing from the listing are dropped unless they were written
+           after the listing started."""
+
+        started = time.time()
+        with self._lock:
+            known = dict(self.db.execute(f'SELECT name, fingerprint FROM {kind}'))
+
+        to_row = ROWS[kind]
+        zone = None if kind == IMAGES else 'all'
+        filter_expr = utils.gce_filter(name=utils.prefix_pattern(NAME_PREFIX))
+        pages = utils.iter_pages(lambda max_results, page_token: utils.list_page(
+            self.driver, kind, filter_expr, zone, max_results, page_token))
+
+        seen = set()
+        written = 0
+        for items, _ in pages:
+            rows = [to_row(item) for item in items]
+            seen.update(row['name'] for row in rows)
+            changed = [row for row in rows if known.get(row['name']) != row['fingerprint']]
+            if changed:
+                self._put(kind, changed, started)
+                written += len(changed)
+
+        gone = [name for name in known if name not in seen]
+        with self._lock, self.db:
+            for name in gone:
+                self.db.execute(f'DELETE FROM {kind} WHERE name = ? AND updated < ?',
+                                (name, started))
+            self.db.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?)', (kind, started))
+            self.reconciles[kind] += 1
+            self.writes[kind] += written + len(gone)
+
+    def _put(self, kind, rows, updated):
+        columns = list(rows[0]) + ['updated']
+        statement = (f'INSERT OR REPLACE INTO {kind} ({", ".join(columns)}) '
+                     f'VALUES ({", ".join("?" * len(columns))})')
+        with self._lock, self.db:
+            self.db.executemany(statement,
+                                [list(row.values()) + [updated] for row in rows])
+
+    def delete(self, kind, name):
+        """Drops a resource halyard deleted, ahead of the next listing"""
+
+        with self._lock, self.db:
+            self.db.execute(f'DELETE FROM {kind} WHERE name = ?', (name,))
+
+    def synced(self):
+        with self._lock:
+            kinds = {row[0] for row in self.db.execute('SELECT kind FROM syncs')}
+        return kinds >= set(KINDS)
+
+    def _query(self, sql, params):
+        with self._lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def _page(self, sql, params, table, prefix, zone, max_results, page_token):
+        """Runs a keyset paginated query over names starting with prefix.
+           params are those of the placeholders after {conditions} in sql.
+           The page token is the last name of the previous page."""
+
+        conditions = [f'{table}.name >= ?', f'{table}.name < ?']
+        condition_params = [prefix, prefix + '\uffff']
+        if page_token:
+            conditions.append(f'{table}.name > ?')
+            condition_params.append(page_token)
+        if zone != 'all' and table != 'images':
+            conditions.append(f'{table}.zone = ?')
+            condition_params.append(zone or self.driver.zone.name)
+        sql = sql.replace('{conditions}', ' AND '.join(conditions))
+        rows = self._query(f'{sql} ORDER BY {table}.name LIMIT ?',
+                           condition_params + list(params) + [max_results + 1])
+        if len(rows) > max_results:
+            return rows[:max_results], rows[max_results - 1]['name']
+        return rows, None
+
+    def instances(self, prefix, zone=None, max_results=utils.PAGE_SIZE, page_token=None):
+        """Page of instances, without idle warm pool hosts"""
+
+        rows, next_page_token = self._page(
+            '''SELECT instances.*, disks.source_image AS image FROM instances
+               LEFT JOIN disks ON disks.name = instances.boot_disk
+               WHERE {conditions} AND IFNULL(instances.pool_state, '') != 'idle' ''',
+            [], 'instances', prefix, zone, max_results, page_token)
+        return [self._instance(row) for row in rows], next_page_token
+
+    def instance(self, name):
+        """Description of an instance with its zone and whether it has a
+           startup script, or None"""
+
+        rows = self._query(
+            '''SELECT instances.*, disks.source_image AS image FROM instances
+               LEFT JOIN disks ON disks.name = instances.boot_disk
+               WHERE instances.name = ?''', [name])
+        if not rows:
+            return None
+        return dict(self._instance(rows[0]), zone=rows[0]['zone'],
+                    startup_script=bool(rows[0]['startup_script']))
+
+    def _instance(self, row):
+        return {"name": row['name'],
+                "creationTimestamp": row['creation_timestamp'],
+                "image": row['image'],
+                "public_ips": json.loads(row['public_ips'])}
+
+    def disks(self, prefix, zone=None, max_results=utils.PAGE_SIZE, page_token=None):
+        rows, next_page_token = self._page(
+            'SELECT name FROM disks WHERE {conditions}',
+            [], 'disks', prefix, zone, max_results, page_token)
+        return [{"name": row['name']} for row in rows], next_page_token
+
+    def stopped_disks(self, prefix, zone=None, max_results=utils.PAGE_SIZE, page_token=None):
+        """Page of user disks no instance of their user runs in their zone"""
+
+        rows, next_page_token = self._page(
+            '''SELECT name FROM disks WHERE {conditions} AND NOT EXISTS (
+                   SELECT 1 FROM instances WHERE instances.user_id = disks.user_id
+                   AND instances.zone = disks.zone AND instances.name >= ?
+                   AND instances.name < ?)''',
+            [utils.INSTANCE_PREFIX, utils.INSTANCE_PREFIX + '\uffff'],
+            'disks', prefix, zone, max_results, page_token)
+        return [{"name": row['name']} for row in rows], next_page_token
+
+    def images(self, prefix, family=None, max_results=utils.PAGE_SIZE, page_token=None):
+        sql = 'SELECT name FROM images WHERE {conditions} AND NOT deprecated'
+        params = []
+        if family:
+            sql += ' AND family = ?'
+            params.append(family)
+        rows, next_page_token = self._page(
+            sql, params, 'images', prefix, None, max_results, page_token)
+        return [{"name": row['name']} for row in rows], next_page_token
+
+    def image(self, name):
+        rows = self._query('SELECT * FROM images WHERE name = ?', [name])
+        if not rows:
+            return None
+        return {"name": rows[0]['name'],
+                "creationTimestamp": rows[0]['creation_timestamp'],
+                "family": rows[0]['family'],
+                "diskSizeGb": rows[0]['disk_size_gb']}
+
+    def stats(self):
+        with self._lock:
+            counts = {kind: self.db.execute(f'SELECT COUNT(*) FROM {kind}').fetchone()[0]
+                      for kind in KINDS}
+            synced = dict(self.db.execute('SELECT kind, synced FROM syncs'))
+            return {"path": self.path,
+                    "rows": counts,
+                    "synced": synced,
+                    "reconciles": dict(self.reconciles),
+                    "writes": dict(self.writes),
+                    "pending": sorted(self.dirty)}
+
+
+def configure(driver, path, reconcile_interval=RECONCILE_INTERVAL):
+    global store
+    store = StateStore(driver, path, int(reconcile_interval))
+    store.start()
+    return store
+
+def delete(kind, name):
+    if store:
+        store.delete(kind, name)
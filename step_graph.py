@@ -0,0 +1,111 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Steps of one graph running at once. Each graph has workers of its own,
+# so steps that block for long, like waiting for an instance to boot,
+# don't hold up the steps of other graphs.
+MAX_WORKERS = 4
+
+
+class StepGraph:
+    """Runs the steps of an operation as soon as the steps they depend on
+       finished. Steps are submitted from completion callbacks, so no
+       worker blocks waiting for another step.
+       The start and end of every step are recorded relative to the
+       creation of the graph. Call close() once the graph is done."""
+
+    def __init__(self, executor=None, max_workers=MAX_WORKERS):
+        self._owns_executor = not executor
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='halyard-step')
+        self.origin = time.monotonic()
+        self.steps = {} # name -> Future
+        self.after = {} # name -> names of the steps it depends on
+        self.times = {} # name -> (start, end)
+        self._lock = threading.Lock()
+
+    def add(self, name, func, after=()):
+        """Adds a step called with the results of the steps in after.
+           A step fails without running when one of them failed."""
+
+        future = Future()
+        deps = [self.steps[dep] for dep in after]
+        self.steps[name] = future
+        self.after[name] = list(after)
+        remaining = [len(deps)]
+        settled = [False] # whether the step ran or failed already
+
+        def run():
+            start = time.monotonic()
+            try:
+                result = func(*[dep.result() for dep in deps])
+            except BaseException as e:
+                self._record(name, start)
+                future.set_exception(e)
+            else:
+                self._record(name, start)
+                future.set_result(result)
+
+        def dep_done(dep):
+            error = dep.exception()
+            with self._lock:
+                remaining[0] -= 1
+                if settled[0] or (not error and remaining[0]):
+                    return
+                settled[0] = True
+            if error:
+                future.set_exception(error)
+            else:
+                self.executor.submit(run)
+
+        if deps:
+            for dep in deps:
+                dep.add_done_callback(dep_done)
+        else:
+            self.executor.submit(run)
+        return future
+
+    def result(self, name):
+        return self.steps[name].result()
+
+    def wait(self):
+        """Waits until every step added so far finished or failed"""
+
+        for future in list(self.steps.values()):
+            try:
+                future.result()
+            except BaseException:
+                pass
+
+    def close(self):
+        """Waits for every step, then stops the workers of the graph"""
+
+        self.wait()
+        if self._owns_executor:
+            self.executor.shutdown(wait=False)
+
+    def _record(self, name, start):
+        with self._lock:
+            self.times[name] = (start - self.origin, time.monotonic() - self.origin)
+
+    def timings(self):
+        """Start and duration in seconds of every step that ran"""
+
+        with self._lock:
+            return {name: {"start": round(start, 3), "duration": round(end - start, 3)}
+                    for name, (start, end) in sorted(self.times.items(), key=lambda t: t[1])}
+
+    def critical_path(self, name):
+        """Steps that determined when the given step could finish"""
+
+        with self._lock:
+            times = dict(self.times)
+        path = []
+        while name in times:
+            path.append(name)
+            deps = [dep for dep in self.after[name] if dep in times]
+            if not deps:
+                break
+            name = max(deps, key=lambda dep: times[dep][1])
+        return path[::-1]
@@ -0,0 +1,51 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+import halyard_utils as utils
+import remote_exec
+
+
+class ReadyProber:
+
+    def watch(self, instance_name, zone, timeout):
+        future = Future()
+        future.set_result('10.0.0.2')
+        return future
+
+
+class WaitForInstanceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logins = 0
+        patches = [
+            mock.patch.object(utils.readiness_prober, 'get_prober',
+                              lambda driver: ReadyProber()),
+            mock.patch.object(utils.remote_exec, 'run', self.login),
+            mock.patch.object(utils, 'LOGIN_INTERVAL', 0.01),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def login(self, instance_name, zone, command):
+        self.logins += 1
+        if self.logins <= self.failed_logins:
+            raise remote_exec.RemoteExecError('Permission denied (publickey)')
+        return remote_exec.CommandResult(command, 0, '', '')
+
+    def test_logins_are_retried_until_keys_are_installed(self):
+        self.failed_logins = 3
+        self.assertEqual(utils.wait_for_instance(None, 'halyard-a', 'zone'), '10.0.0.2')
+        self.assertEqual(self.logins, 4)
+
+    def test_logins_stop_at_the_deadline(self):
+        self.failed_logins = float('inf')
+        with self.assertRaises(utils.HalyardError):
+            utils.wait_for_instance(None, 'halyard-a', 'zone', timeout=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
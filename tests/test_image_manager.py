@@ -0,0 +1,157 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import copy
+import unittest
+from unittest import mock
+
+import halyard_utils as utils
+from image import image_manager
+
+ZONE = 'europe-west4-a'
+
+
+class PreconditionFailed(Exception):
+    """What GCE answers a setLabels call with a stale fingerprint"""
+
+
+class Resource:
+
+    def __init__(self, name, **extra):
+        self.name = name
+        self.state = 'running'
+        self.extra = extra
+
+
+class FakeDriver:
+    """Keeps disks, instances and images in memory. Like GCE, labels can
+       only be set with the disk's current label fingerprint."""
+
+    def __init__(self):
+        self.disks = {}
+        self.nodes = {}
+        self.images = {}
+        self.created_nodes = 0
+
+    def ex_get_volume(self, name, zone):
+        # Every lookup returns a new object, like the GCE API
+        return copy.deepcopy(self.disks[name])
+
+    def ex_get_node(self, name, zone):
+        return self.nodes[name]
+
+    def ex_get_accelerator_type(self, gpu_type, zone=None):
+        return gpu_type
+
+    def ex_get_image(self, name):
+        return self.images[name]
+
+    def create_volume(self, size, name, location=None, ex_image_family=None):
+        self.disks[name] = Resource(name, labels={}, labelFingerprint='0')
+        return copy.deepcopy(self.disks[name])
+
+    def create_node(self, name, size, image, **kwargs):
+        self.created_nodes += 1
+        self.nodes[name] = Resource(name, disks=[])
+        return self.nodes[name]
+
+    def attach_volume(self, node, volume):
+        node.extra['disks'].append({'source': f'zones/{ZONE}/disks/{volume.name}'})
+
+    def ex_set_volume_labels(self, volume, labels):
+        disk = self.disks[volume.name]
+        if volume.extra['labelFingerprint'] != disk.extra['labelFingerprint']:
+            raise PreconditionFailed(f'Labels fingerprint of {volume.name} is stale')
+        disk.extra['labels'] = dict(labels)
+        disk.extra['labelFingerprint'] = str(int(disk.extra['labelFingerprint']) + 1)
+
+    def ex_create_image(self, name, volume, ex_licenses=None, family=None):
+        if name in self.images:
+            raise Exception(f'Image {name} already exists')
+        self.images[name] = Resource(name, family=family)
+
+    def ex_delete_image(self, image):
+        del self.images[image.name]
+
+    def destroy_node(self, node):
+        del self.nodes[node.name]
+
+    def destroy_volume(self, volume):
+        del self.disks[volume.name]
+
+
+class BuildBaseImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = FakeDriver()
+        self.phases = []
+        self.commands = []
+        self.failing = set() # commands containing these fail once
+
+        save_checkpoint = image_manager.save_checkpoint
+        def record(driver, image_disk, zone, key, phase, *args):
+            checkpoint = save_checkpoint(driver, image_disk, zone, key, phase, *args)
+            self.phases.append(phase)
+            return checkpoint
+
+        patches = [
+            mock.patch.object(image_manager, 'save_checkpoint', record),
+            mock.patch.object(image_manager.os, 'system', self.system),
+            mock.patch.object(image_manager, 'get_dest_names', lambda *args: {
+                'dest_image': 'halyard-test-image', 'dest_family': 'halyard-test'}),
+            mock.patch.object(utils, 'wait_for_instance', lambda *args: True),
+            mock.patch.object(image_manager.artifact_cache, 'store', None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def system(self, command):
+        self.commands.append(command)
+        for name in list(self.failing):
+            if name in command:
+                self.failing.discard(name)
+                return 1
+        return 0
+
+    def build(self):
+        return image_manager.build_base_image(self.driver, build_zone=ZONE)
+
+    def test_runs_all_phases(self):
+        result = self.build()
+
+        self.assertEqual(self.phases, image_manager.BUILD_PHASES)
+        self.assertEqual(result['name'], 'halyard-test-image')
+        self.assertIn('halyard-test-image', self.driver.images)
+        self.assertEqual(self.driver.disks, {})
+
+    def test_resumes_after_failed_build(self):
+        self.failing.add('./create_base_image_gce.sh')
+        with self.assertRaises(utils.HalyardError):
+            self.build()
+        self.assertEqual(self.phases, ['create_build_instance'])
+
+        result = self.build()
+        self.assertEqual(self.phases, image_manager.BUILD_PHASES)
+        self.assertEqual(self.driver.created_nodes, 1)
+        self.assertEqual(result['name'], 'halyard-test-image')
+
+    def test_resumes_after_failed_image_creation(self):
+        create_image = self.driver.ex_create_image
+        def fail_once(*args, **kwargs):
+            self.driver.ex_create_image = create_image
+            raise Exception('Operation failed')
+        self.driver.ex_create_image = fail_once
+
+        with self.assertRaises(Exception):
+            self.build()
+        self.assertEqual(self.phases, ['create_build_instance', 'build_image'])
+
+        builds = sum('./create_base_image_gce.sh' in command for command in self.commands)
+        self.build()
+        self.assertEqual(self.phases[-1], 'create_image')
+        self.assertEqual(builds, sum('./create_base_image_gce.sh' in command
+                                     for command in self.commands))
+
+
+if __name__ == '__main__':
+    unittest.main()
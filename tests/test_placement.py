@@ -0,0 +1,84 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import unittest
+from unittest import mock
+
+import placement
+
+
+class TryZonesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.attempts = []
+        self.cleaned = []
+
+    def attempt(self, full_zones):
+        def attempt(zone):
+            self.attempts.append(zone)
+            if zone in full_zones:
+                raise Exception(f'ZONE_RESOURCE_POOL_EXHAUSTED in {zone}')
+            return {"name": f'host-{zone}'}
+        return attempt
+
+    def test_next_zone_is_tried_after_capacity_error(self):
+        zone, result = placement.try_zones(['a', 'b', 'c'], self.attempt({'a'}),
+                                           self.cleaned.append, 16)
+        self.assertEqual((zone, result), ('b', {"name": 'host-b'}))
+        self.assertEqual(self.attempts, ['a', 'b'])
+        self.assertEqual(self.cleaned, ['a'])
+
+    def test_last_capacity_error_is_raised(self):
+        with self.assertRaises(Exception):
+            placement.try_zones(['a', 'b'], self.attempt({'a', 'b'}),
+                                self.cleaned.append, 16)
+        self.assertEqual(self.cleaned, ['a'])
+
+    def test_other_errors_are_raised_at_once(self):
+        def attempt(zone):
+            raise ValueError('bad request')
+        with self.assertRaises(ValueError):
+            placement.try_zones(['a', 'b'], attempt, self.cleaned.append, 16)
+        self.assertEqual(self.cleaned, [])
+
+
+class ReservationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = placement.PlacementScheduler(None, ['r1-a', 'r1-b', 'r2-a'])
+        self.scheduler.quotas = {'r1': {'CPUS': 64}, 'r2': {'CPUS': 32}}
+        patch = mock.patch.object(placement, 'scheduler', self.scheduler)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_concurrent_placements_spread_across_zones(self):
+        zones = [self.scheduler.reserve(self.scheduler.zones, 16)[0] for _ in range(4)]
+        self.assertEqual(zones, ['r1-a', 'r1-b', 'r2-a', 'r1-a'])
+
+    def test_full_zones_are_no_candidates_while_reserved(self):
+        reservations = [self.scheduler.reserve(['r2-a'], 16)[1] for _ in range(2)]
+        self.assertEqual(placement.place(16, zones=['r2-a']), [])
+        self.scheduler.release(reservations[0])
+        self.assertEqual(placement.place(16, zones=['r2-a']), ['r2-a'])
+
+    def test_reservations_last_while_attempts_run(self):
+        reserved = []
+        def attempt(zone):
+            reserved.append(dict(self.scheduler.stats()['reserved']))
+            if zone == 'r1-a':
+                raise Exception('ZONE_RESOURCE_POOL_EXHAUSTED')
+            return zone
+        zone, _ = placement.try_zones(['r1-a', 'r2-a'], attempt, lambda zone: None, 16)
+
+        self.assertEqual(zone, 'r2-a')
+        self.assertEqual(reserved, [{'r1-a': 1}, {'r2-a': 1}])
+        self.assertEqual(self.scheduler.reservations, {})
+        self.assertIn('r1-a', self.scheduler.stats()['cooling_down'])
+
+    def test_preferred_zone_is_tried_first(self):
+        zone, _ = placement.try_zones(['r1-a', 'r2-a'], lambda zone: zone,
+                                      lambda zone: None, 16, preferred='r2-a')
+        self.assertEqual(zone, 'r2-a')
+
+
+if __name__ == '__main__':
+    unittest.main()
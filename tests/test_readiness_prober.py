@@ -0,0 +1,98 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import socket
+import threading
+import unittest
+from unittest import mock
+
+from libcloud.compute.types import NodeState
+
+import readiness_prober
+from readiness_prober import InstanceNotReady, ReadinessProber
+
+
+class Node:
+
+    def __init__(self, address):
+        self.state = NodeState.RUNNING
+        self.public_ips = [address]
+        self.private_ips = []
+
+
+class FakeDriver:
+    """Answers node lookups with the address registered for an instance.
+       Lookups of instances in blocked wait until they are released."""
+
+    def __init__(self):
+        self.addresses = {}
+        self.blocked = {}
+
+    def ex_get_node(self, name, zone):
+        if name in self.blocked:
+            self.blocked[name].wait()
+        return Node(self.addresses[name])
+
+
+class ReadinessProberTest(unittest.TestCase):
+
+    def setUp(self):
+        # Stands in for the SSH port of every instance
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(16)
+        self.addCleanup(self.server.close)
+        threading.Thread(target=self.serve_banners, daemon=True).start()
+        port = mock.patch.object(readiness_prober, 'SSH_PORT',
+                                 self.server.getsockname()[1])
+        port.start()
+        self.addCleanup(port.stop)
+        self.driver = FakeDriver()
+        self.prober = ReadinessProber(self.driver)
+
+    def serve_banners(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            conn.sendall(b'SSH-2.0-OpenSSH_8.4\r\n')
+            conn.close()
+
+    def test_ready_instance_resolves_with_its_address(self):
+        self.driver.addresses['halyard-a'] = '127.0.0.1'
+        future = self.prober.watch('halyard-a', 'zone', timeout=10)
+        self.assertEqual(future.result(10), '127.0.0.1')
+
+    def test_slow_node_lookup_does_not_stall_others(self):
+        self.driver.addresses['halyard-slow'] = '127.0.0.1'
+        self.driver.addresses['halyard-fast'] = '127.0.0.1'
+        release = self.driver.blocked['halyard-slow'] = threading.Event()
+        self.addCleanup(release.set)
+        slow = self.prober.watch('halyard-slow', 'zone', timeout=10)
+        fast = self.prober.watch('halyard-fast', 'zone', timeout=10)
+
+        self.assertEqual(fast.result(5), '127.0.0.1')
+        self.assertFalse(slow.done())
+        release.set()
+        self.assertEqual(slow.result(5), '127.0.0.1')
+
+    def test_probe_error_fails_only_its_instance(self):
+        self.driver.addresses['halyard-bad'] = 'not an address'
+        self.driver.addresses['halyard-good'] = '127.0.0.1'
+        bad = self.prober.watch('halyard-bad', 'zone', timeout=10)
+        with self.assertRaises(InstanceNotReady):
+            bad.result(5)
+
+        good = self.prober.watch('halyard-good', 'zone', timeout=10)
+        self.assertEqual(good.result(5), '127.0.0.1')
+
+    def test_unreachable_instance_fails_at_its_deadline(self):
+        # Nothing listens on this address
+        self.driver.addresses['halyard-down'] = '127.0.0.2'
+        future = self.prober.watch('halyard-down', 'zone', timeout=1)
+        with self.assertRaises(InstanceNotReady):
+            future.result(5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import shutil
+import subprocess
+import unittest
+from unittest import mock
+
+import remote_exec
+
+
+class StubTransport:
+    """Runs scripts with a local shell instead of SSH"""
+
+    instances = []
+
+    def __init__(self, instance_name, zone, idle_timeout=remote_exec.IDLE_TIMEOUT):
+        self.instance_name = instance_name
+        self.zone = zone
+        self.opens = 0
+        self.runs = 0
+        self.closed = False
+        self.alive = False
+        StubTransport.instances.append(self)
+
+    def open(self):
+        self.opens += 1
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def run(self, script, timeout=remote_exec.COMMAND_TIMEOUT):
+        self.runs += 1
+        result = subprocess.run(['bash', '-s'], input=script,
+                                capture_output=True, text=True, timeout=timeout)
+        return result.returncode, result.stdout, result.stderr
+
+    def close(self):
+        self.closed = True
+        self.alive = False
+
+
+class SessionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        StubTransport.instances = []
+        self.pool = remote_exec.SessionPool(StubTransport)
+
+    def test_reuses_connection(self):
+        self.pool.run('halyard-a', 'zone-a', 'true')
+        self.pool.run('halyard-a', 'zone-a', 'true')
+        self.pool.run('halyard-b', 'zone-a', 'true')
+
+        first, second = StubTransport.instances
+        self.assertEqual((first.opens, first.runs), (1, 2))
+        self.assertEqual((second.opens, second.runs), (1, 1))
+
+    def test_reopens_dropped_connection(self):
+        self.pool.run('halyard-a', 'zone-a', 'true')
+        transport = StubTransport.instances[0]
+        transport.alive = False
+        self.pool.run('halyard-a', 'zone-a', 'true')
+        self.assertEqual(transport.opens, 2)
+        self.assertEqual(len(StubTransport.instances), 1)
+
+    def test_batch_results(self):
+        results = self.pool.run_batch('halyard-a', 'zone-a',
+            ['echo one', 'echo two >&2; exit 3', 'echo three'])
+
+        self.assertEqual(len(results), 2)
+        self.assertEqual((results[0].exit_code, results[0].stdout), (0, 'one\n'))
+        self.assertEqual((results[1].exit_code, results[1].stderr), (3, 'two\n'))
+        self.assertEqual(StubTransport.instances[0].runs, 1)
+
+    def test_batch_without_stop_on_error(self):
+        results = self.pool.run_batch('halyard-a', 'zone-a',
+            ['false', 'printf no-newline'], stop_on_error=False)
+        self.assertEqual([result.exit_code for result in results], [1, 0])
+        self.assertEqual(results[1].stdout, 'no-newline')
+
+    def test_close_and_reap(self):
+        self.pool.run('halyard-a', 'zone-a', 'true')
+        self.pool.close('halyard-a', 'zone-a')
+        self.assertTrue(StubTransport.instances[0].closed)
+
+        self.pool.idle_timeout = 0
+        self.pool.run('halyard-a', 'zone-a', 'true')
+        self.pool.reap_idle()
+        self.assertTrue(StubTransport.instances[1].closed)
+        self.pool.run('halyard-a', 'zone-a', 'true')
+        self.assertEqual(len(StubTransport.instances), 3)
+
+
+class ControlDirTest(unittest.TestCase):
+
+    def setUp(self):
+        patch = mock.patch.object(remote_exec.GcloudSSHTransport, '_control_dir', None)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_control_dir_created_on_first_connection(self):
+        transport = remote_exec.GcloudSSHTransport('halyard-a', 'zone-a')
+        self.assertIsNone(remote_exec.GcloudSSHTransport._control_dir)
+        control_dir = os.path.dirname(transport.control_path)
+        self.addCleanup(shutil.rmtree, control_dir, ignore_errors=True)
+        self.assertTrue(os.path.isdir(control_dir))
+        self.assertEqual(remote_exec.GcloudSSHTransport._control_dir, control_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
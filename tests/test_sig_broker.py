@@ -0,0 +1,80 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import asyncio
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from sig_broker import BrokerServer, SocketBroker, connect
+
+
+def start_broker():
+    """Runs a broker for the rest of the test run. Workers exit the process
+       when they lose their broker, so it is never stopped."""
+
+    address = f'unix:{tempfile.mkdtemp(prefix="halyard-broker-")}/broker.sock'
+    threading.Thread(target=asyncio.run, args=(BrokerServer().serve(address),),
+                     daemon=True).start()
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            connect(address).close()
+            return address
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+class Inbox:
+
+    def __init__(self):
+        self.frames = []
+        self.received = threading.Event()
+
+    def __call__(self, frame, droppable=False):
+        self.frames.append(frame)
+        self.received.set()
+
+    def wait(self):
+        """Returns the latest frame, or None when none arrived in time"""
+
+        if not self.received.wait(5):
+            return None
+        self.received.clear()
+        return self.frames[-1]
+
+
+class SocketBrokerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.address = start_broker()
+        # Connected workers keep working once the socket file is gone
+        cls.addClassCleanup(shutil.rmtree, os.path.dirname(cls.address.partition(':')[2]))
+
+    def setUp(self):
+        self.worker1 = SocketBroker(self.address)
+        self.worker2 = SocketBroker(self.address)
+
+    def test_duplicate_registration_keeps_the_registered_device(self):
+        device = Inbox()
+        self.assertTrue(self.worker1.register_device('dup', {}, device))
+        self.assertFalse(self.worker1.register_device('dup', {}, Inbox()))
+        self.assertFalse(self.worker2.register_device('dup', {}, Inbox()))
+
+        local_client = self.worker1.register_client('dup', Inbox())
+        remote_client = self.worker2.register_client('dup', Inbox())
+        self.assertIsNotNone(local_client)
+        self.assertIsNotNone(remote_client)
+
+        self.worker1.send_to_device('dup', 'from worker 1')
+        self.assertEqual(device.wait(), 'from worker 1')
+        self.worker2.send_to_device('dup', 'from worker 2')
+        self.assertEqual(device.wait(), 'from worker 2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import json
+import time
+import unittest
+
+import sig_protocol
+from sig_protocol import RAW_PAYLOAD_MIN_SIZE, RawPayload, encode_message, parse_message
+
+SDP = 'v=0\\r\\n' + 'a=candidate:1 1 udp 2122260223 10.0.0.1 5000 typ host\\r\\n' * 50
+
+def large(payload, suffix=''):
+    raw = f'{{"message_type": "forward", "device_id": "d1", "payload": {payload}}}{suffix}'
+    assert len(raw) >= RAW_PAYLOAD_MIN_SIZE
+    return raw
+
+
+class ParseMessageTest(unittest.TestCase):
+
+    def test_small_message_is_decoded(self):
+        message = parse_message('{"message_type": "forward", "payload": {"a": [1]}}')
+        self.assertEqual(message['payload'], {"a": [1]})
+        self.assertNotIsInstance(message['payload'], RawPayload)
+
+    def test_large_payload_is_spliced(self):
+        payload = json.dumps({"type": "offer", "sdp": SDP, "nested": [{"a": "}]"}]})
+        message = parse_message(large(payload).encode())
+
+        self.assertIsInstance(message['payload'], RawPayload)
+        self.assertEqual(message['payload'], payload)
+        self.assertEqual(message['device_id'], 'd1')
+        self.assertEqual(json.loads(encode_message(message)),
+                         json.loads(large(payload)))
+
+    def test_large_message_allows_trailing_whitespace(self):
+        payload = json.dumps({"sdp": SDP})
+        self.assertEqual(parse_message(large(payload, ' \n'))['payload'], payload)
+
+    def test_mismatched_brackets_are_rejected(self):
+        with self.assertRaises(ValueError):
+            parse_message(large(f'{{"sdp": "{SDP}", "a": ]'))
+        with self.assertRaises(ValueError):
+            parse_message(large(f'[{{"sdp": "{SDP}"]}}'))
+
+    def test_trailing_data_is_rejected(self):
+        payload = json.dumps({"sdp": SDP})
+        with self.assertRaises(ValueError):
+            parse_message(large(payload, '}'))
+        with self.assertRaises(ValueError):
+            parse_message(large(payload, ' garbage'))
+
+    def test_trailing_comma_is_rejected(self):
+        payload = json.dumps({"sdp": SDP})
+        with self.assertRaises(ValueError):
+            parse_message(large(payload, '').replace(f'{payload}}}', f'{payload},}}'))
+
+    def test_unterminated_payload_is_rejected(self):
+        with self.assertRaises(ValueError):
+            parse_message(large(f'{{"sdp": "{SDP}"', ''))
+
+
+class StubOutbox:
+
+    def __init__(self):
+        self.frames = []
+        self.aborted = False
+
+    def put(self, frame, droppable=False):
+        self.frames.append(frame)
+
+    def abort(self):
+        self.aborted = True
+
+
+class StubConnection:
+    kind = 'client'
+    device_id = 'd1'
+
+    def __init__(self):
+        self.outbox = StubOutbox()
+
+
+class ManualHeartbeat(sig_protocol.Heartbeat):
+
+    def start(self):
+        pass
+
+
+class HeartbeatTest(unittest.TestCase):
+
+    def test_first_connection_after_long_uptime_is_kept(self):
+        heartbeat = ManualHeartbeat()
+        # Created when the server started, long before the first connection
+        heartbeat.now = time.monotonic() - 10 * sig_protocol.IDLE_TIMEOUT
+        connection = StubConnection()
+        heartbeat.watch(connection)
+        heartbeat.tick()
+        self.assertFalse(connection.outbox.aborted)
+
+    def test_idle_connection_is_evicted(self):
+        heartbeat = ManualHeartbeat()
+        connection = StubConnection()
+        heartbeat.watch(connection)
+        connection.last_activity -= sig_protocol.IDLE_TIMEOUT
+        heartbeat.check(connection)
+        self.assertTrue(connection.outbox.aborted)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import types
+import unittest
+
+import halyard_utils as utils
+import state_store
+from state_store import DISKS, IMAGES, INSTANCES, StateStore
+
+ZONE = 'us-central1-b'
+OTHER_ZONE = 'europe-west4-a'
+
+
+def instance(name, zone=ZONE, **labels):
+    return {"name": name, "zone": f'zones/{zone}', "status": 'RUNNING',
+            "labels": labels,
+            "disks": [{"boot": True, "source": f'zones/{zone}/disks/{name}'}]}
+
+def disk(name, zone=ZONE, **labels):
+    return {"name": name, "zone": f'zones/{zone}', "status": 'READY',
+            "labels": labels, "labelFingerprint": str(len(labels))}
+
+def image(name, family, deprecated=False):
+    item = {"name": name, "family": family, "status": 'READY'}
+    if deprecated:
+        item['deprecated'] = {"state": 'DEPRECATED'}
+    return item
+
+
+class FakeDriver:
+    """Answers GCE list requests from in memory resources, a page at a time"""
+
+    def __init__(self):
+        self.zone = types.SimpleNamespace(name=ZONE)
+        self.resources = {INSTANCES: [], DISKS: [], IMAGES: []}
+        self.connection = self
+        self.on_list = None # called with the kind of every list request
+
+    def request(self, path, method='GET', params=None):
+        kind = path.rsplit('/', 1)[-1]
+        if self.on_list:
+            self.on_list(kind)
+        start = int(params.get('pageToken', 0))
+        end = start + params['maxResults']
+        items = self.resources[kind][start:end]
+        response = {}
+        if path.startswith('/aggregated'):
+            response['items'] = {'zones/all': {kind: items}}
+        else:
+            response['items'] = items
+        if end < len(self.resources[kind]):
+            response['nextPageToken'] = str(end)
+        return types.SimpleNamespace(object=response)
+
+
+class StateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = FakeDriver()
+        self.store = StateStore(self.driver, ':memory:')
+
+    def names(self, pages):
+        return [item['name'] for items, _ in pages for item in items]
+
+    def test_keyset_pagination_returns_every_name_once(self):
+        self.driver.resources[INSTANCES] = [instance(f'halyard-{i}') for i in range(5)]
+        self.store.reconcile()
+
+        names, page_token = [], None
+        while True:
+            items, page_token = self.store.instances('halyard', ZONE, 2, page_token)
+            self.assertLessEqual(len(items), 2)
+            names += [item['name'] for item in items]
+            if not page_token:
+                break
+        self.assertEqual(names, [f'halyard-{i}' for i in range(5)])
+
+    def test_listings_filter_by_prefix_and_zone(self):
+        self.driver.resources[INSTANCES] = [
+            instance('halyard-a'), instance('halyard-b', OTHER_ZONE),
+            instance('halyard-warm-1', **{utils.STATE_LABEL: 'idle'})]
+        self.store.reconcile()
+
+        self.assertEqual(self.names(utils.iter_pages(lambda max_results, page_token:
+            self.store.instances('halyard', None, max_results, page_token))), ['halyard-a'])
+        items, _ = self.store.instances('halyard-b', 'all')
+        self.assertEqual([item['name'] for item in items], ['halyard-b'])
+
+    def test_stopped_disks_have_no_instance_of_their_user_in_their_zone(self):
+        self.driver.resources[INSTANCES] = [
+            instance('halyard-u1'),
+            instance('halyard-u3', OTHER_ZONE),
+            instance('halyard-warm-1', **{utils.USER_LABEL: 'u4'})]
+        self.driver.resources[DISKS] = [
+            disk(f'{utils.USER_DISK_PREFIX}{user_id}') for user_id in ('u1', 'u2', 'u3', 'u4')]
+        self.store.reconcile()
+
+        stopped, _ = self.store.stopped_disks(utils.USER_DISK_PREFIX, ZONE)
+        self.assertEqual([item['name'] for item in stopped],
+                         [f'{utils.USER_DISK_PREFIX}u2', f'{utils.USER_DISK_PREFIX}u3'])
+
+    def test_images_skip_deprecated_ones_and_filter_by_family(self):
+        self.driver.resources[IMAGES] = [
+            image('halyard-1', 'halyard-a'), image('halyard-2', 'halyard-a', deprecated=True),
+            image('halyard-3', 'halyard-b')]
+        self.store.reconcile()
+
+        items, _ = self.store.images('halyard')
+        self.assertEqual([item['name'] for item in items], ['halyard-1', 'halyard-3'])
+        items, _ = self.store.images('halyard', 'halyard-b')
+        self.assertEqual([item['name'] for item in items], ['halyard-3'])
+
+    def test_sync_writes_only_changed_rows(self):
+        self.driver.resources[DISKS] = [disk('halyard-user-a'), disk('halyard-user-b')]
+        self.store.reconcile([DISKS])
+        self.assertEqual(self.store.writes[DISKS], 2)
+
+        self.driver.resources[DISKS][1] = disk('halyard-user-b', branch='main')
+        self.store.reconcile([DISKS])
+        self.assertEqual(self.store.writes[DISKS], 3)
+
+    def test_sync_drops_missing_rows_but_keeps_newer_ones(self):
+        self.driver.resources[DISKS] = [
+            disk('halyard-user-a'), disk('halyard-user-b'), disk('halyard-user-gone')]
+        self.store.reconcile([DISKS])
+        self.driver.resources[DISKS] = [disk('halyard-user-a')]
+
+        # Written while the listing runs, so the listing can't have it yet
+        def recreate_disk(kind):
+            self.store._put(DISKS, [state_store.disk_row(disk('halyard-user-b'))],
+                            time.time())
+        self.driver.on_list = recreate_disk
+        self.store.reconcile([DISKS])
+
+        items, _ = self.store.disks('halyard-user-')
+        self.assertEqual([item['name'] for item in items],
+                         ['halyard-user-a', 'halyard-user-b'])
+
+    def test_synced_once_every_kind_was_listed(self):
+        self.assertFalse(self.store.synced())
+        self.store.reconcile([DISKS])
+        self.assertFalse(self.store.synced())
+        self.store.reconcile()
+        self.assertTrue(self.store.synced())
+
+
+if __name__ == '__main__':
+    unittest.main()
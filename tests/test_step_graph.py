@@ -0,0 +1,77 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import threading
+import time
+import unittest
+
+from step_graph import StepGraph
+
+
+class StepGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = StepGraph()
+        self.addCleanup(self.graph.close)
+
+    def test_steps_get_the_results_of_their_dependencies(self):
+        self.graph.add('a', lambda: 2)
+        self.graph.add('b', lambda: 3)
+        self.graph.add('sum', lambda a, b: a + b, after=['a', 'b'])
+        self.assertEqual(self.graph.result('sum'), 5)
+
+    def test_failure_propagates_without_running_dependents(self):
+        ran = []
+        def fail():
+            raise ValueError('lookup failed')
+        self.graph.add('a', fail)
+        self.graph.add('b', lambda a: ran.append('b'), after=['a'])
+        self.graph.add('c', lambda b: ran.append('c'), after=['b'])
+
+        for name in ('a', 'b', 'c'):
+            with self.assertRaisesRegex(ValueError, 'lookup failed'):
+                self.graph.result(name)
+        self.assertEqual(ran, [])
+        self.assertEqual(list(self.graph.timings()), ['a'])
+
+    def test_critical_path_follows_the_latest_dependency(self):
+        self.graph.add('fast', lambda: None)
+        self.graph.add('slow', lambda: time.sleep(0.1))
+        self.graph.add('join', lambda *ready: None, after=['fast', 'slow'])
+        self.graph.add('last', lambda join: None, after=['join'])
+        self.graph.result('last')
+
+        self.assertEqual(self.graph.critical_path('last'), ['slow', 'join', 'last'])
+        timings = self.graph.timings()
+        self.assertGreaterEqual(timings['slow']['duration'], 0.1)
+        self.assertGreaterEqual(timings['join']['start'], timings['slow']['start'] + 0.1)
+
+    def test_close_waits_for_running_steps(self):
+        done = []
+        def fail():
+            raise ValueError('create failed')
+        def label():
+            time.sleep(0.1)
+            done.append('label')
+        self.graph.add('label', label)
+        self.graph.add('create', fail)
+        with self.assertRaises(ValueError):
+            self.graph.result('create')
+        self.graph.close()
+        self.assertEqual(done, ['label'])
+
+    def test_blocked_graph_does_not_hold_up_other_graphs(self):
+        release = threading.Event()
+        blocked = StepGraph(max_workers=1)
+        self.addCleanup(blocked.close)
+        self.addCleanup(release.set) # cleanups run last in, first out
+        blocked.add('wait_for_instance', release.wait)
+
+        other = StepGraph()
+        self.addCleanup(other.close)
+        other.add('check_instance', lambda: 'checked')
+        self.assertEqual(other.steps['check_instance'].result(timeout=5), 'checked')
+        self.assertIsNot(blocked.executor, other.executor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import math
+
+
+class TimerWheel:
+    """Hashed timer wheel.
+       Timers are hashed into slots by the tick they are due at, so
+       advancing the clock only visits the slots of the elapsed ticks.
+       Delays shorter than the wheel span cost O(expired) per advance."""
+
+    def __init__(self, tick, span, now=0.0):
+        self.tick = tick
+        self.slots = [{} for _ in range(int(math.ceil(span / tick)) + 1)]
+        self.current = int(now / tick) # last tick that was processed
+        self.timers = {} # key -> slot index
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, delay):
+        """(Re)schedules key to expire after delay seconds"""
+
+        self.cancel(key)
+        due = self.current + max(1, int(math.ceil(delay / self.tick)))
+        index = due % len(self.slots)
+        self.slots[index][key] = due
+        self.timers[key] = index
+
+    def cancel(self, key):
+        index = self.timers.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def advance(self, now):
+        """Moves the wheel to now and returns the keys that expired"""
+
+        expired = []
+        target = int(now / self.tick)
+        # After a long pause every slot has to be visited once at most
+        if target - self.current > len(self.slots):
+            self.current = target - len(self.slots)
+        while self.current < target:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            # Timers further than the span stay for another round
+            due_keys = [key for key, due in slot.items() if due <= self.current]
+            for key in due_keys:
+                del slot[key]
+                del self.timers[key]
+            expired.extend(due_keys)
+        return expired
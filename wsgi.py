@@ -1,10 +1,130 @@
-from sig_server import app
+import argparse
+
+# The gevent backend has to patch the standard library before anything
+# else imports it, so the backend is known before the other imports
+backend_parser = argparse.ArgumentParser(add_help=False)
+backend_parser.add_argument('--backend', dest='backend', action='store',
+                            choices=['gevent', 'asyncio'], default='gevent')
+backend = backend_parser.parse_known_args()[0].backend
+if backend == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+    from sig_server import app
+
 import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
 
-logging.basicConfig(level=logging.DEBUG)
+import sig_protocol
+from sig_broker import SocketBroker, connect
 
-if __name__ == "__main__":
+parser = argparse.ArgumentParser(parents=[backend_parser])
+parser.add_argument('--port', dest='port', action='store', type=int, default=8000)
+parser.add_argument('--workers', dest='workers', action='store', type=int, default=1)
+# Address of a shared broker, e.g. unix:/tmp/sig.sock or tcp:host:9000.
+# Started locally when several workers are run without one.
+parser.add_argument('--broker', dest='broker', action='store', default='')
+parser.add_argument('--listen_fd', dest='listen_fd', action='store', type=int)
+parser.add_argument('--outbox_size', dest='outbox_size', action='store', type=int,
+                    default=sig_protocol.OUTBOX_SIZE)
+# drop_ice or disconnect
+parser.add_argument('--overflow_policy', dest='overflow_policy', action='store',
+                    default=sig_protocol.overflow_policy)
+parser.add_argument('--log_level', dest='log_level', action='store', default='INFO')
+# Share of forwarded messages logged at DEBUG level
+parser.add_argument('--log_sample_rate', dest='log_sample_rate', action='store',
+                    type=float, default=sig_protocol.LOG_SAMPLE_RATE)
+parser.add_argument('--ping_interval', dest='ping_interval', action='store',
+                    type=float, default=sig_protocol.PING_INTERVAL)
+parser.add_argument('--idle_timeout', dest='idle_timeout', action='store',
+                    type=float, default=sig_protocol.IDLE_TIMEOUT)
+# With several workers, worker i serves /metrics on metrics_port + i
+parser.add_argument('--metrics_port', dest='metrics_port', action='store',
+                    type=int, default=0)
+
+BROKER_START_TIMEOUT = 10
+
+def wait_for_broker(address):
+    deadline = time.monotonic() + BROKER_START_TIMEOUT
+    while True:
+        try:
+            connect(address).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+def serve(listener, metrics_port=0):
+    if backend == 'asyncio':
+        import sig_server_asyncio
+        sig_server_asyncio.run(listener, metrics_port)
+        return
     from gevent import pywsgi
     from geventwebsocket.handler import WebSocketHandler
-    server = pywsgi.WSGIServer(('', 8000), app, handler_class=WebSocketHandler)
-    server.serve_forever()
\ No newline at end of file
+    if metrics_port:
+        pywsgi.WSGIServer(('', metrics_port), app, log=None).start()
+    server = pywsgi.WSGIServer(listener, app, handler_class=WebSocketHandler)
+    server.serve_forever()
+
+def run_workers(args):
+    """Starts the broker if needed and one worker process per core.
+       Workers share the listening socket, the kernel balances accepts."""
+
+    processes = []
+    broker_address = args.broker
+    if not broker_address:
+        broker_address = f'unix:/tmp/halyard-sig-broker-{os.getpid()}.sock'
+        processes.append(subprocess.Popen([sys.executable, 'sig_broker.py',
+            '--address', broker_address], cwd=os.path.dirname(os.path.abspath(__file__))))
+    wait_for_broker(broker_address)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', args.port))
+    listener.listen(socket.SOMAXCONN)
+    for i in range(args.workers):
+        metrics_port = args.metrics_port + i if args.metrics_port else 0
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__),
+            '--backend', backend, '--broker', broker_address, '--listen_fd', str(listener.fileno()),
+            '--outbox_size', str(args.outbox_size),
+            '--overflow_policy', args.overflow_policy,
+            '--log_level', args.log_level,
+            '--log_sample_rate', str(args.log_sample_rate),
+            '--ping_interval', str(args.ping_interval),
+            '--idle_timeout', str(args.idle_timeout),
+            '--metrics_port', str(metrics_port)],
+            pass_fds=[listener.fileno()]))
+
+    def stop(signum, frame):
+        for process in processes:
+            process.terminate()
+        if not args.broker:
+            os.remove(broker_address.partition(':')[2])
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for process in processes:
+        process.wait()
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper())
+    sig_protocol.configure_outbox(args.outbox_size, args.overflow_policy)
+    sig_protocol.configure_logging(args.log_sample_rate)
+    sig_protocol.configure_heartbeat(args.ping_interval, args.idle_timeout)
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        if args.broker:
+            sig_protocol.set_broker(SocketBroker(
+                args.broker, on_undeliverable=sig_protocol.report_undeliverable))
+        if args.listen_fd is not None:
+            listener = socket.socket(fileno=args.listen_fd)
+        else:
+            listener = ('', args.port)
+        serve(listener, args.metrics_port)
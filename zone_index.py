@@ -0,0 +1,128 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import halyard_utils as utils
+
+INSTANCES = 'instances'
+DISKS = 'disks'
+
+MAX_WORKERS = 8
+
+index = None
+
+
+class ZoneIndex:
+    """Remembers the zone of instances and disks by name.
+       A name that isn't known yet is looked up in every configured zone
+       at once, so finding it takes the time of a single call. Known
+       names are checked in their zone only."""
+
+    def __init__(self, zones):
+        self.zones = list(dict.fromkeys(zones))
+        self.zones_by_name = {INSTANCES: {}, DISKS: {}} # kind -> name -> zone
+        self.lookups = 0 # fan-out lookups, the others were index hits
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=MAX_WORKERS,
+                                            thread_name_prefix='halyard-zone')
+
+    def get(self, kind, name):
+        with self._lock:
+            return self.zones_by_name[kind].get(name)
+
+    def remember(self, kind, name, zone):
+        with self._lock:
+            self.zones_by_name[kind][name] = zone
+            if zone not in self.zones:
+                self.zones.append(zone)
+
+    def remember_all(self, kind, zones_by_name):
+        """Replaces what is known about kind with a full listing"""
+
+        with self._lock:
+            self.zones_by_name[kind] = dict(zones_by_name)
+            for zone in zones_by_name.values():
+                if zone not in self.zones:
+                    self.zones.append(zone)
+
+    def forget(self, kind, name):
+        with self._lock:
+            self.zones_by_name[kind].pop(name, None)
+
+    def find(self, kind, name, find_in_zone):
+        """Returns the resource find_in_zone(zone) finds and its zone,
+           or (None, None) when no configured zone has it."""
+
+        zone = self.get(kind, name)
+        if zone:
+            resource = find_in_zone(zone)
+            if resource:
+                return resource, zone
+            # Deleted or recreated elsewhere behind our back
+            self.forget(kind, name)
+
+        with self._lock:
+            zones = list(self.zones)
+            self.lookups += 1
+        futures = {self._executor.submit(find_in_zone, zone): zone for zone in zones}
+        for future in as_completed(futures):
+            resource = future.result()
+            if resource:
+                # The remaining lookups finish in the background
+                self.remember(kind, name, futures[future])
+                return resource, futures[future]
+        return None, None
+
+    def stats(self):
+        with self._lock:
+            return {"zones": list(self.zones),
+                    "instances": len(self.zones_by_name[INSTANCES]),
+                    "disks": len(self.zones_by_name[DISKS]),
+                    "lookups": self.lookups}
+
+
+def configure(zones):
+    global index
+    index = ZoneIndex(zones)
+    return index
+
+def _index():
+    global index
+    if not index:
+        index = ZoneIndex([])
+    return index
+
+def find_instance(driver, instance_name, zone=None):
+    """Finds an instance in zone, or in any configured zone without one.
+       Returns the node and its zone."""
+
+    if zone:
+        node = utils.find_instance(driver, instance_name, zone)
+        if node:
+            remember(INSTANCES, instance_name, zone)
+        return node, zone
+    return _index().find(INSTANCES, instance_name,
+        lambda zone: utils.find_instance(driver, instance_name, zone))
+
+def find_disk(driver, disk_name, zone=None):
+    """Finds a disk in zone, or in any configured zone without one.
+       Returns the disk and its zone."""
+
+    if zone:
+        disk = utils.find_disk(driver, disk_name, zone)
+        if disk:
+            remember(DISKS, disk_name, zone)
+        return disk, zone
+    return _index().find(DISKS, disk_name,
+        lambda zone: utils.find_disk(driver, disk_name, zone))
+
+def get(kind, name):
+    return _index().get(kind, name)
+
+def remember(kind, name, zone):
+    _index().remember(kind, name, zone)
+
+def remember_all(kind, zones_by_name):
+    _index().remember_all(kind, zones_by_name)
+
+def forget(kind, name):
+    _index().forget(kind, name)